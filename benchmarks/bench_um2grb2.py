@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+"""
+Stage level benchmark suite of um2grb2.
+
+It generates synthetic UM like input files (PP format, N768 grid, with the
+real STASH codes and time axes of the pb/pd/pe/pf files) into a working
+directory, so that it runs without the NCMRWF /gpfs data. Then it times
+every stage of the conversion pipeline separately:
+
+    load     - getCubeData (iris load with STASH & forecast hour constraints)
+    extract  - getCubeIndex & getIndexedCube loop of every variable & hour
+    average  - cubeWindowsAverager (cubeAverager) of the pf accumulations
+    regrid   - regridder.regrid to the 0.25x0.25 target grid, cold (the
+               first use of the weights, which builds them) & warm, by the
+               method of the variable (conservative for the accumulations,
+               as like as um2grb2.regridAnlFcstFiles)
+    encode   - grib2io.encodeCube (GRIB2 message encoding) & append
+    packing  - grib2io.encodeCube with the packing policy of the variable
+               (um2grb2.getVarPacking)
+    field_cache - fieldcache.FieldCache write & read back of the regridded
+               fields
+    prefetch - iterFieldLevels through prefetch.Prefetcher (reader thread)
+               while the level slices are regridded
+    shuffle  - um2grb2.doShuffleVarsInOrder (byte level re-ordering and the
+               ctl & idx of the ordered file)
+    ctl      - gradsctl.writeCtlIdx (native GrADS ctl & idx)
+
+The synthetic inputs are PP files, so the native fieldsfile reader is timed
+and verified only over a sample real fieldsfile (--fieldsfile), whose every
+level slice is read by both the readers:
+
+    iris_read   - iris (lazy data of the level slice)
+    native_read - um2grb2.getNativeLevelData (fieldsfile.FieldsFile)
+
+The native arrays must be the same as the iris arrays (values & mask), else
+the mismatched fields are listed and it exits with error, i.e. this is the
+check to be passed before enabling the nativeReader option of um2grb2. Its
+result is recorded as native_check in the --save-baseline json.
+
+For every stage it reports the wall time, throughput (fields/s, MB/s) and
+the peak RSS of the process after that stage, and it compares the timings
+against the stored baseline json (if any).
+
+Usage:
+    python benchmarks/bench_um2grb2.py --workdir /tmp/um2grb2bench
+    python benchmarks/bench_um2grb2.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_um2grb2.py --baseline benchmarks/baseline.json
+    python benchmarks/bench_um2grb2.py --fieldsfile /path/to/umglaa_pd000
+"""
+
+import os, sys, time, json, shutil, resource, argparse, datetime
+import numpy
+
+# lets import g2utils from this source tree
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import iris
+import iris.coords
+import iris.coord_systems
+import iris.fileformats.pp as pp
+import iris.unit as unit
+from g2utils import um2grb2, regridder, grib2io, gradsctl, fieldcache, prefetch
+
+# synthetic input files, as like as the real fieldsfiles
+# (file name, [(variable name, STASH, units)], levels, forecast hours, mean)
+_inputs_ = [
+    ('umglaa_pb000', [('surface_temperature', 'm01s00i024', 'K')], 0, range(3, 25, 3), False),
+    ('umglaa_pd000', [('air_temperature', 'm01s16i203', 'K')], 18, range(3, 25, 3), False),
+    ('umglaa_pe000', [('air_pressure_at_sea_level', 'm01s16i222', 'Pa')], 0, range(1, 25), False),
+    ('umglaa_pf000', [('stratiform_rainfall_amount', 'm01s04i201', 'kg m-2')], 0, range(3, 25, 3), True),
+]
+_pressureLevels_ = [1000, 975, 950, 925, 900, 850, 800, 700, 600, 500,
+                    400, 300, 250, 200, 150, 100, 70, 50]
+# accumulations are regridded conservatively (see um2grb2.regridAnlFcstFiles)
+_accumulationTypes_ = ['rain', 'precip', 'snow']
+_stages_ = ['load', 'extract', 'average', 'regrid', 'regrid_warm',
+            'encode', 'packing', 'field_cache', 'prefetch', 'shuffle', 'ctl',
+            'iris_read', 'native_read']
+
+
+def peakRSS():
+    """
+    It returns the peak resident set size of this process in MB.
+    """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+# end of def peakRSS():
+
+
+def n768Grid(nlon=1536, nlat=1152):
+    """
+    It returns the N768 (ENDGame) latitude & longitude coordinates.
+    """
+    cs = iris.coord_systems.GeogCS(6371229.0)
+    dlon, dlat = 360.0 / nlon, 180.0 / nlat
+    lon = iris.coords.DimCoord(numpy.arange(nlon) * dlon + dlon / 2, 'longitude',
+                               units='degrees', coord_system=cs, circular=True)
+    lat = iris.coords.DimCoord(numpy.arange(nlat) * dlat - 90 + dlat / 2, 'latitude',
+                               units='degrees', coord_system=cs)
+    return lat, lon
+# end of def n768Grid(nlon=1536, nlat=1152):
+
+
+def makeCube(varName, varSTASH, units, levels, fhrs, isMean, lat, lon, refTime):
+    """
+    It creates the synthetic cube (time, [pressure], latitude, longitude) of
+    smooth field values (so that the packing is as like as real fields).
+    """
+    nt, nlat, nlon = len(fhrs), len(lat.points), len(lon.points)
+    shape = (nt, len(levels), nlat, nlon) if levels else (nt, nlat, nlon)
+    yy, xx = numpy.meshgrid(numpy.deg2rad(lat.points), numpy.deg2rad(lon.points), indexing='ij')
+    field = (280.0 + 20.0 * numpy.cos(yy) * numpy.sin(2 * xx)).astype(numpy.float32)
+    data = numpy.empty(shape, dtype=numpy.float32)
+    for ti in range(nt):
+        if levels:
+            for li in range(len(levels)):
+                data[ti, li] = field - li - ti * 0.1
+        else:
+            data[ti] = field - ti * 0.1
+    # end of for ti in range(nt):
+
+    cube = iris.cube.Cube(data, long_name=varName, units=units)
+    try:
+        cube.standard_name = varName
+    except ValueError:
+        pass
+    cube.attributes['STASH'] = pp.STASH.from_msi(varSTASH)
+    tunit = unit.Unit('hours since 1970-01-01 00:00:00', calendar=unit.CALENDAR_STANDARD)
+    frt = tunit.date2num(refTime)
+    fhrs = numpy.array(fhrs, dtype=numpy.float64)
+    bounds = None
+    if isMean:
+        # 3-hourly mean/accumulation periods
+        bounds = numpy.column_stack([fhrs - 3, fhrs])
+    cube.add_dim_coord(iris.coords.DimCoord(fhrs + frt, 'time', units=tunit,
+                       bounds=None if bounds is None else bounds + frt), 0)
+    cube.add_aux_coord(iris.coords.AuxCoord(fhrs, 'forecast_period', units='hours',
+                                            bounds=bounds), 0)
+    cube.add_aux_coord(iris.coords.AuxCoord(frt, 'forecast_reference_time', units=tunit))
+    if levels:
+        cube.add_dim_coord(iris.coords.DimCoord(numpy.array(levels, dtype=numpy.float32),
+                                                long_name='pressure', units='hPa'), 1)
+    cube.add_dim_coord(lat.copy(), cube.ndim - 2)
+    cube.add_dim_coord(lon.copy(), cube.ndim - 1)
+    if isMean:
+        cube.add_cell_method(iris.coords.CellMethod('sum', coords='time'))
+    return cube
+# end of def makeCube(...):
+
+
+def generateInputs(workdir, nlon, nlat, ntimes):
+    """
+    It writes the synthetic input files (PP format) into workdir.
+    :param ntimes: no of time steps per input file (0 for all). The mean
+                   inputs need at least 2 time steps for one 6-hourly window.
+    :return: list of (file path, varNamesSTASH, forecast hours, mean) tuples.
+    """
+    lat, lon = n768Grid(nlon, nlat)
+    refTime = datetime.datetime(2015, 12, 9, 0)
+    inputs = []
+    for fname, variables, nlev, fhrs, isMean in _inputs_:
+        fhrs = fhrs[:ntimes] if ntimes else fhrs
+        if isMean and len(fhrs) < 2:
+            raise ValueError("mean input %s needs at least 2 time steps, got %d" % (fname, len(fhrs)))
+        fpath = os.path.join(workdir, fname + '.pp')
+        if not os.path.isfile(fpath):
+            levels = _pressureLevels_[:nlev]
+            cubes = [makeCube(name, STASH, units, levels, fhrs, isMean, lat, lon, refTime)
+                     for name, STASH, units in variables]
+            iris.save(cubes, fpath)
+            print "Generated synthetic input", fpath
+        # end of if not os.path.isfile(fpath):
+        varNamesSTASH = [(name, STASH) for name, STASH, units in variables]
+        inputs.append((fpath, varNamesSTASH, fhrs, isMean))
+    # end of for fname, variables, nlev, fhrs, isMean in _inputs_:
+    return inputs
+# end of def generateInputs(workdir, nlon, nlat, ntimes):
+
+
+class Stage(object):
+    """
+    Accumulates the wall time, no of fields and bytes of the stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.fields = 0
+        self.nbytes = 0
+        self.peakRSS = 0.0
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.time() - self._start
+        self.peakRSS = max(self.peakRSS, peakRSS())
+
+    def report(self):
+        fps = self.fields / self.seconds if self.seconds else 0.0
+        mbps = self.nbytes / 1048576.0 / self.seconds if self.seconds else 0.0
+        return {'seconds': self.seconds, 'fields': self.fields, 'bytes': self.nbytes,
+                'fields_per_sec': fps, 'mb_per_sec': mbps, 'peak_rss_mb': self.peakRSS}
+# end of class Stage(object):
+
+
+def regridMethod(varName):
+    """
+    It returns the regridding method of the variable, as like as
+    um2grb2.regridAnlFcstFiles (conservative for the accumulations).
+    """
+    for acc in _accumulationTypes_:
+        if acc in varName: return 'conservative'
+    return 'linear'
+# end of def regridMethod(varName):
+
+
+def nfields(cube):
+    # no of 2-D (latitude, longitude) fields of the cube
+    return int(numpy.prod(cube.shape[:-2]))
+# end of def nfields(cube):
+
+
+def runBenchmark(workdir, inputs, stages):
+    """
+    It runs all the pipeline stages over the synthetic inputs.
+    :return: dictionary of stage name and its report.
+    """
+    outdir = os.path.join(workdir, 'out')
+    if os.path.exists(outdir): shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    weightsDir = os.path.join(workdir, 'regridWeights')
+    if os.path.exists(weightsDir): shutil.rmtree(weightsDir)
+    targetGrid = [('longitude', numpy.linspace(0, 360, 1440)),
+                  ('latitude', numpy.linspace(-90, 90, 721))]
+    outFn = os.path.join(outdir, 'um_prg_006hr_20151209' + um2grb2._fext_ + '.grib2')
+    regridder._weightsCache_.clear()
+    cacheDir = os.path.join(workdir, 'fieldCache')
+    if os.path.exists(cacheDir): shutil.rmtree(cacheDir)
+    cache = fieldcache.FieldCache(cacheDir, 1024 ** 4)
+
+    for fpath, varNamesSTASH, fhrs, isMean in inputs:
+        # 6-hourly windows of 3-hourly mean fields, as like as pf (1, 5), ...
+        windows = numpy.array([(fhrs[i] - 2, fhrs[i + 1] - 1) for i in range(0, len(fhrs) - 1, 2)])
+        with stages['load'] as stage:
+            cubes = um2grb2.getCubeData(fpath, varNamesSTASH, windows if isMean else fhrs)
+            stage.fields += sum([nfields(cube) for cube in cubes])
+            stage.nbytes += os.path.getsize(fpath)
+        # end of with stages['load'] as stage:
+
+        for varName, varSTASH in varNamesSTASH:
+            method = regridMethod(varName)
+            fieldCubes = []
+            with stages['extract'] as stage:
+                index = um2grb2.getCubeIndex(cubes)
+                for fhr in fhrs:
+                    cube = um2grb2.getIndexedCube(index, varName, varSTASH, fhr)
+                    if cube is None: continue
+                    fieldCubes.append(cube)
+                    stage.fields += nfields(cube)
+                    stage.nbytes += cube.data.nbytes
+                # end of for fhr in fhrs:
+            # end of with stages['extract'] as stage:
+
+            if isMean:
+                with stages['average'] as stage:
+                    tmpCube = um2grb2.getIndexedCube(index, varName, varSTASH, numpy.ravel(windows))
+                    stage.fields += nfields(tmpCube)
+                    stage.nbytes += tmpCube.data.nbytes
+                    fieldCubes = um2grb2.cubeWindowsAverager(tmpCube, windows, 'sum', '6-hourly')
+                # end of with stages['average'] as stage:
+            # end of if isMean:
+
+            for ci, cube in enumerate(fieldCubes):
+                # only the first use of the weights is cold (builds them)
+                key = regridder._gridKey(cube.coord('latitude'), cube.coord('longitude'),
+                                         targetGrid, method)
+                stageName = 'regrid_warm' if key in regridder._weightsCache_ else 'regrid'
+                with stages[stageName] as stage:
+                    regdCube = regridder.regrid(cube, targetGrid, cacheDir=weightsDir, method=method)
+                    stage.fields += nfields(regdCube)
+                    stage.nbytes += regdCube.data.nbytes
+                # end of with stages[stageName] as stage:
+
+                with stages['encode'] as stage:
+                    messages = grib2io.encodeCube(regdCube)
+                    grib2io.appendMessages(outFn, messages)
+                    stage.fields += len(messages)
+                    stage.nbytes += sum([len(msg) for msg, keys in messages])
+                # end of with stages['encode'] as stage:
+
+                with stages['packing'] as stage:
+                    packing = um2grb2.getVarPacking(varName, varSTASH, bool(regdCube.coords('pressure')))
+                    messages = grib2io.encodeCube(regdCube, packing=packing)
+                    stage.fields += len(messages)
+                    stage.nbytes += sum([len(msg) for msg, keys in messages])
+                # end of with stages['packing'] as stage:
+
+                with stages['field_cache'] as stage:
+                    cacheKey = fieldcache.makeKey(fpath, varSTASH, ci)
+                    writer = cache.writer(cacheKey)
+                    for levCube in regdCube.slices(['latitude', 'longitude']):
+                        writer.append(levCube.data)
+                    writer.commit()
+                    levels = cache.get(cacheKey)
+                    for li in range(len(levels)):
+                        # pages in the level (nan check of the mask)
+                        stage.nbytes += fieldcache.getLevel(levels, li).nbytes
+                    stage.fields += len(levels)
+                # end of with stages['field_cache'] as stage:
+            # end of for ci, cube in enumerate(fieldCubes):
+        # end of for varName, varSTASH in varNamesSTASH:
+        del cubes
+
+        # lazy data again, so that the reader thread reads it
+        cubes = um2grb2.getCubeData(fpath, varNamesSTASH, fhrs)
+        index = um2grb2.getCubeIndex(cubes)
+        fields = list(enumerate(fhrs))
+        with stages['prefetch'] as stage:
+            for varName, varSTASH in varNamesSTASH:
+                method = regridMethod(varName)
+                reader = prefetch.Prefetcher(um2grb2.iterFieldLevels(index, varName, varSTASH, fields),
+                                             um2grb2._prefetchDepth_)
+                try:
+                    for fi, fhr in fields:
+                        for levCube in reader.group(fi):
+                            regridder.regrid(levCube, targetGrid, cacheDir=weightsDir, method=method)
+                            stage.fields += 1
+                            stage.nbytes += levCube.data.nbytes
+                        # end of for levCube in reader.group(fi):
+                    # end of for fi, fhr in fields:
+                finally:
+                    reader.close()
+                # end of try:
+            # end of for varName, varSTASH in varNamesSTASH:
+        # end of with stages['prefetch'] as stage:
+        del cubes, index
+    # end of for fpath, varNamesSTASH, fhrs, isMean in inputs:
+
+    um2grb2._ctlMode_ = 'native'
+    um2grb2._ctlTemplate_ = False
+    um2grb2._manifestPath_ = None
+    nbytes = os.path.getsize(outFn)
+    with stages['shuffle'] as stage:
+        written = um2grb2.doShuffleVarsInOrder(outFn)
+        if written is None:
+            raise ValueError("Couldn't re-order %s" % outFn)
+        newfilefpath = outFn.split(um2grb2._fext_)[0] + '.grib2'
+        stage.fields += len(written)
+        stage.nbytes += nbytes
+    # end of with stages['shuffle'] as stage:
+
+    with stages['ctl'] as stage:
+        gradsctl.writeCtlIdx(newfilefpath, written)
+        stage.fields += len(written)
+        stage.nbytes += nbytes
+    # end of with stages['ctl'] as stage:
+
+    return dict([(name, stages[name].report()) for name in _stages_])
+# end of def runBenchmark(workdir, inputs, stages):
+
+
+def checkNativeReader(workdir, fpath, stages):
+    """
+    It reads every level slice of the fieldsfile by iris and by the native
+    reader and compares their arrays (values & mask).
+    :return: (no of compared fields, list of the mismatched fields).
+    """
+    um2grb2._nativeReader_ = True
+    um2grb2._tmpDir_ = workdir
+    ffile = um2grb2.openFieldsFile(fpath)
+    if ffile is None:
+        raise ValueError("Not a fieldsfile %s" % fpath)
+    compared, mismatches = 0, []
+    try:
+        for cube in iris.load(fpath):
+            for levCube in cube.slices(['latitude', 'longitude']):
+                with stages['native_read'] as stage:
+                    native = um2grb2.getNativeLevelData(ffile, levCube)
+                    if native is None: continue
+                    stage.fields += 1
+                    stage.nbytes += native.nbytes
+                # end of with stages['native_read'] as stage:
+                with stages['iris_read'] as stage:
+                    data = levCube.data
+                    stage.fields += 1
+                    stage.nbytes += data.nbytes
+                # end of with stages['iris_read'] as stage:
+                compared += 1
+                if not (numpy.array_equal(numpy.ma.getmaskarray(native), numpy.ma.getmaskarray(data))
+                        and numpy.array_equal(numpy.ma.filled(native, 0), numpy.ma.filled(data, 0))):
+                    mismatches.append('%s %s %s' % (cube.attributes.get('STASH'),
+                                      levCube.coord('forecast_period').points, cube.name()))
+            # end of for levCube in cube.slices(['latitude', 'longitude']):
+        # end of for cube in iris.load(fpath):
+    finally:
+        ffile.close()
+        um2grb2._nativeReader_ = False
+    # end of try:
+    return compared, mismatches
+# end of def checkNativeReader(workdir, fpath, stages):
+
+
+def compareBaseline(results, baseline, tolerance):
+    """
+    It prints the stage timings against the baseline and returns the list of
+    stages which are slower than baseline by more than tolerance (fraction).
+    """
+    regressions = []
+    print "\n%-12s %10s %10s %8s" % ('stage', 'baseline', 'current', 'speedup')
+    for name in _stages_:
+        if name not in baseline or name not in results: continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        speedup = old / new if new else float('inf')
+        flag = ''
+        if new > old * (1 + tolerance):
+            regressions.append(name)
+            flag = ' <-- REGRESSION'
+        print "%-12s %10.3f %10.3f %7.2fx%s" % (name, old, new, speedup, flag)
+    # end of for name in _stages_:
+    return regressions
+# end of def compareBaseline(results, baseline, tolerance):
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage level benchmark of um2grb2')
+    parser.add_argument('--workdir', default='/tmp/um2grb2bench',
+                        help='directory for synthetic inputs & outputs')
+    parser.add_argument('--nlon', type=int, default=1536, help='source grid longitudes (N768)')
+    parser.add_argument('--nlat', type=int, default=1152, help='source grid latitudes (N768)')
+    parser.add_argument('--ntimes', type=int, default=4,
+                        help='no of time steps per input file (0 for all)')
+    parser.add_argument('--baseline', help='baseline json to compare against')
+    parser.add_argument('--save-baseline', help='save this run as baseline json')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slow down fraction w.r.t baseline')
+    parser.add_argument('--fieldsfile', help='sample real fieldsfile to verify & time '
+                        'the native reader against iris')
+    args = parser.parse_args()
+    if args.ntimes < 0 or args.ntimes == 1:
+        parser.error("--ntimes must be 0 (all) or at least 2 (6-hourly windows of the mean inputs)")
+
+    if not os.path.exists(args.workdir): os.makedirs(args.workdir)
+    inputs = generateInputs(args.workdir, args.nlon, args.nlat, args.ntimes)
+    stages = dict([(name, Stage(name)) for name in _stages_])
+    results = runBenchmark(args.workdir, inputs, stages)
+    mismatches = []
+    if args.fieldsfile:
+        compared, mismatches = checkNativeReader(args.workdir, args.fieldsfile, stages)
+        print "Native reader vs iris: %d fields compared, %d mismatched" % (compared, len(mismatches))
+        for mismatch in mismatches:
+            print "ALERT !!! native reader mismatch:", mismatch
+        results.update([(name, stages[name].report()) for name in ('iris_read', 'native_read')])
+    # end of if args.fieldsfile:
+
+    print "\n%-12s %10s %8s %10s %10s %10s" % ('stage', 'seconds', 'fields', 'fields/s', 'MB/s', 'peakRSS MB')
+    for name in _stages_:
+        report = results[name]
+        print "%-12s %10.3f %8d %10.2f %10.2f %10.1f" % (name, report['seconds'], report['fields'],
+                                                       report['fields_per_sec'], report['mb_per_sec'],
+                                                       report['peak_rss_mb'])
+    # end of for name in _stages_:
+
+    results = {'grid': [args.nlat, args.nlon], 'ntimes': args.ntimes, 'stages': results}
+    if args.fieldsfile:
+        # record of the check, which justifies enabling the native reader
+        stat = os.stat(args.fieldsfile)
+        results['native_check'] = {'fieldsfile': os.path.abspath(args.fieldsfile),
+                                   'size': stat.st_size, 'mtime': int(stat.st_mtime),
+                                   'compared': compared, 'mismatches': mismatches,
+                                   'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    # end of if args.fieldsfile:
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fobj:
+            json.dump(results, fobj, indent=2, sort_keys=True)
+        print "Saved baseline into", args.save_baseline
+    # end of if args.save_baseline:
+
+    if args.baseline:
+        with open(args.baseline) as fobj:
+            baseline = json.load(fobj)
+        if baseline.get('grid') != results['grid'] or baseline.get('ntimes') != results['ntimes']:
+            print "ALERT !!! baseline was taken with different grid/ntimes, comparison is not fair"
+        regressions = compareBaseline(results['stages'], baseline['stages'], args.tolerance)
+        if regressions:
+            print "Regressed stages:", ', '.join(regressions)
+            sys.exit(1)
+    # end of if args.baseline:
+    if mismatches: sys.exit(1)
+# end of def main():
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+This module is the cross-cycle cache of the regridded fields of um2grb2.
+
+The analysis of 06/12/18Z (and 00Z) reads the umglca_pf file of the previous
+cycle short forecast and averages & regrids its 6 hourly means, again on
+every rerun of that cycle. So the regridded (and time averaged) level slices
+of those fields are kept on disk, as one entry per (field, output domain),
+keyed by the content of its input, i.e. input path + size + mtime, STASH,
+forecast hour (or window), time processing, regridding method and target
+grid. The reruns reuse those instead of reading, averaging and regridding
+again.
+
+Every entry is a directory of one float32 .npy file per level (masked points
+as nan), which is written level by level while the field is regridded (see
+FieldWriter) and renamed into place once complete, so that the parallel
+workers may share the cache directory. The entries are read back as read-only
+memory maps, i.e. only the level which is being encoded is paged in.
+
+The cache is bounded by its size in bytes, beyond which the least recently
+used entries (by mtime, which is touched on every hit) are evicted. The
+directory is rescanned only when the size estimate of this process (size of
+the last scan plus the bytes written since then) is beyond the bound or
+every _evictEvery_ writes (to see the writes of the other workers).
+"""
+
+import os, time, shutil, hashlib, tempfile
+import numpy
+
+# max no of writes between the rescans of the cache directory
+_evictEvery_ = 32
+# age (seconds) of the incomplete entries (of killed workers) to be removed
+_staleAge_ = 24 * 3600
+
+
+def makeKey(*parts):
+    """
+    It returns the hex digest key of the parts (numpy arrays are hashed by
+    their values).
+    """
+    md5 = hashlib.md5()
+    for part in parts:
+        if isinstance(part, numpy.ndarray):
+            md5.update(numpy.ascontiguousarray(part).tostring())
+        else:
+            md5.update(repr(part))
+        md5.update('|')
+    # end of for part in parts:
+    return md5.hexdigest()
+# end of def makeKey(*parts):
+
+
+def _levelName(li):
+    return 'level.%04d.npy' % li
+# end of def _levelName(li):
+
+
+def getLevel(levels, li):
+    """
+    It returns the 2-D level li of the cached entry (masked, if it has nan).
+    :param levels: list of the level memory maps (see FieldCache.get).
+    """
+    level = levels[li]
+    if numpy.isnan(level).any(): level = numpy.ma.masked_invalid(level)
+    return level
+# end of def getLevel(levels, li):
+
+
+class FieldWriter(object):
+    """
+    Incremental writer of one cache entry. The levels are written into a
+    temporary directory, which is renamed into the cache by commit().
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmpDir = tempfile.mkdtemp(dir=cache.cacheDir, suffix='.tmp')
+        self.nlevels = 0
+        self.nbytes = 0
+
+    def append(self, level):
+        """
+        It writes the next regridded 2-D level (as float32, masked points as
+        nan).
+        """
+        level = numpy.ma.filled(numpy.ma.asarray(level, dtype=numpy.float32), numpy.nan)
+        numpy.save(os.path.join(self.tmpDir, _levelName(self.nlevels)), level)
+        self.nlevels += 1
+        self.nbytes += level.nbytes
+
+    def commit(self):
+        """
+        It moves the complete entry into the cache.
+        """
+        if not self.nlevels: return self.abort()
+        try:
+            os.rename(self.tmpDir, self.cache._path(self.key))
+        except OSError:
+            # already cached by other worker
+            return self.abort()
+        # end of try:
+        self.cache._written(self.nbytes)
+
+    def abort(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+# end of class FieldWriter(object):
+
+
+class FieldCache(object):
+    """
+    On disk LRU cache of the regridded fields.
+    :param cacheDir: cache directory.
+    :param maxBytes: max size of the cache in bytes.
+    """
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                # created by other worker
+                if not os.path.isdir(cacheDir): raise
+        # end of if not os.path.isdir(cacheDir):
+        # size estimate and no of writes since the last scan
+        self.size = None
+        self.writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def has(self, key):
+        return os.path.isdir(self._path(key))
+
+    def get(self, key):
+        """
+        It returns the list of the read-only memory maps of the levels of the
+        key (no data is read yet, see getLevel) or None if it is not cached.
+        The memory maps stay valid, even if the entry is evicted later.
+        """
+        path = self._path(key)
+        try:
+            names = sorted([name for name in os.listdir(path) if name.endswith('.npy')])
+            levels = [numpy.load(os.path.join(path, name), mmap_mode='r') for name in names]
+            # most recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        # end of try:
+        return levels or None
+
+    def writer(self, key):
+        """
+        It returns the FieldWriter of the key.
+        """
+        return FieldWriter(self, key)
+
+    def _written(self, nbytes):
+        # evict only if the estimate is beyond the max size (or periodically)
+        self.writes += 1
+        if self.size is not None: self.size += nbytes
+        if self.size is None or self.size > self.maxBytes or self.writes >= _evictEvery_:
+            self.evict()
+
+    def _scan(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, name)
+            try:
+                mtime = os.stat(path).st_mtime
+                if name.endswith('.tmp'):
+                    # incomplete entry of the killed worker
+                    if now - mtime > _staleAge_: shutil.rmtree(path, ignore_errors=True)
+                    continue
+                # end of if name.endswith('.tmp'):
+                size = sum([os.path.getsize(os.path.join(path, level)) for level in os.listdir(path)])
+            except OSError:
+                # evicted by other worker
+                continue
+            # end of try:
+            entries.append((mtime, size, name))
+        # end of for name in os.listdir(self.cacheDir):
+        return entries
+
+    def evict(self):
+        """
+        It removes the least recently used entries until the cache is within
+        its max size.
+        """
+        entries = self._scan()
+        total = sum([size for mtime, size, name in entries])
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes: break
+            shutil.rmtree(os.path.join(self.cacheDir, name), ignore_errors=True)
+            total -= size
+        # end of for mtime, size, name in sorted(entries):
+        self.size = total
+        self.writes = 0
+# end of class FieldCache(object):
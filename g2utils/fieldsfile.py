@@ -0,0 +1,306 @@
+"""
+This module has the low level helpers of UM fieldsfile (UMDP F3 format).
+
+The fieldsfile starts with the fixed length header of 256 words (64-bit
+integers, big endian as written by the UM), which has the addresses and
+the dimensions of the other components, say lookup table (64 words per
+field) and data. Every lookup entry has the start address (LBEGIN) and the
+length on disk (LBNREC) of its field data.
+
+FieldsFile is the native memory mapped reader. Its lookup table is parsed
+into a compact numpy structured array (the lookup index), which is cached as
+a sidecar (sharedstore array, keyed by the file path, size & mtime), so the
+repeated opens of the same file (say the previous cycle umglca files of the
+06/12/18Z analysis) don't parse it again. The data of a record is served on
+demand, straight from the memory map (no intermediate read buffer) for the
+unpacked 32/64-bit records and by WGDOS unpacking (mo_pack or iris
+pp_packing, if available) for the packed records. Only the records which
+are decoded alike by iris are served, i.e. the records with extra data,
+other packings (say land/sea compressed), scaled data (BMKS) or non-real
+data are refused (ValueError), so that the caller falls back to iris.
+
+um2grb2 uses it only as an opt-in data path: the cubes (metadata) of the
+fields are still built by iris.load, which parses the lookup table itself,
+so the sidecar spares only the lookup parse of this reader. On the little
+endian nodes the big endian records are converted (copied) once into the
+native byte order.
+"""
+
+import os, mmap, hashlib
+import numpy
+import sharedstore
+
+# no of words of the fixed length header
+_fixedHeaderLen_ = 256
+# UM integer missing data indicator
+_imdi_ = -32768
+# fixed length header positions (0 based) of the lookup & data components
+_lookupStart_, _lookupDim1_, _lookupDim2_ = 149, 150, 151
+_dataStart_, _dataDim1_ = 159, 160
+# lookup entry positions (0 based) of the field data length on disk & start
+_lbnrec_, _lbegin_ = 29, 28
+# lookup entry positions (0 based) of the no of rows & columns of the field
+_lbrow_, _lbnpt_ = 17, 18
+# lookup entry positions (0 based) of the forecast period, data length,
+# extra data length, packing, level, data type and STASH code
+_lbft_, _lblrec_, _lbext_, _lbpack_, _lbproc_ = 13, 14, 19, 20, 24
+_lblev_, _lbuser1_, _lbuser4_ = 32, 38, 41
+# lookup entry positions (0 based) of the first real word, level value,
+# missing data indicator and scaling factor (real words)
+_realStart_, _blev_, _bmdi_, _bmks_ = 45, 51, 62, 63
+# version of the lookup index (part of the sidecar name, so that the sidecars
+# of the older index layout are not used)
+_indexVersion_ = 2
+# lookup index (one record per used lookup entry) of FieldsFile
+_indexDtype_ = numpy.dtype([('position', 'i4'), ('stash', 'i4'), ('lbft', 'i4'),
+                            ('lbproc', 'i4'), ('lblev', 'i4'), ('blev', 'f8'),
+                            ('lbrow', 'i4'), ('lbnpt', 'i4'), ('lbpack', 'i4'),
+                            ('lbuser1', 'i4'), ('lbext', 'i4'), ('lbegin', 'i8'),
+                            ('lblrec', 'i8'), ('bmdi', 'f8'), ('bmks', 'f8')])
+
+
+def readFixedHeader(fpath):
+    """
+    It reads the fixed length header of the fieldsfile.
+    :param fpath: fieldsfile path.
+    :return: (fixed length header as int64 numpy array, numpy byte order
+             string '>' or '<') or (None, None) if it is not a fieldsfile.
+    """
+    with open(fpath, 'rb') as fobj:
+        raw = fobj.read(_fixedHeaderLen_ * 8)
+    # end of with open(fpath, 'rb') as fobj:
+    if len(raw) < _fixedHeaderLen_ * 8:
+        return None, None
+    for byteorder in ('>', '<'):
+        header = numpy.frombuffer(raw, dtype=byteorder + 'i8')
+        # every field has 64 words of lookup entry
+        if header[_lookupDim1_] == 64:
+            return header, byteorder
+    # end of for byteorder in ('>', '<'):
+    return None, None
+# end of def readFixedHeader(fpath):
+
+
+def readLookup(fpath, header, byteorder):
+    """
+    It reads the lookup table of the fieldsfile.
+    :return: (no of lookup entries, 64) shaped int64 numpy array.
+    """
+    start = int(header[_lookupStart_]) - 1
+    nlookup = int(header[_lookupDim2_])
+    with open(fpath, 'rb') as fobj:
+        fobj.seek(start * 8)
+        raw = fobj.read(nlookup * 64 * 8)
+    # end of with open(fpath, 'rb') as fobj:
+    nlookup = len(raw) // (64 * 8)
+    return numpy.frombuffer(raw[:nlookup * 64 * 8],
+                            dtype=byteorder + 'i8').reshape((nlookup, 64))
+# end of def readLookup(fpath, header, byteorder):
+
+
+def isCompleteFieldsFile(fpath):
+    """
+    It checks whether the fieldsfile is completely written or not, i.e.
+    the fixed length header is valid, the lookup table & data components
+    are within the file and the data of every used lookup entry is within
+    the file.
+    :param fpath: fieldsfile path.
+    :return: True or False
+    """
+    try:
+        size = os.path.getsize(fpath)
+        header, byteorder = readFixedHeader(fpath)
+        if header is None:
+            return False
+        lookupStart, nlookup = header[_lookupStart_], header[_lookupDim2_]
+        dataStart, dataLen = header[_dataStart_], header[_dataDim1_]
+        if _imdi_ in (lookupStart, nlookup, dataStart, dataLen):
+            # data length is updated only while closing the file
+            return False
+        if min(lookupStart, nlookup, dataStart, dataLen) <= 0:
+            return False
+        if (lookupStart - 1 + 64 * nlookup) * 8 > size:
+            return False
+        if (dataStart - 1 + dataLen) * 8 > size:
+            return False
+        lookup = readLookup(fpath, header, byteorder)
+        # unused lookup entries are filled with -99
+        used = lookup[lookup[:, 0] != -99]
+        if not len(used):
+            return False
+        if ((used[:, _lbegin_] + used[:, _lbnrec_]) * 8 > size).any():
+            return False
+    except (IOError, OSError, ValueError):
+        return False
+    # end of try:
+    return True
+# end of def isCompleteFieldsFile(fpath):
+
+
+def getMaxFieldSize(fpath):
+    """
+    It returns the no of grid points (rows x columns) of the largest field
+    of the fieldsfile, without reading any data.
+    :param fpath: fieldsfile path.
+    :return: integer or None if it is not a fieldsfile.
+    """
+    try:
+        header, byteorder = readFixedHeader(fpath)
+        if header is None:
+            return None
+        lookup = readLookup(fpath, header, byteorder)
+    except (IOError, OSError, ValueError):
+        return None
+    # end of try:
+    used = lookup[lookup[:, 0] != -99]
+    if not len(used):
+        return None
+    return int((used[:, _lbrow_] * used[:, _lbnpt_]).max())
+# end of def getMaxFieldSize(fpath):
+
+
+def makeLookupIndex(lookup, byteorder):
+    """
+    It parses the lookup table into the lookup index (structured array of
+    _indexDtype_) of the used lookup entries.
+    :param lookup: lookup table as returned by readLookup.
+    :param byteorder: numpy byte order string of the file.
+    """
+    position = numpy.where(lookup[:, 0] != -99)[0]
+    used = lookup[position]
+    reals = numpy.ascontiguousarray(used[:, _realStart_:]).view(byteorder + 'f8')
+    index = numpy.zeros(len(used), dtype=_indexDtype_)
+    index['position'] = position
+    for name, word in [('stash', _lbuser4_), ('lbft', _lbft_), ('lbproc', _lbproc_),
+                       ('lblev', _lblev_), ('lbrow', _lbrow_), ('lbnpt', _lbnpt_),
+                       ('lbpack', _lbpack_), ('lbuser1', _lbuser1_), ('lbext', _lbext_),
+                       ('lbegin', _lbegin_), ('lblrec', _lblrec_)]:
+        index[name] = used[:, word]
+    # end of for name, word in [...]:
+    index['blev'] = reals[:, _blev_ - _realStart_]
+    index['bmdi'] = reals[:, _bmdi_ - _realStart_]
+    index['bmks'] = reals[:, _bmks_ - _realStart_]
+    return index
+# end of def makeLookupIndex(lookup, byteorder):
+
+
+def getLookupIndex(fpath, header, byteorder, cacheDir=None):
+    """
+    It returns the lookup index of the fieldsfile from the sidecar cache
+    (cacheDir) or else it parses the lookup table and caches it.
+    :param fpath: fieldsfile path.
+    :param header: fixed length header (see readFixedHeader).
+    :param byteorder: numpy byte order string of the file.
+    :param cacheDir: sidecar cache directory (None means no cache).
+    :return: lookup index (read-only memory map, if cached).
+    """
+    if cacheDir is None:
+        return makeLookupIndex(readLookup(fpath, header, byteorder), byteorder)
+    # the sidecar is valid only for the same file path, size & mtime
+    stat = os.stat(fpath)
+    key = hashlib.md5(os.path.abspath(fpath)).hexdigest()[:12]
+    name = '%s.%s.%d.%d.lookup%d' % (os.path.basename(fpath), key, stat.st_size,
+                                     int(stat.st_mtime), _indexVersion_)
+    if sharedstore.hasArray(cacheDir, name):
+        try:
+            return sharedstore.getArray(cacheDir, name)
+        except (IOError, ValueError):
+            # broken sidecar, so lets parse it again
+            pass
+    # end of if sharedstore.hasArray(cacheDir, name):
+    index = makeLookupIndex(readLookup(fpath, header, byteorder), byteorder)
+    return sharedstore.putArray(cacheDir, name, index)
+# end of def getLookupIndex(fpath, header, byteorder, cacheDir=None):
+
+
+def _getWgdosUnpack():
+    # WGDOS unpacking function(data, rows, columns, mdi) if available
+    try:
+        import mo_pack
+        return mo_pack.decompress_wgdos
+    except ImportError:
+        pass
+    try:
+        from iris.fileformats.pp_packing import wgdos_unpack
+        return wgdos_unpack
+    except ImportError:
+        return None
+# end of def _getWgdosUnpack():
+
+
+class FieldsFile(object):
+    """
+    Memory mapped reader of the fieldsfile (see the module doc).
+    :param fpath: fieldsfile path.
+    :param cacheDir: sidecar cache directory of the lookup index (None means
+                     no cache).
+    """
+    def __init__(self, fpath, cacheDir=None):
+        self.fpath = fpath
+        header, self.byteorder = readFixedHeader(fpath)
+        if header is None:
+            raise ValueError("Not a fieldsfile %s" % fpath)
+        self.index = getLookupIndex(fpath, header, self.byteorder, cacheDir)
+        with open(fpath, 'rb') as fobj:
+            self.mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        # end of with open(fpath, 'rb') as fobj:
+
+    def find(self, stash, lbft=None, lblev=None, blev=None, lbproc=None):
+        """
+        It returns the lookup index records which match the (STASH, time,
+        level) keys. The None keys are not matched.
+        :param stash: STASH code as integer (section * 1000 + item).
+        :param lbft: forecast period in hours.
+        :param lblev: level number (say model level).
+        :param blev: level value (say pressure in hPa).
+        :param lbproc: processing code (say 0 for instantaneous).
+        """
+        match = self.index['stash'] == stash
+        if lbft is not None: match &= self.index['lbft'] == lbft
+        if lblev is not None: match &= self.index['lblev'] == lblev
+        if blev is not None: match &= numpy.isclose(self.index['blev'], blev)
+        if lbproc is not None: match &= self.index['lbproc'] == lbproc
+        return self.index[match]
+
+    def getData(self, record):
+        """
+        It returns the data of the record (of the lookup index) as (rows,
+        columns) array. The unpacked 64-bit (lbpack 0) and 32-bit (lbpack 2)
+        records are the read-only views of the memory map in the byte order
+        of the file (so the big endian UM output still needs one conversion
+        to the native byte order, see um2grb2.getNativeLevelData) and the
+        missing data is bmdi (not masked).
+        :param record: record of the lookup index (see find).
+        :return: numpy array.
+        :raise ValueError: if the record is not decoded alike by iris, i.e.
+                 extra data (lbext), packing other than 0, 1 or 2, scaled
+                 data (bmks) or non-real data.
+        """
+        rows, cols = int(record['lbrow']), int(record['lbnpt'])
+        offset = int(record['lbegin']) * 8
+        pack = int(record['lbpack'])
+        if pack not in (0, 1, 2):
+            # land/sea compressed, other than regular grid or other packing
+            raise ValueError("Unsupported packing %d" % pack)
+        if int(record['lbext']):
+            raise ValueError("Unsupported extra data of %d words" % int(record['lbext']))
+        if int(record['lbuser1']) != 1:
+            raise ValueError("Unsupported data type %d" % int(record['lbuser1']))
+        if float(record['bmks']) not in (0.0, 1.0):
+            raise ValueError("Unsupported scaling factor %s" % float(record['bmks']))
+        if pack == 0:
+            data = numpy.frombuffer(self.mmap, self.byteorder + 'f8', rows * cols, offset)
+        elif pack == 2:
+            data = numpy.frombuffer(self.mmap, self.byteorder + 'f4', rows * cols, offset)
+        elif pack == 1:
+            unpack = _getWgdosUnpack()
+            if unpack is None:
+                raise ValueError("WGDOS unpacking (mo_pack) is not available")
+            raw = self.mmap[offset:offset + int(record['lblrec']) * 8]
+            data = unpack(raw, rows, cols, float(record['bmdi']))
+        # end of if pack == 0:
+        return data.reshape((rows, cols))
+
+    def close(self):
+        self.mmap.close()
+# end of class FieldsFile(object):
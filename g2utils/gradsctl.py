@@ -0,0 +1,286 @@
+"""
+This module generates GrADS ctl and idx files of the grib2 files natively,
+i.e. without g2ctl.pl and gribmap which re-read the entire grib2 file which
+we have just written.
+
+The message offsets and header keys are taken from the writer itself (as
+returned by grib2io.concatShards/copyMessages), so there is no second pass
+over the grib2 file. It can also emit one templated ctl (%f3 forecast hour
+template) with one idx file, which covers all the forecast files.
+
+The idx file is written in the GrADS grib2 index (version 1) layout, i.e.
+version number, number of integers and then (message offset, field number)
+integer pair for every (time, variable, level) record in ctl order. The
+missing records have -999 offset.
+"""
+
+import os, re, datetime
+import numpy
+
+# ctl level suffix of the variable names w.r.t typeOfFirstFixedSurface
+_levelSuffix_ = {1: 'sfc', 100: 'prs', 101: 'msl', 103: 'hag', 200: 'clm'}
+_levelDesc_ = {1: 'surface', 100: 'pressure level', 101: 'mean sea level',
+               103: 'm above ground', 200: 'entire atmosphere'}
+_undef_ = '9.999E+20'
+_idxversion_ = 1
+
+
+def _gradsTime(dtime):
+    """
+    It returns the GrADS time string (say 06Z09dec2015) of datetime.
+    """
+    months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+              'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    return '%02dZ%02d%s%04d' % (dtime.hour, dtime.day, months[dtime.month - 1], dtime.year)
+# end of def _gradsTime(dtime):
+
+
+def _recordTime(keys, useInitialTime=False):
+    """
+    It returns the datetime of the message, either validity time or initial
+    (reference) time.
+    """
+    if useInitialTime or keys.get('validityDate') is None:
+        date, hhmm = keys['dataDate'], keys['dataTime']
+    else:
+        date, hhmm = keys['validityDate'], keys['validityTime']
+    # end of if useInitialTime or ...:
+    return datetime.datetime.strptime('%08d%04d' % (int(date), int(hhmm)), '%Y%m%d%H%M')
+# end of def _recordTime(keys, useInitialTime=False):
+
+
+def _varKey(keys):
+    """
+    It returns the key of ctl variable to which this message belongs to.
+    Pressure levels of same parameter are grouped into one variable.
+    """
+    ltype = keys['typeOfFirstFixedSurface']
+    level = None if ltype == 100 else keys['level']
+    return (keys['discipline'], keys['parameterCategory'], keys['parameterNumber'],
+            ltype, level, keys.get('typeOfStatisticalProcessing'))
+# end of def _varKey(keys):
+
+
+def _varName(keys, names):
+    """
+    It returns the unique GrADS variable name (shortName + level suffix).
+    """
+    ltype = keys['typeOfFirstFixedSurface']
+    short = str(keys.get('shortName') or 'unknown')
+    if short == 'unknown':
+        short = 'var%d_%d_%d' % (keys['discipline'], keys['parameterCategory'],
+                                 keys['parameterNumber'])
+    short = re.sub('[^a-z0-9]', '', short.lower())
+    if not short or not short[0].isalpha(): short = 'v' + short
+    name = (short + _levelSuffix_.get(ltype, 'l%d' % ltype))[:13]
+    unique, count = name, 1
+    while unique in names:
+        count += 1
+        unique = name + str(count)
+    # end of while unique in names:
+    return unique
+# end of def _varName(keys, names):
+
+
+def _collectVars(recordsList):
+    """
+    It collects the ctl variables (in the order of their first message) and
+    the pressure levels (zdef) from the records of one or more grib2 files.
+    :param recordsList: list of records list. Each record is (offset, length,
+                        keys) tuple.
+    :return: ctlVars: list of dictionary (key, name, keys, levels)
+    :return: zlevels: pressure levels in hPa (from surface to top)
+    """
+    varsDic, ctlVars = {}, []
+    zlevels = set()
+    names = set()
+    for records in recordsList:
+        for offset, length, keys in records:
+            vkey = _varKey(keys)
+            if vkey not in varsDic:
+                name = _varName(keys, names)
+                names.add(name)
+                varsDic[vkey] = {'key': vkey, 'name': name, 'keys': keys, 'levels': []}
+                ctlVars.append(varsDic[vkey])
+            # end of if vkey not in varsDic:
+            if keys['typeOfFirstFixedSurface'] == 100:
+                # pressure in Pa to hPa
+                plev = round(keys['level'] / 100.0, 4)
+                zlevels.add(plev)
+                if plev not in varsDic[vkey]['levels']:
+                    varsDic[vkey]['levels'].append(plev)
+            # end of if keys['typeOfFirstFixedSurface'] == 100:
+        # end of for offset, length, keys in records:
+    # end of for records in recordsList:
+    zlevels = sorted(zlevels, reverse=True)
+    for var in ctlVars:
+        # GrADS maps the n-th level of variable to the n-th zdef level, so
+        # pressure variables take all the zdef levels (missing are undefined)
+        if var['levels']: var['levels'] = list(zlevels)
+    return ctlVars, zlevels
+# end of def _collectVars(recordsList):
+
+
+def _ctlHeader(keys):
+    """
+    It returns the xdef, ydef lines (and options) from the grid keys.
+    """
+    ni, nj = int(keys['Ni']), int(keys['Nj'])
+    lon0 = float(keys['longitudeOfFirstGridPointInDegrees'])
+    lon1 = float(keys['longitudeOfLastGridPointInDegrees'])
+    lat0 = float(keys['latitudeOfFirstGridPointInDegrees'])
+    lat1 = float(keys['latitudeOfLastGridPointInDegrees'])
+    if lon1 < lon0: lon1 += 360.0
+    dlon = (lon1 - lon0) / (ni - 1) if ni > 1 else 1.0
+    dlat = abs(lat1 - lat0) / (nj - 1) if nj > 1 else 1.0
+    options = []
+    if lat0 > lat1:
+        # north to south scanning
+        options.append('yrev')
+    lines = ['ydef %d linear %f %f' % (nj, min(lat0, lat1), dlat),
+             'xdef %d linear %f %f' % (ni, lon0, dlon)]
+    return lines, options
+# end of def _ctlHeader(keys):
+
+
+def _varLine(var):
+    """
+    It returns the GrADS grib2 variable definition line.
+    """
+    disc, cat, num, ltype, level, statproc = var['key']
+    keys = var['keys']
+    if ltype == 100:
+        levs = '%d,%d' % (len(var['levels']), ltype)
+        desc = '(%s)' % ' '.join(['%g' % lev for lev in var['levels']])
+    elif level is None:
+        levs = '0,%d' % ltype
+        desc = _levelDesc_.get(ltype, 'level type %d' % ltype)
+    else:
+        levs = '0,%d,%g' % (ltype, level)
+        desc = '%g %s' % (level, _levelDesc_.get(ltype, 'level type %d' % ltype))
+    # end of if ltype == 100:
+    codes = '%d,%d,%d' % (disc, cat, num)
+    if statproc is not None:
+        codes += ',%d' % statproc
+    return '%s %s %s ** %s %s [%s]' % (var['name'], levs, codes, desc,
+                                       keys.get('name') or '', keys.get('units') or '')
+# end of def _varLine(var):
+
+
+def _writeCtl(ctlPath, dset, idxPath, title, ctlVars, zlevels, gridKeys,
+              tdef, template=False):
+    """
+    It writes the ctl file.
+    """
+    xydef, options = _ctlHeader(gridKeys)
+    if template: options.insert(0, 'template')
+    lines = ['dset ^%s' % dset,
+             'index ^%s' % os.path.basename(idxPath),
+             'undef %s' % _undef_,
+             'title %s' % title,
+             '* produced by um2grb2 natively (g2utils/gradsctl.py)',
+             'dtype grib2']
+    if options: lines.append('options %s' % ' '.join(options))
+    lines.extend(xydef)
+    lines.append(tdef)
+    if zlevels:
+        lines.append('zdef %d levels %s' % (len(zlevels), ' '.join(['%g' % z for z in zlevels])))
+    else:
+        lines.append('zdef 1 linear 1 1')
+    lines.append('vars %d' % len(ctlVars))
+    lines.extend([_varLine(var) for var in ctlVars])
+    lines.append('endvars')
+    with open(ctlPath, 'w') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+# end of def _writeCtl(...):
+
+
+def _writeIdx(idxPath, ntimes, ctlVars, zlevels, recordsByTime):
+    """
+    It writes the GrADS grib2 index file.
+    :param ntimes: no of times in tdef.
+    :param recordsByTime: dictionary of time index and its records.
+    """
+    recoff, trecs = {}, 0
+    for var in ctlVars:
+        recoff[var['key']] = trecs
+        trecs += max(1, len(var['levels']))
+    # end of for var in ctlVars:
+    varsDic = dict([(var['key'], var) for var in ctlVars])
+
+    table = numpy.empty((ntimes * trecs, 2), dtype=numpy.int32)
+    table[:, 0] = -999
+    table[:, 1] = 0
+    for ti, records in recordsByTime.iteritems():
+        for offset, length, keys in records:
+            vkey = _varKey(keys)
+            ioff = ti * trecs + recoff[vkey]
+            if keys['typeOfFirstFixedSurface'] == 100:
+                # position of level within the variable levels (same as zdef)
+                plev = round(keys['level'] / 100.0, 4)
+                ioff += varsDic[vkey]['levels'].index(plev)
+            # end of if keys['typeOfFirstFixedSurface'] == 100:
+            # one field per message
+            table[ioff] = (offset, 1)
+        # end of for offset, length, keys in records:
+    # end of for ti, records in recordsByTime.iteritems():
+
+    with open(idxPath, 'wb') as fobj:
+        numpy.array([_idxversion_, table.size], dtype=numpy.int32).tofile(fobj)
+        table.tofile(fobj)
+    # end of with open(idxPath, 'wb') as fobj:
+# end of def _writeIdx(...):
+
+
+def writeCtlIdx(gribPath, records, useInitialTime=False):
+    """
+    It writes GrADS ctl (gribPath.ctl) and idx (gribPath.idx) files of the
+    single grib2 file.
+    :param gribPath: grib2 file path.
+    :param records: list of (offset, length, keys) of all the messages of
+                    gribPath (as returned by the writer).
+    :param useInitialTime: if True, then initial (reference) time is used as
+                           tdef (like g2ctl -0), otherwise validity time.
+    :return: ctl file path.
+    """
+    if not records:
+        raise ValueError("No grib2 messages to create ctl file of %s" % gribPath)
+    ctlPath, idxPath = gribPath + '.ctl', gribPath + '.idx'
+    ctlVars, zlevels = _collectVars([records])
+    dtime = _recordTime(records[0][-1], useInitialTime)
+    tdef = 'tdef 1 linear %s 1mo' % _gradsTime(dtime)
+    _writeCtl(ctlPath, os.path.basename(gribPath), idxPath, os.path.basename(gribPath),
+              ctlVars, zlevels, records[0][-1], tdef)
+    _writeIdx(idxPath, 1, ctlVars, zlevels, {0: records})
+    return ctlPath
+# end of def writeCtlIdx(gribPath, records, useInitialTime=False):
+
+
+def writeTemplateCtlIdx(ctlPath, dsetTemplate, filesRecords, initTime, interval=6):
+    """
+    It writes one templated GrADS ctl file (with %f3 forecast hour template)
+    and one idx file, which covers all the forecast grib2 files.
+    :param ctlPath: ctl file path. idx path will be ctlPath with .idx extension.
+    :param dsetTemplate: dset template (say um_prg_%f3hr_20151209.grib2)
+    :param filesRecords: dictionary of forecast hour (integer) and the list
+                         of (offset, length, keys) records of that file.
+    :param initTime: initial time (datetime) of the forecast.
+    :param interval: forecast files interval in hours.
+    :return: ctl file path.
+    """
+    filesRecords = dict([(fhr, recs) for fhr, recs in filesRecords.iteritems() if recs])
+    if not filesRecords:
+        raise ValueError("No grib2 messages to create template ctl file %s" % ctlPath)
+    fhrs = sorted(filesRecords)
+    idxPath = os.path.splitext(ctlPath)[0] + '.idx'
+    ctlVars, zlevels = _collectVars([filesRecords[fhr] for fhr in fhrs])
+    # %f3 is forecast hour w.r.t the first time of tdef, so tdef starts from
+    # the initial time and the missing files (say 000hr) are just undefined.
+    ntimes = fhrs[-1] // interval + 1
+    tdef = 'tdef %d linear %s %dhr' % (ntimes, _gradsTime(initTime), interval)
+    _writeCtl(ctlPath, dsetTemplate, idxPath, os.path.basename(ctlPath),
+              ctlVars, zlevels, filesRecords[fhrs[0]][0][-1], tdef, template=True)
+    _writeIdx(idxPath, ntimes, ctlVars, zlevels,
+              dict([(fhr // interval, filesRecords[fhr]) for fhr in fhrs]))
+    return ctlPath
+# end of def writeTemplateCtlIdx(...):
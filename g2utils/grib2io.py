@@ -0,0 +1,339 @@
+"""
+This module has the low level GRIB2 message I/O helpers of um2grb2.
+
+It encodes the Iris cubes into GRIB2 message bytes (without writing into the
+output file) and writes those messages either into the shared output file or
+into the per-worker shard files. Each shard file has its own sidecar index
+(json lines), which records the variable order rank and the offset & length
+of every message. The shards of an output file are concatenated in the
+order of rank at the end, without decoding any message.
+
+The data values of every message can be re-packed by the packing policy of
+its variable (packing type & bits per value), while encoding itself.
+
+It also re-orders the messages of an existing grib2 file at byte level, by
+scanning only the message boundaries and section-4 keys (without unpacking
+any data values) and copying the raw message bytes in the required order.
+"""
+
+import os, glob, json, mmap
+import gribapi
+import iris.fileformats.grib as irisgrib
+import mplogging
+
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('grib2io')
+
+# sidecar index extension of shard files
+_idxext_ = '.json'
+
+# section-4 keys of every message which we keep with the message bytes
+_messageKeys_ = ['discipline', 'parameterCategory', 'parameterNumber',
+                 'typeOfFirstFixedSurface']
+# fallback packing type, if the packing type is not available in this
+# gribapi build (say grid_ccsds needs libaec, grid_jpeg needs openjpeg) or
+# not applicable for the field (say second order packing of constant field)
+_packingFallbacks_ = {'grid_ccsds': 'grid_complex_spatial_differencing',
+                      'grid_jpeg': 'grid_complex_spatial_differencing',
+                      'grid_second_order': 'grid_complex_spatial_differencing',
+                      'grid_complex_spatial_differencing': 'grid_simple',
+                      'grid_complex': 'grid_simple'}
+# other header keys which are needed to generate GrADS ctl/idx files (these
+# are optional, i.e. it will be None if the key is not available)
+_ctlKeys_ = ['typeOfStatisticalProcessing', 'dataDate', 'dataTime',
+             'validityDate', 'validityTime', 'shortName', 'name', 'units',
+             'Ni', 'Nj', 'jScansPositively',
+             'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+             'latitudeOfLastGridPointInDegrees', 'longitudeOfLastGridPointInDegrees']
+
+
+def getMessageKeys(gribid):
+    """
+    It returns the basic section-4 keys of the grib message as dictionary,
+    which identifies the variable & its level.
+    :param gribid: gribapi message id.
+    :return: dictionary of _messageKeys_, _ctlKeys_ and 'level' (None for surface).
+    """
+    keys = {}
+    for key in _messageKeys_:
+        keys[key] = gribapi.grib_get_long(gribid, key)
+    # end of for key in _messageKeys_:
+    for key in _ctlKeys_:
+        try:
+            keys[key] = gribapi.grib_get(gribid, key)
+        except gribapi.GribInternalError:
+            # key is not available in this message (product) template
+            keys[key] = None
+    # end of for key in _ctlKeys_:
+    if gribapi.grib_is_missing(gribid, 'scaledValueOfFirstFixedSurface'):
+        keys['level'] = None
+    else:
+        value = gribapi.grib_get_long(gribid, 'scaledValueOfFirstFixedSurface')
+        factor = gribapi.grib_get_long(gribid, 'scaleFactorOfFirstFixedSurface')
+        keys['level'] = value * 10.0 ** -factor
+    # end of if gribapi.grib_is_missing(...):
+    return keys
+# end of def getMessageKeys(gribid):
+
+
+def setPacking(gribid, packing):
+    """
+    It re-packs the data values of the message as per the packing policy.
+    If the packing type is not available, then it falls back to the next
+    one as per _packingFallbacks_ (ends with grid_simple).
+    :param gribid: gribapi message handle.
+    :param packing: dictionary of 'packingType' (say grid_simple, grid_complex,
+                    grid_complex_spatial_differencing, grid_second_order,
+                    grid_ccsds, grid_jpeg) and/or 'bitsPerValue'.
+    :return: the packing type which is applied.
+    """
+    values = gribapi.grib_get_double_array(gribid, 'values')
+    packingType = packing.get('packingType')
+    while True:
+        try:
+            if packingType:
+                gribapi.grib_set_string(gribid, 'packingType', packingType)
+            if packing.get('bitsPerValue'):
+                gribapi.grib_set_long(gribid, 'bitsPerValue', int(packing['bitsPerValue']))
+            # set the values again, so that those are packed as per above
+            gribapi.grib_set_double_array(gribid, 'values', values)
+            return packingType
+        except gribapi.GribInternalError:
+            if packingType not in _packingFallbacks_: raise
+            packingType = _packingFallbacks_[packingType]
+        # end of try:
+    # end of while True:
+# end of def setPacking(gribid, packing):
+
+
+def encodeCube(cube, centre=28, subCentre=0, packing=None):
+    """
+    It encodes the cube into GRIB2 messages in memory (same as iris.save
+    does, but without writing). The location section is edited to point to
+    the right RMC.
+    :param cube: Iris cube to be encoded.
+    :param centre: originating centre (28 is RMC of India)
+    :param subCentre: originating sub centre (exeter is not in the spec)
+    :param packing: (optional) packing policy (see setPacking). If it is None,
+                    then the default packing of iris/gribapi is kept.
+    :return: list of (message bytes, message keys dictionary) tuples.
+    """
+    messages = []
+    for gribid in irisgrib.as_messages(cube):
+        try:
+            gribapi.grib_set_long(gribid, "centre", centre)
+            gribapi.grib_set_long(gribid, "subCentre", subCentre)
+            if packing: setPacking(gribid, packing)
+            messages.append((gribapi.grib_get_message(gribid), getMessageKeys(gribid)))
+        finally:
+            gribapi.grib_release(gribid)
+    # end of for gribid in irisgrib.as_messages(cube):
+    return messages
+# end of def encodeCube(cube, centre=28, subCentre=0, packing=None):
+
+
+def appendMessages(fpath, messages):
+    """
+    It appends the encoded messages into fpath. Caller has to lock the file,
+    if the same file is shared with other processes.
+    :param fpath: grib2 file path.
+    :param messages: list of (message bytes, keys) tuples.
+    :return: list of (offset, length) of the written messages.
+    """
+    positions = []
+    with open(fpath, 'ab') as fobj:
+        # in append mode, the position is not at the end until the write.
+        fobj.seek(0, os.SEEK_END)
+        for msg, keys in messages:
+            positions.append((fobj.tell(), len(msg)))
+            fobj.write(msg)
+        # end of for msg, keys in messages:
+    # end of with open(fpath, 'ab') as fobj:
+    return positions
+# end of def appendMessages(fpath, messages):
+
+
+def appendShard(shardPath, messages, rank, name, stash):
+    """
+    It appends the encoded messages of one variable into the shard file
+    and records them into the sidecar index of the shard. The sidecar entry
+    is written only after the messages, so that a partially written
+    messages never get into the index.
+    :param shardPath: shard file path (only one worker writes into it).
+    :param messages: list of (message bytes, keys) tuples.
+    :param rank: variable order rank in the output file.
+    :param name: variable name.
+    :param stash: variable STASH code.
+    :return: list of (offset, length) of the written messages.
+    """
+    positions = appendMessages(shardPath, messages)
+    entry = {'rank': rank, 'name': name, 'STASH': str(stash),
+             'messages': [[offset, length, keys] for (offset, length), (msg, keys)
+                          in zip(positions, messages)]}
+    with open(shardPath + _idxext_, 'a') as fobj:
+        fobj.write(json.dumps(entry) + '\n')
+    # end of with open(shardPath + _idxext_, 'a') as fobj:
+    return positions
+# end of def appendShard(...):
+
+
+def getShards(shardDir, prefix):
+    """
+    It returns the sorted list of the shard files of the output file prefix.
+    """
+    return sorted(glob.glob(os.path.join(shardDir, prefix + '.*.shard.grib2')))
+# end of def getShards(shardDir, prefix):
+
+
+def readShardIndex(shardPath):
+    """
+    It returns the list of sidecar entries of the shard file.
+    """
+    entries = []
+    if not os.path.isfile(shardPath + _idxext_):
+        return entries
+    with open(shardPath + _idxext_) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if not line: continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # partially written last line
+                _log_.warning("ALERT !!! Skipping broken shard index line in %s", shardPath)
+        # end of for line in fobj:
+    # end of with open(shardPath + _idxext_) as fobj:
+    return entries
+# end of def readShardIndex(shardPath):
+
+
+def concatShards(shardPaths, outPath):
+    """
+    It concatenates the messages of all the shards into outPath in the
+    order of the variables rank (and in the order of shards & messages
+    within the same rank), without decoding any message.
+    :param shardPaths: list of shard file paths.
+    :param outPath: output grib2 file path (will be overwritten).
+    :return: list of (offset, length, keys) of the messages in outPath.
+    """
+    records = []
+    for si, shardPath in enumerate(shardPaths):
+        for ei, entry in enumerate(readShardIndex(shardPath)):
+            records.append(((entry['rank'], si, ei), shardPath, entry['messages']))
+        # end of for ei, entry in enumerate(readShardIndex(shardPath)):
+    # end of for si, shardPath in enumerate(shardPaths):
+    records.sort(key=lambda record: record[0])
+
+    written = []
+    shardFiles = {}
+    try:
+        with open(outPath, 'wb') as outobj:
+            for order, shardPath, messages in records:
+                if shardPath not in shardFiles:
+                    shardFiles[shardPath] = open(shardPath, 'rb')
+                shardobj = shardFiles[shardPath]
+                for offset, length, keys in messages:
+                    shardobj.seek(offset)
+                    written.append((outobj.tell(), length, keys))
+                    outobj.write(shardobj.read(length))
+                # end of for offset, length, keys in messages:
+            # end of for order, shardPath, messages in records:
+        # end of with open(outPath, 'wb') as outobj:
+    finally:
+        for shardobj in shardFiles.values():
+            shardobj.close()
+    # end of try:
+    return written
+# end of def concatShards(shardPaths, outPath):
+
+
+def truncateMessages(fpath, size):
+    """
+    It truncates the partially appended messages of the grib2 file (or
+    shard) after the size (last committed end offset). The sidecar index
+    entries of the shard beyond the size are also removed.
+    :param fpath: grib2 file or shard file path.
+    :param size: size in bytes to be kept.
+    """
+    with open(fpath, 'r+b') as fobj:
+        fobj.truncate(size)
+    # end of with open(fpath, 'r+b') as fobj:
+    if os.path.isfile(fpath + _idxext_):
+        entries = [entry for entry in readShardIndex(fpath)
+                   if all([offset + length <= size for offset, length, keys in entry['messages']])]
+        with open(fpath + _idxext_, 'w') as fobj:
+            for entry in entries:
+                fobj.write(json.dumps(entry) + '\n')
+        # end of with open(fpath + _idxext_, 'w') as fobj:
+    # end of if os.path.isfile(fpath + _idxext_):
+# end of def truncateMessages(fpath, size):
+
+
+def removeShards(shardPaths):
+    """
+    It removes the shard files along with its sidecar index files.
+    """
+    for shardPath in shardPaths:
+        for fpath in (shardPath, shardPath + _idxext_):
+            if os.path.isfile(fpath): os.remove(fpath)
+    # end of for shardPath in shardPaths:
+# end of def removeShards(shardPaths):
+
+
+def scanMessages(fpath):
+    """
+    It scans the message boundaries and section-4 keys of all the messages
+    of the grib2 file. The data values are never unpacked.
+    :param fpath: grib2 file path.
+    :return: list of (offset, length, keys) of the messages in fpath.
+    """
+    records = []
+    with open(fpath, 'rb') as fobj:
+        while True:
+            gribid = gribapi.grib_new_from_file(fobj)
+            if gribid is None: break
+            try:
+                offset = gribapi.grib_get_long(gribid, 'offset')
+                length = gribapi.grib_get_long(gribid, 'totalLength')
+                records.append((offset, length, getMessageKeys(gribid)))
+            finally:
+                gribapi.grib_release(gribid)
+        # end of while True:
+    # end of with open(fpath, 'rb') as fobj:
+    return records
+# end of def scanMessages(fpath):
+
+
+def copyMessages(srcPath, records, outPath):
+    """
+    It copies the raw bytes of the messages (records) of srcPath into
+    outPath in the order of records. Both files are memory mapped, so that
+    it is just a memory copy of the messages.
+    :param srcPath: source grib2 file path.
+    :param records: list of (offset, length, keys) of the messages in srcPath.
+    :param outPath: output grib2 file path (will be overwritten).
+    :return: list of (offset, length, keys) of the messages in outPath.
+    """
+    written = []
+    total = sum([length for offset, length, keys in records])
+    with open(srcPath, 'rb') as srcobj, open(outPath, 'w+b') as outobj:
+        if not total:
+            return written
+        outobj.truncate(total)
+        srcmap = mmap.mmap(srcobj.fileno(), 0, access=mmap.ACCESS_READ)
+        outmap = mmap.mmap(outobj.fileno(), total, access=mmap.ACCESS_WRITE)
+        try:
+            position = 0
+            for offset, length, keys in records:
+                outmap[position:position + length] = srcmap[offset:offset + length]
+                written.append((position, length, keys))
+                position += length
+            # end of for offset, length, keys in records:
+            outmap.flush()
+        finally:
+            outmap.close()
+            srcmap.close()
+        # end of try:
+    # end of with open(...):
+    return written
+# end of def copyMessages(srcPath, records, outPath):
@@ -0,0 +1,181 @@
+"""
+This module has the single writer process of the 'writer' output mode of
+um2grb2.
+
+The workers encode the regridded fields into GRIB2 message bytes in
+parallel and pass those bytes (through a bounded queue) to one writer
+process, which is the only process writing into the unordered outfiles.
+So there is no lock at all. The writer does only the appends and the index
+bookkeeping, i.e. it keeps the offset, length, section-4 keys and the
+variable order rank of every message it has written, and commits the unit
+into the task manifest once its messages are written.
+
+When all the conversion tasks of an outfile are done, its re-ordering task
+asks the writer to flush the outfile, which returns the index of the
+outfile, as soon as the writer has written all the messages of those tasks.
+Then the messages are copied in the order of the variables (without
+scanning the outfile again).
+
+The flush waits only for a bounded time and fails as soon as the writer
+process is dead, so that a conversion task whose 'done' never arrives (say
+its worker is killed) or a dead writer fails the re-ordering task instead of
+blocking it forever.
+"""
+
+import os, time, traceback, Queue
+import multiprocessing as mp
+import grib2io
+import mplogging
+
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('gribwriter')
+
+# seconds between the liveness checks of the writer while flushing
+_flushTick_ = 5.0
+
+
+def _isAlive(pid):
+    # True, if the process of pid is running (not exited nor zombie). It
+    # works from the forked workers also (unlike Process.is_alive).
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open('/proc/%d/stat' % pid) as fobj:
+            return fobj.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        # no procfs, so lets trust the kill
+        return True
+# end of def _isAlive(pid):
+
+
+def _existingRecords(fpath):
+    # messages of the outfile, which are written in the earlier run (resume)
+    if not os.path.isfile(fpath) or not os.path.getsize(fpath):
+        return []
+    return [(offset, length, keys, None) for offset, length, keys in grib2io.scanMessages(fpath)]
+# end of def _existingRecords(fpath):
+
+
+def _writerLoop(queue, replies, commit):
+    """
+    Loop of the writer process. The requests are
+     - ('append', fpath, rank, messages, unit) from the conversion tasks,
+     - ('done', taskName) once a conversion task is over,
+     - ('flush', fpath, deps) from the re-ordering task of fpath,
+     - None to stop.
+    The requests of a worker come in order (single feeder of the worker), but
+    the requests of different workers may not. So the flush of fpath is
+    replied only after the 'done' of all its deps tasks.
+    """
+    index = {}
+    done = set()
+    flushes = {}
+    while True:
+        request = queue.get()
+        if request is None: break
+        try:
+            if request[0] == 'append':
+                fpath, rank, messages, unit = request[1:]
+                if fpath not in index: index[fpath] = _existingRecords(fpath)
+                positions = grib2io.appendMessages(fpath, messages)
+                index[fpath].extend([(offset, length, keys, rank) for (offset, length), (msg, keys)
+                                     in zip(positions, messages)])
+                if commit is not None and unit is not None:
+                    # messages are written, so lets commit the unit
+                    commit(*(tuple(unit) + (fpath, fpath, positions, rank)))
+                # end of if commit is not None and ...:
+            elif request[0] == 'done':
+                done.add(request[1])
+            elif request[0] == 'flush':
+                flushes[request[1]] = set(request[2])
+            # end of if request[0] == 'append':
+        except Exception:
+            _log_.error("ALERT !!! Error in writer process!! %s", traceback.format_exc())
+        # end of try:
+
+        for fpath, deps in flushes.items():
+            if not deps.issubset(done): continue
+            del flushes[fpath]
+            try:
+                records = index.pop(fpath) if fpath in index else _existingRecords(fpath)
+            except Exception:
+                _log_.error("ALERT !!! Error while indexing %s in writer process!! %s", fpath,
+                            traceback.format_exc())
+                records = []
+            # end of try:
+            replies[fpath].put(records)
+        # end of for fpath, deps in flushes.items():
+    # end of while True:
+# end of def _writerLoop(queue, replies, commit):
+
+
+class GribWriter(object):
+    """
+    Single writer process of the outfiles. Create it before forking the
+    workers (i.e. before the scheduler runs), so that the workers inherit
+    the queues.
+    :param outFiles: list of unordered outfile paths.
+    :param commit: (optional) function commit(*unit, fpath, target,
+                   positions, rank), which is called in the writer process once
+                   the messages of the unit are written.
+    :param maxsize: max no of pending requests, beyond which the workers
+                    wait for the writer (to bound the memory of the queue).
+    :param flushTimeout: max seconds to wait for the flush of an outfile.
+    """
+    def __init__(self, outFiles, commit=None, maxsize=64, flushTimeout=3600):
+        self.flushTimeout = flushTimeout
+        self.queue = mp.Queue(maxsize)
+        self.replies = dict([(fpath, mp.Queue()) for fpath in outFiles])
+        self.process = mp.Process(target=_writerLoop, name='GribWriter',
+                                  args=(self.queue, self.replies, commit))
+        self.process.daemon = True
+        self.process.start()
+
+    def append(self, fpath, rank, messages, unit=None):
+        """
+        It passes the encoded messages to the writer (called in worker).
+        :param fpath: unordered outfile path.
+        :param rank: variable order rank of the messages.
+        :param messages: list of (message bytes, keys) tuples.
+        :param unit: (optional) manifest unit arguments of commit.
+        """
+        self.queue.put(('append', fpath, rank, messages, unit))
+
+    def taskDone(self, taskName):
+        """
+        It tells the writer that the task will not append anymore.
+        """
+        self.queue.put(('done', taskName))
+
+    def flush(self, fpath, deps):
+        """
+        It waits until the writer has written all the messages of the deps
+        tasks into fpath and returns the index of fpath.
+        :param fpath: unordered outfile path.
+        :param deps: names of the tasks which write into fpath.
+        :return: list of (offset, length, keys, rank) of the messages in
+                 fpath. rank is None for the messages of the earlier run.
+        :raise RuntimeError: if the writer process is dead or the flush is
+                             not replied within flushTimeout.
+        """
+        deadline = time.time() + self.flushTimeout
+        self.queue.put(('flush', fpath, list(deps)))
+        while True:
+            try:
+                return self.replies[fpath].get(timeout=max(0.1, min(_flushTick_, deadline - time.time())))
+            except Queue.Empty:
+                pass
+            # end of try:
+            if not _isAlive(self.process.pid):
+                raise RuntimeError("Writer process is dead, while flushing %s" % fpath)
+            if time.time() >= deadline:
+                raise RuntimeError("Writer didn't flush %s within %d seconds (tasks %s)" %
+                                   (fpath, self.flushTimeout, ', '.join(deps)))
+        # end of while True:
+
+    def stop(self):
+        self.queue.put(None)
+        self.process.join()
+# end of class GribWriter(object):
@@ -0,0 +1,220 @@
+"""
+This module keeps the persistent task manifest of um2grb2, so that a rerun
+(after wall-clock limit, filesystem hiccup, OOM, etc.) redoes only the
+missing work instead of converting everything again.
+
+The manifest is a json lines file under tmpPath. Each completed unit
+(input file, STASH, forecast hour, output subdomain) is recorded only after its messages are
+written, along with the input file size & mtime and the end offset of the
+written messages in the target file (unordered outfile or shard). Once an
+outfile is re-ordered, a 'finished' entry is recorded for it.
+
+While resuming, recover() makes the manifest and the output files
+consistent again, i.e.
+ - partially appended messages (after the last committed end offset) are
+   truncated,
+ - all the units of an outfile are redone, if any of its input files has
+   been changed (size or mtime) since then,
+ - units are redone if its target file has been lost.
+"""
+
+import os, json
+import sharedstore
+import mplogging
+
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('manifest')
+
+
+def getInputSignature(infile):
+    """
+    It returns (size, mtime) of the input file.
+    """
+    stat = os.stat(infile)
+    return stat.st_size, int(stat.st_mtime)
+# end of def getInputSignature(infile):
+
+
+def getUnitKey(infile, STASH, fhr, domain=None):
+    """
+    It returns the hashable key of the unit (input file, STASH, forecast hour,
+    output domain).
+    :param fhr: forecast hour (or window of forecast hours).
+    :param domain: name of the output subdomain (None is the global domain).
+    """
+    try:
+        fhr = [float(f) for f in fhr]
+    except TypeError:
+        fhr = [float(fhr)]
+    return (os.path.abspath(infile), str(STASH), tuple(fhr), domain)
+# end of def getUnitKey(infile, STASH, fhr, domain=None):
+
+
+def _append(manifestPath, entry):
+    # different processes append into the same manifest
+    with sharedstore.fileLock(manifestPath + '.lock'):
+        with open(manifestPath, 'a') as fobj:
+            fobj.write(json.dumps(entry) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        # end of with open(manifestPath, 'a') as fobj:
+    # end of with sharedstore.fileLock(manifestPath + '.lock'):
+# end of def _append(manifestPath, entry):
+
+
+def addUnit(manifestPath, infile, signature, STASH, fhr, outfile, target, end, domain=None,
+            start=None, rank=None):
+    """
+    It records the completed unit into the manifest. Call it only after the
+    messages of the unit are written into the target file.
+    :param manifestPath: manifest file path.
+    :param infile: input file path.
+    :param signature: (size, mtime) of the infile while it was read.
+    :param STASH: STASH code of the variable.
+    :param fhr: forecast hour (or window of forecast hours).
+    :param outfile: unordered outfile path.
+    :param target: file path into which the messages are written (outfile
+                   itself or shard of it).
+    :param end: end offset of the written messages in the target file.
+    :param domain: name of the output subdomain (None is the global domain).
+    :param start: start offset of the written messages in the target file.
+    :param rank: variable order rank of the messages (see getRanks).
+    """
+    infile, STASH, fhr, domain = getUnitKey(infile, STASH, fhr, domain)
+    _append(manifestPath, {'type': 'unit', 'infile': infile, 'size': signature[0],
+                           'mtime': signature[1], 'STASH': STASH, 'fhr': list(fhr),
+                           'domain': domain, 'outfile': outfile, 'target': target,
+                           'start': start, 'end': end, 'rank': rank})
+# end of def addUnit(...):
+
+
+def addFinished(manifestPath, outfile, ordered):
+    """
+    It records that the outfile has been re-ordered into ordered file.
+    """
+    _append(manifestPath, {'type': 'finished', 'outfile': outfile, 'ordered': ordered})
+# end of def addFinished(manifestPath, outfile, ordered):
+
+
+def getRanks(manifestPath, target):
+    """
+    It returns the variable order ranks of the messages of the target file,
+    which are recorded by its units.
+    :return: sorted list of (start, end, rank) of the units of the target
+             (the units of the older manifests without rank are left out).
+    """
+    return sorted([(entry['start'], entry['end'], entry['rank'])
+                   for entry in readManifest(manifestPath)
+                   if entry['type'] == 'unit' and entry['target'] == target and
+                   entry.get('start') is not None and entry.get('rank') is not None])
+# end of def getRanks(manifestPath, target):
+
+
+def readManifest(manifestPath):
+    """
+    It returns the list of entries of the manifest.
+    """
+    entries = []
+    if not os.path.isfile(manifestPath):
+        return entries
+    with open(manifestPath) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if not line: continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # partially written last line
+                _log_.warning("ALERT !!! Skipping broken manifest line in %s", manifestPath)
+        # end of for line in fobj:
+    # end of with open(manifestPath) as fobj:
+    return entries
+# end of def readManifest(manifestPath):
+
+
+def _isStale(entry):
+    if not os.path.isfile(entry['infile']):
+        return True
+    return tuple(getInputSignature(entry['infile'])) != (entry['size'], entry['mtime'])
+# end of def _isStale(entry):
+
+
+def recover(manifestPath, truncate):
+    """
+    It makes the manifest and its target files consistent for resuming (see
+    the module doc) and rewrites the manifest with the valid entries only.
+    :param manifestPath: manifest file path.
+    :param truncate: function truncate(target, end), which truncates the
+                     target file to its last committed end offset.
+    :return: set of completed unit keys, set of valid target files and the
+             set of re-ordered outfiles.
+    """
+    entries = readManifest(manifestPath)
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry['outfile'], []).append(entry)
+    # end of for entry in entries:
+
+    keep = []
+    for outfile, group in groups.iteritems():
+        units = [entry for entry in group if entry['type'] == 'unit']
+        finished = [entry for entry in group if entry['type'] == 'finished']
+        if [entry for entry in units if _isStale(entry)] or \
+                (finished and not os.path.isfile(finished[-1]['ordered'])):
+            # input has been changed (or product lost), so redo whole outfile
+            _log_.warning("Input changed or product lost, so redo all units of %s", outfile)
+            targets = set([entry['target'] for entry in units] + [outfile])
+            targets.update([entry['ordered'] for entry in finished])
+            for target in targets:
+                if os.path.isfile(target): os.remove(target)
+            # end of for target in targets:
+            continue
+        # end of if [...]:
+        if finished:
+            # outfile already re-ordered, so its targets are not needed
+            keep.extend(units + finished[-1:])
+            continue
+        # end of if finished:
+        for entry in units:
+            # units of lost target files have to be redone
+            if os.path.isfile(entry['target']): keep.append(entry)
+        # end of for entry in units:
+    # end of for outfile, group in groups.iteritems():
+
+    # truncate partially appended messages after the last committed end
+    ends = {}
+    for entry in keep:
+        if entry['type'] == 'unit' and os.path.isfile(entry['target']):
+            ends[entry['target']] = max(ends.get(entry['target'], 0), entry['end'])
+    # end of for entry in keep:
+    for target, end in ends.iteritems():
+        if os.path.getsize(target) != end:
+            _log_.warning("Truncating partially appended %s to %d bytes", target, end)
+            truncate(target, end)
+    # end of for target, end in ends.iteritems():
+
+    # rewrite the manifest with the valid entries only
+    if entries:
+        tmpPath = '%s.%d.tmp' % (manifestPath, os.getpid())
+        with open(tmpPath, 'w') as fobj:
+            for entry in keep:
+                fobj.write(json.dumps(entry) + '\n')
+        # end of with open(tmpPath, 'w') as fobj:
+        os.rename(tmpPath, manifestPath)
+    # end of if entries:
+
+    done = set([getUnitKey(entry['infile'], entry['STASH'], entry['fhr'], entry.get('domain'))
+                for entry in keep if entry['type'] == 'unit'])
+    finished = set([entry['outfile'] for entry in keep if entry['type'] == 'finished'])
+    return done, set(ends.keys()), finished
+# end of def recover(manifestPath, truncate):
+
+
+def removeManifest(manifestPath):
+    """
+    It removes the manifest (to start afresh).
+    """
+    for fpath in (manifestPath, manifestPath + '.lock'):
+        if os.path.isfile(fpath): os.remove(fpath)
+    # end of for fpath in (...):
+# end of def removeManifest(manifestPath):
@@ -0,0 +1,305 @@
+"""
+This module is the instrumentation layer of um2grb2.
+
+Every task (conversion of file x forecast-hour x variable, re-ordering of
+an outfile and the whole run itself) emits one json record with its wall
+duration, the time & no of fields & bytes of every stage (load, read,
+read_wait, extract, average, field_cache, interpolate, encode, lock_wait,
+save, shuffle, ctl),
+worker PID and the waiting time on the global lock. The stages of the reader
+thread (prefetch_read, prefetch_extract) overlap the other stages of the
+task, so those are reported apart and read_wait is the only read cost on the
+critical path of the task.
+
+Every worker process appends its records into its own json lines file
+(metrics.<pid>.jsonl) in the metrics directory, so there is no contention
+between the workers. The report() aggregates the records of a run into
+per-stage breakdown, per-worker utilisation, slowest tasks and the critical
+path (last finished outfile, back to the slowest conversion which fed it).
+"""
+
+import os, time, glob, json
+
+# metrics directory of this run (None means metrics are disabled)
+_metricsDir_ = None
+# the task which is running in this process
+_current_ = None
+# name prefix of the stages of the background (reader) thread of the task
+_backgroundPrefix_ = 'prefetch_'
+
+
+def setup(metricsDir):
+    """
+    It enables the metrics into metricsDir. Call it before forking the
+    workers, so that all the workers emit into the same directory.
+    :param metricsDir: metrics directory path or None to disable.
+    """
+    global _metricsDir_, _current_
+    _metricsDir_ = metricsDir
+    _current_ = None
+    if metricsDir is not None and not os.path.exists(metricsDir):
+        try:
+            os.makedirs(metricsDir)
+        except OSError:
+            # other process may created it already
+            if not os.path.isdir(metricsDir): raise
+    # end of if metricsDir is not None and ...:
+# end of def setup(metricsDir):
+
+
+class _Stage(object):
+    """
+    Accumulates time, no of fields and bytes of one stage of the task.
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.fields = 0
+        self.nbytes = 0
+        self.count = 0
+        self._start = None
+
+    def add(self, fields=0, nbytes=0):
+        self.fields += int(fields)
+        self.nbytes += int(nbytes)
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.time() - self._start
+        self.count += 1
+
+    def asDict(self):
+        return {'seconds': self.seconds, 'fields': self.fields,
+                'bytes': self.nbytes, 'count': self.count}
+# end of class _Stage(object):
+
+
+class _NullStage(object):
+    """
+    No-op stage, when the metrics are disabled.
+    """
+    def add(self, fields=0, nbytes=0): pass
+    def __enter__(self): return self
+    def __exit__(self, *args): pass
+# end of class _NullStage(object):
+
+
+class TaskMetrics(object):
+    """
+    Metrics of a single task.
+    """
+    def __init__(self, name, kind, **info):
+        self.name = name
+        self.kind = kind
+        self.info = info
+        self.stages = {}
+        self.pid = os.getpid()
+        self.start = time.time()
+
+    def stage(self, name):
+        if name not in self.stages: self.stages[name] = _Stage()
+        return self.stages[name]
+
+    def record(self, status):
+        end = time.time()
+        stages = dict([(name, stage.asDict()) for name, stage in self.stages.iteritems()])
+        lockWait = self.stages['lock_wait'].seconds if 'lock_wait' in self.stages else 0.0
+        written = self.stages.get('save', self.stages.get('shuffle'))
+        record = {'task': self.name, 'kind': self.kind, 'pid': self.pid,
+                  'status': status, 'start': self.start, 'end': end,
+                  'duration': end - self.start, 'lock_wait': lockWait,
+                  'fields': written.fields if written else 0,
+                  'bytes': written.nbytes if written else 0, 'stages': stages}
+        record.update(self.info)
+        return record
+# end of class TaskMetrics(object):
+
+
+def _getTask():
+    # the current task of this process (None if metrics are disabled)
+    if _metricsDir_ is None or _current_ is None: return None
+    if _current_.pid != os.getpid(): return None
+    return _current_
+# end of def _getTask():
+
+
+def _emit(record):
+    fpath = os.path.join(_metricsDir_, 'metrics.%d.jsonl' % os.getpid())
+    with open(fpath, 'a') as fobj:
+        fobj.write(json.dumps(record) + '\n')
+    # end of with open(fpath, 'a') as fobj:
+# end of def _emit(record):
+
+
+def startTask(name, kind, **info):
+    """
+    It starts the metrics of the task in this process. If the previous task
+    was not finished (say raised exception), then it is emitted as failed.
+    :param name: task name.
+    :param kind: task kind (convert, shuffle, run).
+    :param info: other json serializable info of the task.
+    """
+    global _current_
+    if _metricsDir_ is None: return
+    # (task of the parent process, which is inherited by fork, is dropped)
+    if _getTask() is not None: _emit(_current_.record('failed'))
+    _current_ = TaskMetrics(name, kind, **info)
+# end of def startTask(name, kind, **info):
+
+
+def finishTask(status='done'):
+    """
+    It emits the record of the current task.
+    """
+    global _current_
+    if _getTask() is not None: _emit(_current_.record(status))
+    _current_ = None
+# end of def finishTask(status='done'):
+
+
+def stage(name):
+    """
+    It returns the stage (context manager) of the current task, to time the
+    code within the with statement. Fields & bytes are added by add().
+    """
+    task = _getTask()
+    return task.stage(name) if task is not None else _NullStage()
+# end of def stage(name):
+
+
+def appendInfo(key, value):
+    """
+    It appends value into the list info of the current task (say outfiles).
+    """
+    task = _getTask()
+    if task is None: return
+    values = task.info.setdefault(key, [])
+    if value not in values: values.append(value)
+# end of def appendInfo(key, value):
+
+
+def loadRecords(metricsDir):
+    """
+    It returns all the records of the metrics directory.
+    """
+    records = []
+    for fpath in sorted(glob.glob(os.path.join(metricsDir, 'metrics.*.jsonl'))):
+        with open(fpath) as fobj:
+            for line in fobj:
+                line = line.strip()
+                if not line: continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partially written last line of killed worker
+                    pass
+            # end of for line in fobj:
+        # end of with open(fpath) as fobj:
+    # end of for fpath in sorted(...):
+    return records
+# end of def loadRecords(metricsDir):
+
+
+def criticalPath(records):
+    """
+    It returns the critical path of the run as list of records, i.e. the last
+    finished re-ordering task, preceded by the last finished conversion task
+    which wrote into its outfile.
+    """
+    shuffles = [rec for rec in records if rec['kind'] == 'shuffle']
+    converts = [rec for rec in records if rec['kind'] == 'convert']
+    if not shuffles:
+        return sorted(converts, key=lambda rec: rec['end'])[-1:]
+    last = max(shuffles, key=lambda rec: rec['end'])
+    feeders = [rec for rec in converts if last.get('outfile') in rec.get('outfiles', [])]
+    path = [last]
+    if feeders:
+        path.insert(0, max(feeders, key=lambda rec: rec['end']))
+    return path
+# end of def criticalPath(records):
+
+
+def report(records, top=10):
+    """
+    It returns the report text of the records of a run (critical path and
+    per-stage breakdown).
+    :param records: list of metrics records (as returned by loadRecords).
+    :param top: no of slowest tasks to be listed.
+    """
+    lines = []
+    tasks = [rec for rec in records if rec['kind'] != 'run']
+    if not tasks:
+        return "No task metrics found"
+    runs = [rec for rec in records if rec['kind'] == 'run']
+    t0 = min([rec['start'] for rec in records])
+    t1 = max([rec['end'] for rec in records])
+    lines.append("Run wall time: %.2f seconds, %d tasks (%d failed), %d workers"
+                 % (runs[-1]['duration'] if runs else t1 - t0, len(tasks),
+                    len([rec for rec in tasks if rec['status'] != 'done']),
+                    len(set([rec['pid'] for rec in tasks]))))
+
+    # per-stage breakdown
+    totals = {}
+    for rec in tasks:
+        for name, stage in rec['stages'].iteritems():
+            total = totals.setdefault(name, {'seconds': 0.0, 'fields': 0, 'bytes': 0, 'count': 0})
+            for key in total: total[key] += stage[key]
+        # end of for name, stage in rec['stages'].iteritems():
+    # end of for rec in tasks:
+    taskTime = sum([rec['duration'] for rec in tasks])
+    # stages of the reader thread overlap the others, so those are not part
+    # of the task time (its wait is read_wait)
+    background = dict([(name, total) for name, total in totals.iteritems()
+                       if name.startswith(_backgroundPrefix_)])
+    totals = dict([(name, total) for name, total in totals.iteritems() if name not in background])
+    lines.append("\nPer-stage breakdown (sum over all tasks, %.2f task seconds):" % taskTime)
+    lines.append("%-16s %10s %7s %9s %10s %10s %10s" % ('stage', 'seconds', '%', 'fields',
+                                                       'MB', 'fields/s', 'MB/s'))
+    for stages in (totals, background):
+        if stages is background and background:
+            lines.append("Reader thread stages (overlapped with the above):")
+        for name, total in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+            secs, mb = total['seconds'], total['bytes'] / 1048576.0
+            lines.append("%-16s %10.2f %7.1f %9d %10.1f %10.2f %10.2f"
+                         % (name, secs, 100.0 * secs / taskTime if taskTime else 0.0,
+                            total['fields'], mb, total['fields'] / secs if secs else 0.0,
+                            mb / secs if secs else 0.0))
+        # end of for name, total in sorted(...):
+        if stages is totals:
+            other = taskTime - sum([total['seconds'] for total in totals.values()])
+            lines.append("%-16s %10.2f %7.1f" % ('(untimed)', other,
+                                                 100.0 * other / taskTime if taskTime else 0.0))
+        # end of if stages is totals:
+    # end of for stages in (totals, background):
+
+    lockWaits = [rec['lock_wait'] for rec in tasks]
+    lines.append("\nLock wait: total %.2f seconds, max %.2f seconds per task"
+                 % (sum(lockWaits), max(lockWaits)))
+
+    # per-worker utilisation
+    lines.append("\nPer-worker busy time:")
+    busy = {}
+    for rec in tasks:
+        busy[rec['pid']] = busy.get(rec['pid'], 0.0) + rec['duration']
+    for pid, secs in sorted(busy.items()):
+        lines.append("  pid %-8d %10.2f seconds (%5.1f%% of wall)"
+                     % (pid, secs, 100.0 * secs / (t1 - t0) if t1 > t0 else 0.0))
+    # end of for pid, secs in sorted(busy.items()):
+
+    lines.append("\nSlowest %d tasks:" % top)
+    for rec in sorted(tasks, key=lambda rec: -rec['duration'])[:top]:
+        lines.append("  %-40s %-8s %8.2f seconds" % (rec['task'], rec['kind'], rec['duration']))
+    # end of for rec in sorted(...):
+
+    lines.append("\nCritical path:")
+    for rec in criticalPath(tasks):
+        stages = ', '.join(["%s %.2f" % (name, stage['seconds']) for name, stage in
+                            sorted(rec['stages'].items(), key=lambda item: -item[1]['seconds'])
+                            if not name.startswith(_backgroundPrefix_)])
+        lines.append("  %-40s started %8.2f ended %8.2f (%s)"
+                     % (rec['task'], rec['start'] - t0, rec['end'] - t0, stages))
+    # end of for rec in criticalPath(tasks):
+    return '\n'.join(lines)
+# end of def report(records, top=10):
@@ -0,0 +1,146 @@
+"""
+This module provides the multiprocessing safe, non-blocking logging of
+um2grb2.
+
+All the worker processes put its log records (already formatted text) into
+one multiprocessing queue, which costs no file syscall in the workers. A
+single listener process takes the records from the queue and writes them
+in batches into the log file and the console, i.e. one write & flush per
+batch instead of one flush per print of every worker.
+
+The log level filters the records within the worker itself, so that the
+per-field debug chatter is not even formatted in production. The print
+statements (of this and other modules) are captured as INFO records by
+replacing sys.stdout with StdoutLogger.
+
+Python 2 logging has no QueueHandler/QueueListener, so those are here.
+"""
+
+import sys, time, Queue, logging
+import multiprocessing as mp
+
+# format of every log record
+_format_ = '%(asctime)s %(processName)s %(levelname)s %(message)s'
+# name of the parent logger of all the g2utils loggers
+_loggerName_ = 'g2utils'
+
+
+class QueueHandler(logging.Handler):
+    """
+    Logging handler, which puts the formatted records into the queue.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # format in the worker, so that only plain text is pickled
+            self.queue.put_nowait(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+# end of class QueueHandler(logging.Handler):
+
+
+class StdoutLogger(object):
+    """
+    File like object to replace sys.stdout, which logs every complete line
+    (of print statements) as INFO record of the logger.
+    """
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.buf = ''
+
+    def write(self, text):
+        self.buf += text
+        if '\n' not in self.buf: return
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            if line.strip(): self.logger.log(self.level, line)
+        # end of for line in lines:
+
+    def flush(self):
+        pass
+# end of class StdoutLogger(object):
+
+
+def _listen(queue, logfile, console, batchSize, flushInterval):
+    # listener process, which writes the records in batches
+    log = open(logfile, 'a')
+    stop = False
+    while not stop:
+        batch = []
+        deadline = time.time() + flushInterval
+        while len(batch) < batchSize:
+            try:
+                text = queue.get(timeout=max(deadline - time.time(), 0.01))
+            except Queue.Empty:
+                break
+            if text is None:
+                stop = True
+                break
+            batch.append(text)
+        # end of while len(batch) < batchSize:
+        if not batch: continue
+        text = ''.join(batch)
+        log.write(text)
+        log.flush()
+        if console is not None:
+            console.write(text)
+            console.flush()
+        # end of if console is not None:
+    # end of while not stop:
+    log.close()
+# end of def _listen(...):
+
+
+class LogListener(object):
+    """
+    It starts the listener process and configures the g2utils logger of
+    this process (and the workers which are going to be forked from it)
+    to put the records into the queue. Call stop() at the end, which writes
+    all the pending records and restores sys.stdout.
+    :param logfile: log file path (records are appended).
+    :param level: log level name ('DEBUG', 'INFO', 'WARNING', ...).
+    :param console: if True, then records are written into console also.
+    :param batchSize: max no of records per write.
+    :param flushInterval: max seconds between the writes of the records.
+    """
+    def __init__(self, logfile, level='INFO', console=True, batchSize=512, flushInterval=1.0):
+        self.queue = mp.Queue()
+        self.stdout = sys.stdout
+        self.process = mp.Process(target=_listen, name='LogListener',
+                                  args=(self.queue, logfile, sys.stdout if console else None,
+                                        batchSize, flushInterval))
+        self.process.daemon = True
+        self.process.start()
+
+        handler = QueueHandler(self.queue)
+        handler.setFormatter(logging.Formatter(_format_))
+        self.logger = logging.getLogger(_loggerName_)
+        self.logger.handlers = [handler]
+        self.logger.setLevel(getattr(logging, str(level).upper()))
+        self.logger.propagate = False
+        # capture the print statements as INFO records
+        sys.stdout = StdoutLogger(logging.getLogger(_loggerName_ + '.stdout'))
+
+    def stop(self):
+        if sys.stdout is not self.stdout:
+            # log the last partial line (if any)
+            sys.stdout.write('\n')
+            sys.stdout = self.stdout
+        # end of if sys.stdout is not self.stdout:
+        self.logger.handlers = []
+        self.queue.put(None)
+        self.process.join()
+# end of class LogListener(object):
+
+
+def getLogger(name):
+    """
+    It returns the logger of the g2utils module name.
+    """
+    return logging.getLogger(_loggerName_ + '.' + name)
+# end of def getLogger(name):
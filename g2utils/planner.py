@@ -0,0 +1,71 @@
+"""
+This module is the read planner of um2grb2.
+
+The product catalog declares (in the priority order) every input file kind
+(filename prefix) and the output fields it provides, i.e. its outfile
+(um_prg or um_ana), variables (name, STASH), no of vertical levels,
+forecast hours of the chunk and whether those are 6 hourly means.
+
+Different input files may provide the same output field, say qwqg00.pp0
+and umglca_pd/umglca_pe of the 00Z analysis. Instead of hand-maintained
+branches per hour, the planner resolves every output field (outfile, STASH,
+forecast hours) to exactly one input file of the run (the first one in the
+catalog order) before any I/O starts, and returns the plan grouped by input
+file, i.e. the minimal list of variables to be read & regridded from every
+file. So the complete work list of a run is known upfront.
+"""
+
+import numpy
+
+
+def getCatalogEntry(catalog, fname):
+    """
+    It returns the catalog entry of the input file.
+    :param catalog: list of catalog entries (dictionaries with 'prefix',
+                    'outfile', 'vars', 'levels', 'fcstHours', 'mean' keys).
+    :param fname: input filename (say umglca_pd000 or qwqg00.pp0).
+    """
+    for entry in catalog:
+        if fname.startswith(entry['prefix']): return entry
+    # end of for entry in catalog:
+    raise ValueError("Filename not implemented yet! %s" % fname)
+# end of def getCatalogEntry(catalog, fname):
+
+
+def getFieldKey(entry, STASH):
+    """
+    It returns the key of the output field (outfile, STASH, forecast hours)
+    which is provided by the catalog entry.
+    """
+    return (entry['outfile'], str(STASH), tuple(numpy.ravel(entry['fcstHours']).tolist()))
+# end of def getFieldKey(entry, STASH):
+
+
+def makePlan(catalog, fnames):
+    """
+    It resolves every output field of the input files to exactly one input
+    file (the first one in the catalog order) and returns the plan.
+    :param catalog: list of catalog entries in the priority order.
+    :param fnames: input filenames (or partial filenames) of the run.
+    :return: (dictionary of catalog prefix and its list of (name, STASH) to
+             be read, list of (prefix, name, STASH, owner prefix) of the
+             duplicate fields which are dropped).
+    """
+    prefixes = set([getCatalogEntry(catalog, fname)['prefix'] for fname in fnames])
+    plan, owners, dropped = {}, {}, []
+    for entry in catalog:
+        if entry['prefix'] not in prefixes: continue
+        plan[entry['prefix']] = []
+        for name, STASH in entry['vars']:
+            key = getFieldKey(entry, STASH)
+            if key in owners:
+                # already provided by the higher priority input file
+                dropped.append((entry['prefix'], name, STASH, owners[key]))
+                continue
+            # end of if key in owners:
+            owners[key] = entry['prefix']
+            plan[entry['prefix']].append((name, STASH))
+        # end of for name, STASH in entry['vars']:
+    # end of for entry in catalog:
+    return plan, dropped
+# end of def makePlan(catalog, fnames):
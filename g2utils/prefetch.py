@@ -0,0 +1,105 @@
+"""
+This module has the background reader of um2grb2.
+
+The conversion task reads (realises the lazy data of) every 2-D field from
+the fieldsfile on the shared parallel filesystem and then regrids & encodes
+it, strictly one after another. The Prefetcher runs the reads in a thread,
+which fills a bounded buffer of the next fields, while the task regrids &
+encodes the current field. The file reads release the GIL, so the read time
+is hidden behind the compute (as much as the buffer depth allows), while the
+memory is bounded by the depth of the buffer.
+
+The reads are produced by a generator of (key, value) items, say (forecast
+hour index, level slice), and consumed in the same order by group(key).
+"""
+
+import sys, threading, Queue
+
+
+class Prefetcher(object):
+    """
+    Background reader of the items of the generator.
+    :param items: iterable (generator) of (key, value) tuples, which does the
+                  reads while it is iterated (in the reader thread).
+    :param depth: max no of items read ahead. If it is 0, then no thread, i.e.
+                  the items are read while consuming.
+    """
+    def __init__(self, items, depth=2):
+        self.items = iter(items)
+        self.depth = depth
+        self.next = None
+        self.stop = threading.Event()
+        self.thread = None
+        if depth > 0:
+            self.queue = Queue.Queue(depth)
+            self.thread = threading.Thread(target=self._read, name='Prefetcher')
+            self.thread.daemon = True
+            self.thread.start()
+        # end of if depth > 0:
+
+    def _put(self, entry):
+        # don't block forever, if the consumer has stopped
+        while not self.stop.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+        # end of while not self.stop.is_set():
+
+    def _read(self):
+        try:
+            for item in self.items:
+                if self.stop.is_set(): return
+                self._put(('item', item))
+            # end of for item in self.items:
+        except Exception:
+            # raise it in the consumer
+            self._put(('error', sys.exc_info()))
+            return
+        # end of try:
+        self._put(('end', None))
+
+    def _peek(self):
+        if self.next is not None: return self.next
+        if self.thread is not None:
+            self.next = self.queue.get()
+        else:
+            try:
+                self.next = ('item', next(self.items))
+            except StopIteration:
+                self.next = ('end', None)
+        # end of if self.thread is not None:
+        return self.next
+
+    def group(self, key):
+        """
+        It yields the values of the consecutive items of the key. It stops at
+        the first item of other key (which is left for the next group).
+        """
+        while True:
+            kind, item = self._peek()
+            if kind == 'end': return
+            if kind == 'error':
+                self.next = ('end', None)
+                raise item[0], item[1], item[2]
+            # end of if kind == 'error':
+            if item[0] != key: return
+            self.next = None
+            yield item[1]
+        # end of while True:
+
+    def close(self):
+        """
+        It stops the reader thread (the pending reads are dropped).
+        """
+        self.stop.set()
+        if self.thread is None: return
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        # end of while self.thread.is_alive():
+        self.thread.join()
+# end of class Prefetcher(object):
@@ -0,0 +1,422 @@
+"""
+This module provides a sparse-matrix regridder for the um2grb2 conversion.
+
+The bilinear stencil from the UM source grid (say N768) to the 0.25x0.25
+degree target grid is always the same for every variable, forecast hour and
+pressure level. So instead of calling cube.interpolate() for every 2-D field,
+we build the source-grid -> target-grid weights only once as a sparse matrix
+and apply it with a single sparse mat-vec product per 2-D slice.
+
+The weights are cached in memory (per process) and also persisted on disk
+(as numpy .npy files of sharedstore), so that every run and every worker
+reuses them. The persisted weights are attached as read-only memory maps,
+so all the workers share the same physical pages (zero-copy) instead of
+holding its own copy. Only one worker builds the weights (under file lock),
+while the others wait and attach to it.
+
+The bilinear weights reproduces the iris.analysis.Linear() scheme, i.e.
+circular coordinates (longitude) are wrapped and the points which are out of
+the source grid (latitude poles) are linearly extrapolated.
+
+The 'conservative' method is the first order area weighted remapping (as
+iris.analysis.AreaWeighted) for the accumulated fields (say precipitation),
+so that the total over the area is preserved. Every target cell value is
+the mean of the source cells weighted by their overlap area on the sphere.
+For the regular lat/lon grids the overlap area is separable, i.e. the
+longitude overlap times the sin(latitude) overlap, so the weights are the
+kronecker product of two 1-D overlap matrices. Those are cached exactly as
+the bilinear weights, so applying them costs the same as linear.
+"""
+
+import os, hashlib
+import numpy
+import scipy.sparse
+import iris
+import sharedstore
+import mplogging
+
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('regridder')
+# in-memory cache of the weights, keyed by the (source grid, target grid) key
+_weightsCache_ = {}
+
+
+def _gridKey(srcLat, srcLon, targetGrid, method):
+    """
+    It returns the unique key (md5 hexdigest) of the (source grid, target
+    grid, method) combination, which is used as the in-memory and on-disk
+    cache key of the weights.
+    :param srcLat: source latitude coordinate
+    :param srcLon: source longitude coordinate
+    :param targetGrid: list of (coordinate name, sample points) tuples.
+    :param method: regridding method name as string.
+    """
+    md5 = hashlib.md5()
+    md5.update(method)
+    for coord in (srcLat, srcLon):
+        md5.update(coord.name())
+        md5.update(str(bool(getattr(coord, 'circular', False))))
+        md5.update(numpy.ascontiguousarray(coord.points, dtype=numpy.float64).tostring())
+    for name, points in sorted(targetGrid):
+        md5.update(name)
+        md5.update(numpy.ascontiguousarray(points, dtype=numpy.float64).tostring())
+    return md5.hexdigest()
+# end of def _gridKey(...):
+
+
+def _linearWeights1D(src, tgt, circular=False, period=360.0):
+    """
+    It returns the lower/upper source indices and the weights of the upper
+    index for the 1-D linear interpolation of src points onto tgt points.
+    :param src: 1-D monotonic source points.
+    :param tgt: 1-D target points.
+    :param circular: if True, then src is treated as periodic (longitude).
+    :return: lower index, upper index, weight of upper index (all 1-D arrays
+             of length of tgt).
+    """
+    src = numpy.asarray(src, dtype=numpy.float64)
+    tgt = numpy.asarray(tgt, dtype=numpy.float64)
+    n = len(src)
+    # handle descending source points (say north to south latitude)
+    descending = n > 1 and src[0] > src[-1]
+    if descending:
+        src = src[::-1]
+
+    if circular:
+        # wrap the target points into [src[0], src[0]+period) and extend the
+        # source points by one more point, which is the wrapped first point.
+        tgt = numpy.mod(tgt - src[0], period) + src[0]
+        src = numpy.append(src, src[0] + period)
+        lo = numpy.searchsorted(src, tgt, side='right') - 1
+        lo = numpy.clip(lo, 0, n - 1)
+        hi = lo + 1
+        wt = (tgt - src[lo]) / (src[hi] - src[lo])
+        # the extended point is the first point again
+        hi = numpy.mod(hi, n)
+    else:
+        # out of range points will be extrapolated linearly from end intervals
+        lo = numpy.searchsorted(src, tgt, side='right') - 1
+        lo = numpy.clip(lo, 0, n - 2)
+        hi = lo + 1
+        wt = (tgt - src[lo]) / (src[hi] - src[lo])
+    # end of if circular:
+
+    if descending:
+        lo, hi = n - 1 - lo, n - 1 - hi
+    return lo, hi, wt
+# end of def _linearWeights1D(...):
+
+
+def buildLinearWeights(srcLat, srcLon, tgtLat, tgtLon):
+    """
+    It builds the bilinear interpolation weights from the source grid to the
+    target grid as a scipy.sparse csr matrix of shape
+    (len(tgtLat)*len(tgtLon), len(srcLat)*len(srcLon)), which has (at most)
+    4 non-zero weights per row.
+    :param srcLat: source latitude coordinate (iris coord)
+    :param srcLon: source longitude coordinate (iris coord)
+    :param tgtLat: target latitude points
+    :param tgtLon: target longitude points
+    :return: sparse weights matrix
+    """
+    nys, nxs = len(srcLat.points), len(srcLon.points)
+    nyt, nxt = len(tgtLat), len(tgtLon)
+
+    ylo, yhi, wy = _linearWeights1D(srcLat.points, tgtLat)
+    period = srcLon.units.modulus or 360.0
+    xlo, xhi, wx = _linearWeights1D(srcLon.points, tgtLon,
+                                    circular=getattr(srcLon, 'circular', False),
+                                    period=period)
+    # broadcast to (target lat, target lon) shape
+    ylo, yhi, wy = ylo[:, None], yhi[:, None], wy[:, None]
+    xlo, xhi, wx = xlo[None, :], xhi[None, :], wx[None, :]
+
+    rows = numpy.arange(nyt * nxt).reshape(nyt, nxt)
+    stencil = [(ylo, xlo, (1.0 - wy) * (1.0 - wx)),
+               (ylo, xhi, (1.0 - wy) * wx),
+               (yhi, xlo, wy * (1.0 - wx)),
+               (yhi, xhi, wy * wx)]
+    allRows, allCols, allWts = [], [], []
+    for yi, xi, wt in stencil:
+        allRows.append(rows.ravel())
+        allCols.append((yi * nxs + xi).ravel())
+        allWts.append(wt.ravel())
+    # end of for yi, xi, wt in stencil:
+
+    weights = scipy.sparse.coo_matrix((numpy.concatenate(allWts),
+                                      (numpy.concatenate(allRows),
+                                       numpy.concatenate(allCols))),
+                                      shape=(nyt * nxt, nys * nxs))
+    # duplicate entries (if any) are summed up while converting into csr
+    return weights.tocsr()
+# end of def buildLinearWeights(...):
+
+
+def _cellBounds(coord, points=None, lower=None, upper=None):
+    """
+    It returns the (n, 2) cell bounds of the coordinate. If the coordinate
+    has no bounds (or points are given, say target points), then the bounds
+    are the mid points of the adjacent points, and the end cells are half
+    spacing beyond the end points (clipped to lower/upper).
+    :param coord: iris coord (or None if points are given).
+    :param points: 1-D points.
+    :param lower: lower limit of the bounds (say -90 for latitude).
+    :param upper: upper limit of the bounds (say 90 for latitude).
+    """
+    if points is None and coord.has_bounds():
+        bounds = numpy.array(coord.bounds, dtype=numpy.float64)
+    else:
+        if points is None: points = coord.points
+        points = numpy.asarray(points, dtype=numpy.float64)
+        mids = 0.5 * (points[1:] + points[:-1])
+        edges = numpy.concatenate(([points[0] - (mids[0] - points[0])], mids,
+                                   [points[-1] + (points[-1] - mids[-1])]))
+        bounds = numpy.column_stack((edges[:-1], edges[1:]))
+    # end of if points is None and coord.has_bounds():
+    # make every cell lower bound < upper bound (descending coordinate)
+    bounds = numpy.sort(bounds, axis=1)
+    if lower is not None or upper is not None:
+        bounds = numpy.clip(bounds, lower, upper)
+    return bounds
+# end of def _cellBounds(...):
+
+
+def _overlapWeights1D(srcBounds, tgtBounds, circular=False, period=360.0):
+    """
+    It returns the 1-D overlap weights of the source cells onto the target
+    cells as scipy.sparse csr matrix of shape (no of target cells, no of
+    source cells). Every row is the overlap length of the source cells,
+    normalised by the total overlap of the row (so that the row sums up to
+    1, even for the target cell which partially covers the source grid).
+    :param srcBounds: (n, 2) source cell bounds (may be descending order).
+    :param tgtBounds: (m, 2) target cell bounds.
+    :param circular: if True, then the source is periodic (longitude).
+    """
+    nsrc = len(srcBounds)
+    # sort the source cells (say north to south latitude)
+    order = numpy.argsort(srcBounds[:, 0], kind='mergesort')
+    srcLo, srcHi = srcBounds[order, 0], srcBounds[order, 1]
+    shifts = (-period, 0.0, period) if circular else (0.0,)
+    rows, cols, wts = [], [], []
+    for ti, (tlo, thi) in enumerate(tgtBounds):
+        for shift in shifts:
+            lo, hi = tlo + shift, thi + shift
+            # source cells which overlaps (lo, hi)
+            j0 = numpy.searchsorted(srcHi, lo, side='right')
+            j1 = numpy.searchsorted(srcLo, hi, side='left')
+            if j1 <= j0: continue
+            overlap = numpy.minimum(srcHi[j0:j1], hi) - numpy.maximum(srcLo[j0:j1], lo)
+            keep = overlap > 0
+            rows.append(numpy.repeat(ti, keep.sum()))
+            cols.append(order[j0:j1][keep])
+            wts.append(overlap[keep])
+        # end of for shift in shifts:
+    # end of for ti, (tlo, thi) in enumerate(tgtBounds):
+    weights = scipy.sparse.coo_matrix((numpy.concatenate(wts), (numpy.concatenate(rows),
+                                      numpy.concatenate(cols))),
+                                      shape=(len(tgtBounds), nsrc)).tocsr()
+    rowSum = numpy.asarray(weights.sum(axis=1)).ravel()
+    rowSum[rowSum == 0] = 1.0
+    return scipy.sparse.diags(1.0 / rowSum).dot(weights).tocsr()
+# end of def _overlapWeights1D(...):
+
+
+def buildConservativeWeights(srcLat, srcLon, tgtLat, tgtLon):
+    """
+    It builds the area weighted (first order conservative) weights from the
+    source grid to the target grid as a scipy.sparse csr matrix of shape
+    (len(tgtLat)*len(tgtLon), len(srcLat)*len(srcLon)). The area of the cell
+    on the sphere is proportional to (longitude width) x (difference of
+    sin(latitude) bounds), so the weights are the kronecker product of the
+    1-D latitude (in sin space) and longitude overlap weights.
+    :param srcLat: source latitude coordinate (iris coord)
+    :param srcLon: source longitude coordinate (iris coord)
+    :param tgtLat: target latitude points
+    :param tgtLon: target longitude points
+    :return: sparse weights matrix
+    """
+    srcLatBounds = numpy.sin(numpy.radians(_cellBounds(srcLat, lower=-90.0, upper=90.0)))
+    tgtLatBounds = numpy.sin(numpy.radians(_cellBounds(None, tgtLat, lower=-90.0, upper=90.0)))
+    latWeights = _overlapWeights1D(srcLatBounds, tgtLatBounds)
+
+    period = srcLon.units.modulus or 360.0
+    lonWeights = _overlapWeights1D(_cellBounds(srcLon), _cellBounds(None, tgtLon),
+                                   circular=getattr(srcLon, 'circular', False),
+                                   period=period)
+    # row (target) and column (source) index is lat * nlon + lon
+    return scipy.sparse.kron(latWeights, lonWeights, format='csr')
+# end of def buildConservativeWeights(...):
+
+
+# weights builder of the regridding methods
+_builders_ = {'linear': buildLinearWeights,
+              'conservative': buildConservativeWeights}
+
+
+def _saveWeights(fpath, weights):
+    """
+    Save the sparse weights matrix into the sharedstore group directory
+    (written atomically, so that other workers never read a partially
+    written weights).
+    """
+    sharedstore.saveArrays(fpath, {'data': weights.data, 'indices': weights.indices,
+                                   'indptr': weights.indptr,
+                                   'shape': numpy.array(weights.shape)})
+# end of def _saveWeights(fpath, weights):
+
+
+def _loadWeights(fpath):
+    """
+    Load the sparse weights matrix from the sharedstore group directory.
+    The data, indices and indptr arrays are read-only memory maps (no copy).
+    """
+    arrays = sharedstore.loadArrays(fpath, ['data', 'indices', 'indptr', 'shape'])
+    return scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                   shape=tuple(arrays['shape']), copy=False)
+# end of def _loadWeights(fpath):
+
+
+def getWeights(srcLat, srcLon, targetGrid, cacheDir=None, method='linear'):
+    """
+    It returns the sparse weights matrix for the (source grid, target grid)
+    pair. First it looks into the in-memory cache, then into the on-disk
+    cache (cacheDir) and finally it builds the weights and stores them into
+    both caches.
+    :param srcLat: source latitude coordinate (iris coord)
+    :param srcLon: source longitude coordinate (iris coord)
+    :param targetGrid: list of (coordinate name, sample points) tuples.
+    :param cacheDir: directory path to persist (and share) the weights. If
+                     None, then the weights are cached in memory only.
+    :param method: regridding method, 'linear' or 'conservative'.
+    :return: scipy.sparse csr weights matrix.
+    """
+    if method not in _builders_:
+        raise ValueError("Unknown regridding method '%s'" % method)
+
+    key = _gridKey(srcLat, srcLon, targetGrid, method)
+    if key in _weightsCache_:
+        return _weightsCache_[key]
+
+    if cacheDir is None:
+        grid = dict(targetGrid)
+        weights = _builders_[method](srcLat, srcLon, grid['latitude'], grid['longitude'])
+        _log_.debug("Built %s regrid weights %s", method, str(weights.shape))
+        _weightsCache_[key] = weights
+        return weights
+    # end of if cacheDir is None:
+
+    fpath = os.path.join(cacheDir, '%s_%s' % (method, key))
+    # only one worker builds the weights, others wait and attach to it.
+    with sharedstore.fileLock(fpath + '.lock'):
+        weights = None
+        if os.path.isdir(fpath):
+            try:
+                weights = _loadWeights(fpath)
+            except Exception as e:
+                _log_.warning("ALERT !!! Couldn't load regrid weights %s, %s", fpath, str(e))
+                weights = None
+        # end of if os.path.isdir(fpath):
+
+        if weights is None:
+            grid = dict(targetGrid)
+            weights = _builders_[method](srcLat, srcLon, grid['latitude'], grid['longitude'])
+            _log_.debug("Built %s regrid weights %s", method, str(weights.shape))
+            _saveWeights(fpath, weights)
+            _log_.debug("Saved regrid weights into %s", fpath)
+            # attach to the persisted weights, so that this worker also
+            # shares the same pages instead of its own copy.
+            weights = _loadWeights(fpath)
+        # end of if weights is None:
+    # end of with sharedstore.fileLock(fpath + '.lock'):
+
+    _weightsCache_[key] = weights
+    return weights
+# end of def getWeights(...):
+
+
+def regrid(cube, targetGrid, cacheDir=None, method='linear'):
+    """
+    It regrids the cube to the targetGrid by applying the cached sparse
+    weights. The cube must have latitude and longitude as its last two
+    dimensions (as in UM fields). All the other dimensions (say pressure)
+    are regridded together as a single sparse mat-mat product.
+    :param cube: Iris cube with (..., latitude, longitude) dimensions.
+    :param targetGrid: list of (coordinate name, sample points) tuples, as
+                       in the sample points of cube.interpolate().
+    :param cacheDir: directory path to persist the weights.
+    :param method: regridding method, 'linear' (bilinear) or 'conservative'
+                   (area weighted, for the accumulated fields).
+    :return: regridded Iris cube.
+    """
+    srcLat = cube.coord('latitude')
+    srcLon = cube.coord('longitude')
+    latDim, = cube.coord_dims(srcLat)
+    lonDim, = cube.coord_dims(srcLon)
+    if (latDim, lonDim) != (cube.ndim - 2, cube.ndim - 1):
+        raise ValueError("latitude and longitude must be the last two dimensions of cube")
+
+    weights = getWeights(srcLat, srcLon, targetGrid, cacheDir, method)
+    grid = dict(targetGrid)
+    tgtLat, tgtLon = grid['latitude'], grid['longitude']
+
+    data = cube.data
+    isMasked = numpy.ma.isMaskedArray(data)
+    if isMasked:
+        # masked points are propagated as nan through the weights
+        data = numpy.ma.filled(data.astype(numpy.float64), numpy.nan)
+    # end of if isMasked:
+    outDtype = numpy.float32 if data.dtype == numpy.float32 else numpy.float64
+    lead = data.shape[:-2]
+    flat = data.reshape((-1, data.shape[-2] * data.shape[-1]))
+    # single sparse mat-vec (mat-mat for multi-level) product
+    regdData = weights.dot(flat.T).T.astype(outDtype)
+    regdData = regdData.reshape(lead + (len(tgtLat), len(tgtLon)))
+    if isMasked:
+        regdData = numpy.ma.masked_invalid(regdData)
+
+    return makeRegriddedCube(cube, targetGrid, regdData)
+# end of def regrid(...):
+
+
+def makeRegriddedCube(cube, targetGrid, regdData):
+    """
+    It creates the regridded cube of the already regridded data (say from
+    the field cache) with the metadata of the source cube (whose data is not
+    touched at all).
+    :param cube: source Iris cube with (..., latitude, longitude) dimensions.
+    :param targetGrid: target grid (see regrid).
+    :param regdData: regridded data of (..., target latitude, target
+                     longitude) shape.
+    :return: regridded Iris cube.
+    """
+    srcLat = cube.coord('latitude')
+    srcLon = cube.coord('longitude')
+    latDim, = cube.coord_dims(srcLat)
+    lonDim, = cube.coord_dims(srcLon)
+    grid = dict(targetGrid)
+    tgtLat, tgtLon = grid['latitude'], grid['longitude']
+    if regdData.shape != cube.shape[:-2] + (len(tgtLat), len(tgtLon)):
+        raise ValueError("regridded data shape %s doesn't match the target grid" % str(regdData.shape))
+
+    # create the new cube with all the non-horizontal coordinates of cube
+    regdCube = iris.cube.Cube(regdData)
+    regdCube.metadata = cube.metadata
+    for coord in cube.dim_coords:
+        dims = cube.coord_dims(coord)
+        if dims[0] not in (latDim, lonDim):
+            regdCube.add_dim_coord(coord.copy(), dims)
+    # end of for coord in cube.dim_coords:
+    for coord in cube.aux_coords:
+        dims = cube.coord_dims(coord)
+        if latDim in dims or lonDim in dims:
+            # horizontal aux coordinates can not be carried over
+            continue
+        regdCube.add_aux_coord(coord.copy(), dims)
+    # end of for coord in cube.aux_coords:
+    # add the target horizontal coordinates
+    regdCube.add_dim_coord(srcLat.copy(points=numpy.asarray(tgtLat, dtype=srcLat.dtype)), latDim)
+    newLon = srcLon.copy(points=numpy.asarray(tgtLon, dtype=srcLon.dtype))
+    regdCube.add_dim_coord(newLon, lonDim)
+
+    return regdCube
+# end of def makeRegriddedCube(cube, targetGrid, regdData):
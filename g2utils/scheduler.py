@@ -0,0 +1,345 @@
+"""
+This module has the flat task-graph scheduler of um2grb2.
+
+Instead of the nested process trees (one process per file type, each one
+with its own pool of forecast hour processes and one more pool for the
+re-ordering), all the tasks (file x forecast-hour x variable conversion,
+re-ordering and ctl generation) are submitted to a single pool of bounded
+number of worker processes.
+
+Tasks are dispatched in the order of priority and cost (largest first), so
+that the big tasks (say 18 levels pd files) are not left at the tail of the
+run. A task becomes ready as soon as all its dependency tasks are completed,
+i.e. re-ordering of an output file starts as soon as all its input tasks are
+done, while other conversions are still running.
+
+Tasks are admitted by memory also. Every task has an estimated memory
+footprint and a task is started only if the estimated total of the running
+tasks fits within the memory budget (a task which does not fit is left at
+the head of the ready queue, while the smaller ready tasks which do fit are
+run meanwhile). So the no of workers can be as many as the cores, without
+being OOM killed by few big (say 18 levels N768 pd) tasks at the same time.
+
+Tasks can also be added while it is running (say by the poller of the
+watch mode, which adds the conversion tasks of every new input file as soon
+as it lands).
+
+A worker which is killed (say by the OOM killer or a segfault in gribapi)
+takes its task with it, i.e. the pool never returns its result. So every
+task reports its worker pid as it starts, and a running task whose worker
+is dead is marked as failed (lost) and its dependents are cancelled,
+instead of waiting for it forever.
+"""
+
+import os, time, heapq, traceback, Queue
+import multiprocessing as mp
+import mplogging
+
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('scheduler')
+# seconds between the liveness checks of the workers of the running tasks
+_livenessInterval_ = 2.0
+# seconds to wait for a result in every loop of the scheduler
+_tick_ = 0.1
+# queue of (task name, worker pid) of the started tasks (set in the workers)
+_started_ = None
+
+
+def getNumProcs(nprocs=None):
+    """
+    It returns the no of worker processes. If nprocs is not passed, then it
+    takes the no of slots allocated by LSF (bsub -n) or else cpu count.
+    :param nprocs: no of worker processes (integer) or None.
+    """
+    if nprocs:
+        return int(nprocs)
+    for env in ('LSB_DJOB_NUMPROC', 'LSB_MAX_NUM_PROCESSORS'):
+        value = os.environ.get(env, '').strip()
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+    # end of for env in (...):
+    return mp.cpu_count()
+# end of def getNumProcs(nprocs=None):
+
+
+def getMemBudget(memBudget=None):
+    """
+    It returns the memory budget of the tasks in bytes. If memBudget is not
+    passed, then it takes 80% of the physical memory of this node.
+    :param memBudget: memory budget in MB (integer) or None.
+    """
+    if memBudget:
+        return int(memBudget) * 1024 ** 2
+    try:
+        return int(0.8 * os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (ValueError, OSError, AttributeError):
+        # unknown, so no memory limit
+        return None
+# end of def getMemBudget(memBudget=None):
+
+
+def _initWorker(started):
+    # pool initializer of the worker process
+    global _started_
+    _started_ = started
+# end of def _initWorker(started):
+
+
+def _isAlive(pid):
+    # True, if the process of pid is still running
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+# end of def _isAlive(pid):
+
+
+def _runTask(func, arg, name=None):
+    """
+    It runs func(arg) in the worker process and returns (True, result) or
+    (False, traceback string), so that one failed task never kills the run.
+    It reports the worker pid of the task first (see Scheduler.run).
+    """
+    if _started_ is not None and name is not None:
+        _started_.put((name, os.getpid()))
+    try:
+        return True, func(arg)
+    except Exception:
+        return False, traceback.format_exc()
+# end of def _runTask(func, arg, name=None):
+
+
+class Task(object):
+    """
+    A single unit of work of the scheduler.
+    """
+    def __init__(self, name, func, arg, cost=1, deps=(), priority=0, seq=0, mem=0):
+        self.name = name
+        self.func = func
+        self.arg = arg
+        self.cost = cost
+        self.mem = mem
+        self.deps = list(deps)
+        self.priority = priority
+        self.seq = seq
+# end of class Task(object):
+
+
+class Scheduler(object):
+    """
+    Flat task-graph scheduler with bounded no of worker processes.
+
+    The func of every task must be a module level function (picklable), and
+    the worker processes are forked only when run() is called, so that the
+    workers get the module global variables which are set before that.
+    :param nprocs: no of worker processes (see getNumProcs).
+    :param memBudget: memory budget of the running tasks in MB (see
+                      getMemBudget).
+    """
+    def __init__(self, nprocs=None, memBudget=None):
+        self.nprocs = getNumProcs(nprocs)
+        self.memBudget = getMemBudget(memBudget)
+        self.tasks = {}
+        self.order = []
+        # run state (valid only while run() is going on)
+        self._pending = None
+        self._dependents = None
+        self._completed = None
+        self._ready = None
+
+    def addTask(self, name, func, arg, cost=1, deps=(), priority=0, mem=0):
+        """
+        It adds the task into the graph. The dependency tasks must be added
+        already (so that there is no cycle in the graph).
+        :param name: unique name of the task.
+        :param func: module level function, which will be called as func(arg).
+        :param arg: argument of func.
+        :param cost: estimated cost of the task (larger ones are run first).
+        :param deps: names of the tasks which must be completed before this.
+        :param priority: tasks of higher priority are run first (irrespective
+                         of cost) once they are ready.
+        :param mem: estimated memory footprint of the task in bytes.
+        """
+        if name in self.tasks:
+            raise ValueError("Task '%s' already added" % name)
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError("Unknown dependency '%s' of task '%s'" % (dep, name))
+        # end of for dep in deps:
+        if self.memBudget and mem > self.memBudget:
+            _log_.warning("ALERT !!! Task %s needs %d MB, which is more than the memory budget %d MB. "
+                          "It will be run alone.", name, mem // 1024 ** 2, self.memBudget // 1024 ** 2)
+        # end of if self.memBudget and mem > self.memBudget:
+        self.tasks[name] = Task(name, func, arg, cost, deps, priority,
+                                 len(self.order), mem)
+        self.order.append(name)
+        # added while running, so lets register it now itself
+        if self._pending is not None: self._register(name)
+    # end of def addTask(...):
+
+    def _register(self, name):
+        task = self.tasks[name]
+        self._pending[name] = set(task.deps) - self._completed
+        self._dependents[name] = []
+        for dep in self._pending[name]:
+            self._dependents[dep].append(name)
+        # end of for dep in self._pending[name]:
+        if not self._pending[name]: self._push(name)
+    # end of def _register(self, name):
+
+    def _push(self, name):
+        task = self.tasks[name]
+        # order by priority, cost (largest first) and then insertion order
+        heapq.heappush(self._ready, (-task.priority, -task.cost, task.seq, name))
+    # end of def _push(self, name):
+
+    def _cancel(self, name, results):
+        # cancel all the dependents (recursively) of the lost task
+        for dependent in self._dependents[name]:
+            if dependent not in self._pending: continue
+            del self._pending[dependent]
+            self._completed.add(dependent)
+            results[dependent] = None
+            _log_.warning("ALERT !!! Task %s is cancelled, since its dependency %s is lost!!", dependent, name)
+            self._cancel(dependent, results)
+        # end of for dependent in self._dependents[name]:
+    # end of def _cancel(self, name, results):
+
+    def _pop(self, usedMem, running):
+        # pop the first ready task (in the heap order), which fits within the
+        # memory budget. A task bigger than the budget is run alone.
+        skipped, name = [], None
+        while self._ready:
+            entry = heapq.heappop(self._ready)
+            mem = self.tasks[entry[-1]].mem
+            if not self.memBudget or not running or usedMem + mem <= self.memBudget:
+                name = entry[-1]
+                break
+            skipped.append(entry)
+        # end of while self._ready:
+        for entry in skipped:
+            heapq.heappush(self._ready, entry)
+        return name
+    # end of def _pop(self, usedMem, running):
+
+    def run(self, poller=None, pollInterval=10):
+        """
+        It runs all the tasks and returns the dictionary of task name and its
+        result (None for the failed tasks). The dependents of a failed task
+        are still run (they have to handle the missing inputs), as like as
+        the rest of um2grb2 skips the failed fields. But the dependents of a
+        lost task (whose worker is killed) are cancelled, since its outputs
+        may be incomplete.
+        :param poller: (optional) function, which is called in the main
+                       process for every pollInterval seconds. It may add
+                       new tasks and it returns False, once no more tasks
+                       will be added.
+        :param pollInterval: poller interval in seconds.
+        """
+        if not self.tasks and poller is None:
+            return {}
+        self._pending, self._dependents = {}, {}
+        self._completed, self._ready = set(), []
+        for name in self.order:
+            self._register(name)
+        # end of for name in self.order:
+
+        polling = poller is not None
+        nprocs = self.nprocs if polling else min(self.nprocs, len(self.tasks))
+        _log_.info("Creating %d workers to run %d tasks in scheduler.", nprocs, len(self.tasks))
+        if self.memBudget:
+            _log_.info("Memory budget of the running tasks is %d MB.", self.memBudget // 1024 ** 2)
+        results = {}
+        started = mp.Queue()
+        pool = mp.Pool(processes=nprocs, initializer=_initWorker, initargs=(started,))
+        anyLost = False
+        try:
+            # async results & worker pids of the running tasks
+            running, workers = {}, {}
+            # running tasks whose worker was found dead in the last check
+            suspects = set()
+            # estimated memory of the running tasks
+            usedMem = 0
+            lastPoll = lastCheck = time.time()
+            while self._ready or running or polling:
+                # dispatch only as many tasks as free workers, so that the
+                # order of ready tasks is kept (pool itself is fifo).
+                while self._ready and len(running) < nprocs:
+                    name = self._pop(usedMem, len(running))
+                    # nothing fits within the memory budget now
+                    if name is None: break
+                    task = self.tasks[name]
+                    running[name] = pool.apply_async(_runTask, (task.func, task.arg, name))
+                    usedMem += task.mem
+                # end of while self._ready and len(running) < nprocs:
+
+                # short waits keep the main process interruptible
+                if running:
+                    running.values()[0].wait(_tick_)
+                elif polling:
+                    time.sleep(max(0, min(lastPoll + pollInterval - time.time(), _livenessInterval_)))
+                # end of if running:
+                if polling and time.time() >= lastPoll + pollInterval:
+                    polling = bool(poller())
+                    lastPoll = time.time()
+                # end of if polling and ...:
+
+                while True:
+                    try:
+                        name, pid = started.get_nowait()
+                    except Queue.Empty:
+                        break
+                    workers[name] = pid
+                # end of while True:
+                finished = [(name, asyncResult.get()) for name, asyncResult in running.items()
+                            if asyncResult.ready()]
+                lost = []
+                if time.time() >= lastCheck + _livenessInterval_:
+                    # dead at two consecutive checks (not a result on the way)
+                    dead = set([name for name, asyncResult in running.items()
+                                if not asyncResult.ready() and name in workers
+                                and not _isAlive(workers[name])])
+                    lost = list(dead & suspects)
+                    suspects = dead - suspects
+                    lastCheck = time.time()
+                # end of if time.time() >= lastCheck + _livenessInterval_:
+                anyLost = anyLost or bool(lost)
+                for name in lost:
+                    finished.append((name, (False, "worker process %d of the task is killed" % workers[name])))
+
+                for name, (ok, result) in finished:
+                    del running[name]
+                    workers.pop(name, None)
+                    usedMem -= self.tasks[name].mem
+                    self._completed.add(name)
+                    if ok:
+                        results[name] = result
+                    else:
+                        results[name] = None
+                        _log_.error("ALERT !!! Task %s failed!! %s", name, result)
+                    # end of if ok:
+                    if name in lost:
+                        self._cancel(name, results)
+                        continue
+                    # end of if name in lost:
+                    for dependent in self._dependents[name]:
+                        if dependent not in self._pending: continue
+                        self._pending[dependent].discard(name)
+                        if not self._pending[dependent]: self._push(dependent)
+                    # end of for dependent in self._dependents[name]:
+                # end of for name, (ok, result) in finished:
+            # end of while self._ready or running or polling:
+        finally:
+            if anyLost:
+                # pool waits for the lost tasks forever in join
+                pool.terminate()
+            else:
+                pool.close()
+                pool.join()
+            # end of if anyLost:
+            self._pending = self._dependents = self._completed = self._ready = None
+        # end of try:
+        return results
+    # end of def run(self):
+# end of class Scheduler(object):
@@ -0,0 +1,134 @@
+"""
+This module provides a simple memory-mapped array store, which is shared by
+all the worker processes of um2grb2.
+
+The helper arrays (target grid coordinates, regrid weights, masks, etc.)
+are written only once as numpy .npy files into the store directory (under
+tmpPath) and every worker attaches to them by numpy.load(mmap_mode='r').
+So all the workers share the same physical pages of the OS page cache
+(zero-copy) instead of holding its own copy of the N768 sized arrays.
+
+The arrays are written into a temporary file/directory and then renamed,
+so that a worker never attaches to a partially written array. An exclusive
+file lock is provided to let only one worker build an array, while others
+are waiting to attach to it.
+"""
+
+import os, shutil, fcntl
+import numpy
+
+
+def _arrayPath(storeDir, name):
+    return os.path.join(storeDir, name + '.npy')
+# end of def _arrayPath(storeDir, name):
+
+
+def _makeDirs(dirPath):
+    if not os.path.exists(dirPath):
+        try:
+            os.makedirs(dirPath)
+        except OSError:
+            # other worker may created it already
+            if not os.path.isdir(dirPath): raise
+    # end of if not os.path.exists(dirPath):
+# end of def _makeDirs(dirPath):
+
+
+def hasArray(storeDir, name):
+    """
+    It returns True if the array name is available in the store.
+    """
+    return os.path.isfile(_arrayPath(storeDir, name))
+# end of def hasArray(storeDir, name):
+
+
+def getArray(storeDir, name):
+    """
+    It attaches to the array of the store as read-only memory map.
+    :param storeDir: store directory path.
+    :param name: array name.
+    :return: read-only numpy memmap.
+    """
+    return numpy.load(_arrayPath(storeDir, name), mmap_mode='r')
+# end of def getArray(storeDir, name):
+
+
+def putArray(storeDir, name, array):
+    """
+    It writes the array into the store (if it is not already there) and
+    returns it as read-only memory map. Call this before forking the workers,
+    so that all the workers inherit the same mapping.
+    :param storeDir: store directory path.
+    :param name: array name.
+    :param array: numpy array.
+    :return: read-only numpy memmap of the array.
+    """
+    fpath = _arrayPath(storeDir, name)
+    array = numpy.asarray(array)
+    if os.path.isfile(fpath):
+        shared = getArray(storeDir, name)
+        if shared.shape == array.shape and shared.dtype == array.dtype and \
+                                        numpy.array_equal(shared, array):
+            return shared
+    # end of if os.path.isfile(fpath):
+    _makeDirs(storeDir)
+    tmpPath = '%s.%d.tmp' % (fpath, os.getpid())
+    with open(tmpPath, 'wb') as fobj:
+        numpy.save(fobj, array)
+    os.rename(tmpPath, fpath)
+    return getArray(storeDir, name)
+# end of def putArray(storeDir, name, array):
+
+
+def saveArrays(dirPath, arrays):
+    """
+    It writes the dictionary of arrays as one group (directory of .npy files)
+    atomically, i.e. either all the arrays are there or none.
+    :param dirPath: group directory path.
+    :param arrays: dictionary of name and numpy array.
+    """
+    _makeDirs(os.path.dirname(dirPath))
+    tmpDir = '%s.%d.tmp' % (dirPath, os.getpid())
+    if os.path.exists(tmpDir): shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    for name, array in arrays.iteritems():
+        with open(_arrayPath(tmpDir, name), 'wb') as fobj:
+            numpy.save(fobj, numpy.asarray(array))
+    # end of for name, array in arrays.iteritems():
+    if os.path.exists(dirPath):
+        # older (or broken) group, replace it
+        shutil.rmtree(dirPath)
+    os.rename(tmpDir, dirPath)
+# end of def saveArrays(dirPath, arrays):
+
+
+def loadArrays(dirPath, names):
+    """
+    It attaches to the arrays of the group as read-only memory maps.
+    :param dirPath: group directory path.
+    :param names: list of array names.
+    :return: dictionary of name and read-only numpy memmap.
+    """
+    return dict([(name, getArray(dirPath, name)) for name in names])
+# end of def loadArrays(dirPath, names):
+
+
+class fileLock(object):
+    """
+    Exclusive (inter process) file lock, to be used in with statement.
+    """
+    def __init__(self, lockPath):
+        self.lockPath = lockPath
+        self.fobj = None
+
+    def __enter__(self):
+        _makeDirs(os.path.dirname(self.lockPath))
+        self.fobj = open(self.lockPath, 'a')
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_UN)
+        self.fobj.close()
+        self.fobj = None
+# end of class fileLock(object):
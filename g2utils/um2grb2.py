@@ -72,10 +72,91 @@ Code History:
 12. Dec 11th, 2015: Global MP.LOCK added to avoid communication errors in overwriting
                     /appending grib2 files. (AAT)
                     Few unused modules removed & code cleaning (MNRS): List=netCDF4, types
+13. Oct 18th, 2026: Regridding through cached sparse bilinear weights (regridder.py)
+                    instead of cube.interpolate() for every field.
+14. Oct 18th, 2026: (STASH, forecast_period) field index built once per input
+                    file instead of scanning the CubeList for every extract.
+15. Oct 18th, 2026: Load-time STASH filtering (field level) in getCubeData, and
+                    the forecast_period extract of the loaded (lazy) cubes.
+16. Oct 18th, 2026: Vectorised cubeAverager over the raw time axis, which does
+                    all the accumulation windows in one pass. pf files enabled.
+17. Oct 18th, 2026: Lock free 'shard' output mode (per-task shard files which are
+                    concatenated in the order of variables at the end). GRIB2
+                    messages are encoded out of the lock (grib2io.py).
+18. Oct 18th, 2026: doShuffleVarsInOrder re-orders the raw message bytes by
+                    its section-4 keys, instead of iris load & save.
+19. Oct 18th, 2026: Native GrADS ctl/idx generation (gradsctl.py) from the writer
+                    offsets, instead of g2ctl.pl & gribmap re-reading the files.
+                    Optional single %f3 templated ctl for all forecast files.
+20. Oct 18th, 2026: Flat task-graph scheduler (scheduler.py) with bounded no of
+                    workers, which runs file x forecast-hour x variable tasks
+                    (largest first) and the re-ordering as soon as its inputs
+                    are done, instead of nested _MyPool/mp.Pool process trees.
+21. Oct 18th, 2026: Target grid and regrid weights are shared by all the workers
+                    as read-only memory mapped arrays (sharedstore.py).
+22. Oct 18th, 2026: Resumable conversion with persistent task manifest (manifest.py).
+                    Rerun redoes only the missing (file, STASH, forecast hour)
+                    units and truncates the partially appended messages.
+23. Oct 18th, 2026: Watch mode of forecast conversion, which converts every input
+                    file as soon as the UM run writes it completely and publishes
+                    the um_prg files of its hours incrementally.
+24. Oct 18th, 2026: Structured per-task metrics (metrics.py), i.e. json record of
+                    time, fields & bytes of every stage (load, read, extract,
+                    average, interpolate, encode, lock_wait, save, shuffle, ctl)
+                    per task. scripts/metricsreport.py aggregates it.
+25. Oct 18th, 2026: Non-blocking queue based logging (mplogging.py) with log levels
+                    instead of myLog, which flushed the shared log file on every
+                    print of every worker. Per-field chatter is DEBUG level now.
+26. Oct 18th, 2026: Memory-aware admission of the scheduler. Every conversion task
+                    has estimated memory footprint (by its no of fields & grid
+                    size) and it is started only if it fits within the budget.
+27. Oct 18th, 2026: Level by level streaming (regridEncodeLevels) of multi-level
+                    fields through read -> regrid -> encode, so that the peak
+                    memory is bounded by single 2-D slice instead of 3-D field.
+28. Oct 18th, 2026: Per-variable GRIB2 packing policy (packing type & bits per
+                    value) from the _orderedVars_ table, applied while encoding.
+29. Oct 18th, 2026: 'writer' output mode (gribwriter.py), i.e. workers encode in
+                    parallel and one writer process appends all the messages
+                    (no lock) and keeps its index for the ordered copy.
+30. Oct 18th, 2026: Area weighted conservative regridding (precomputed & cached
+                    sparse overlap weights) for the accumulated rain/precip/snow
+                    fields, instead of bilinear which doesn't preserve the total.
+31. Oct 18th, 2026: Regional subdomains output (subdomains option), i.e. only the
+                    source window & the target points of the lat/lon boxes are
+                    interpolated and encoded, into its own um_prg_<name> files.
+32. Oct 18th, 2026: Configurable target grid resolutions (resolutions option), i.e.
+                    0.25, 0.5 & 1.0 deg products from a single load & average of
+                    every field, each with its own weights and outfiles.
+33. Oct 18th, 2026: Declarative _productCatalog_ and read planner (planner.py)
+                    instead of the if/elif chain of getVarInOutFilesDetails, i.e.
+                    every output field is resolved to one input file upfront.
+34. Oct 18th, 2026: Background reader thread (prefetch.py) per task, which reads the
+                    level slices of the next fields into a bounded buffer, while
+                    the current field is regridded to all the domains & encoded.
+35. Oct 18th, 2026: Native memory mapped fieldsfile reader (fieldsfile.FieldsFile),
+                    an opt-in data path, which serves the data of the level
+                    slices from the memory map instead of iris (the fields which
+                    it doesn't decode alike by iris are still read by iris, and
+                    the cubes are still built by iris.load), with its lookup
+                    index cached as sidecar for the repeated opens (say previous
+                    cycle umglca files of the 06/12/18Z analysis).
+36. Oct 18th, 2026: Cross-cycle LRU cache of the regridded (and time averaged)
+                    fields of the previous cycle inputs (analysis umglca_pf),
+                    keyed by the input content, so that the reruns reuse those
+                    instead of reading, averaging & regridding (off by default).
+37. Oct 18th, 2026: Common set-up & tear-down of convertFcstFiles & convertAnlFiles
+                    (runConversion), i.e. the forecast task manifest, metrics
+                    & log are also named by the assimilated hour. The forecast
+                    manifest of the older name (um_prg_<date>.<mode>.manifest)
+                    is moved to the new name on resume.
+38. Oct 18th, 2026: Every input file is loaded (iris.load) only once for the tasks
+                    of all its variables, in the main process before forking the
+                    workers (preloadFiles), instead of once per variable task.
 
 References:
 1. Iris. v1.8.1 03-Jun-2015. Met Office. UK. https://github.com/SciTools/iris/archive/v1.8.1.tar.gz
 2. myLog() based on http://mail.python.org/pipermail/python-list/2007-May/438106.html <-- Class#1
+   (replaced by mplogging.py)
 3. Data understanding: /gpfs2/home/umfcst/ShortJobs/Subset-WRF/ncum_subset_24h.sh
 4. Creating Child processes: http://stackoverflow.com/questions/6974695/python-process-pool-non-daemonic
    # class #3
@@ -88,14 +169,26 @@ Copyright: ESSO-NCMRWF,MoES, 2015-2016.
 """
 
 # -- Start importing necessary modules
-import os, sys, time, subprocess
+import os, sys, time, bisect, subprocess
 import numpy, scipy
 import iris
 import gribapi
 import iris.unit as unit
 import multiprocessing as mp
-import multiprocessing.pool as mppool       # We must import this explicitly, it is not imported by the top-level multiprocessing                                                 module.
 import datetime
+import regridder
+import planner
+import prefetch
+import fieldcache
+import grib2io
+import gradsctl
+import scheduler
+import sharedstore
+import manifest
+import fieldsfile
+import metrics
+import mplogging
+import gribwriter
 # End of importing business
 
 # -- Start coding
@@ -103,6 +196,9 @@ iris.FUTURE.strict_grib_load = True
 # create global lock object
 lock = mp.Lock()
 
+# logger of this module (see mplogging.LogListener)
+_log_ = mplogging.getLogger('um2grb2')
+
 # other global variables
 _current_date_ = None
 _startT_ = None
@@ -110,102 +206,412 @@ _tmpDir_ = None
 _inDataPath_ = None
 _opPath_ = None
 _targetGrid_ = None
+_regridWeightsDir_ = None
+# output domains as list of (subdomain name, (south, north, west, east) box,
+# target grid). The global domain has None name & box (see setTargetDomains)
+_domains_ = [(None, None, None)]
+# target grid resolution (in degrees) of the untagged outfiles
+_defaultResolution_ = 0.25
+# sharedstore directory of the helper arrays (memory mapped by all workers)
+_sharedDir_ = None
 _fext_ = '_unOrdered'
+# output mode either 'locked' (all the workers append into the same file by
+# acquiring global lock) or 'shard' (lock free, each task writes into its own
+# shard file and those are concatenated in the order of variables at the end)
+# or 'writer' (workers pass the encoded messages to single writer process)
+_outputMode_ = 'locked'
+_shardDir_ = None
+# writer process of the 'writer' output mode (gribwriter.GribWriter)
+_writer_ = None
+# (isPressureLevel, discipline, category, number) -> rank of _orderedVars_
+_gribParamRanks_ = None
+# GrADS ctl/idx generation mode either 'native' (from the writer offsets) or
+# 'g2ctl' (g2ctl.pl & gribmap scripts)
+_ctlMode_ = 'native'
+# if True, then one templated ctl (%f3) is created for all forecast files
+_ctlTemplate_ = False
+# no of worker processes of the scheduler (None means LSF slots or cpu count)
+_nprocs_ = None
+# memory budget of the running tasks in MB (None means 80% of physical memory)
+_memBudget_ = None
+# task manifest path, completed units (input file, STASH, forecast hour) keys
+# and re-ordered outfiles of the earlier run (resume)
+_manifestPath_ = None
+_doneUnits_ = set()
+_finishedFiles_ = set()
+# read plan of the run, i.e. catalog prefix -> list of (name, STASH) to be
+# read from that input file (see planConversion)
+_readPlan_ = None
+# lazily loaded cubes of the input files, i.e. (partial filename, hr) ->
+# (input signature, cubes), which are loaded once per file in the main
+# process before forking the workers (see preloadFiles)
+_loadedFiles_ = {}
+# no of level slices read ahead by the reader thread of every task (0 means
+# no reader thread, i.e. read & compute one after another)
+_prefetchDepth_ = 2
+# read the data of the level slices by the native fieldsfile reader (else iris).
+# The metadata is still parsed by iris.load. Opt-in, enable it only after the
+# native vs iris check of benchmarks/bench_um2grb2.py --fieldsfile has passed
+# (0 mismatched, recorded as native_check in its --save-baseline json) over
+# the fieldsfiles of the model version in use.
+_nativeReader_ = False
+# cross-cycle cache directory & max size (bytes, 0 disables it) of the
+# regridded fields of the previousCycle inputs (say analysis umglca_pf)
+_fieldCacheDir_ = None
+_fieldCacheSize_ = 0
+# field cache of this process (see getFieldCache)
+_fieldCache_ = None
+
+# -- Create a GRIB2 packing policies Dictionary!
+# packing policy names (3rd item of the _orderedVars_ entries) and its packing
+# (see grib2io.setPacking). 'default' keeps the packing of iris/gribapi.
+# complex packing with spatial differencing (template 5.3) is decoded by
+# wgrib2/g2ctl/GrADS and it is much smaller than simple packing for smooth
+# fields. 'ccsds16' is smaller & faster still, but use it only if all the
+# downstream decoders support CCSDS (template 5.42).
+_packingPolicies_ = {
+'default': None,
+'complex16': {'packingType': 'grid_complex_spatial_differencing', 'bitsPerValue': 16},
+'simple12': {'packingType': 'grid_simple', 'bitsPerValue': 12},
+'ccsds16': {'packingType': 'grid_ccsds', 'bitsPerValue': 16},
+}
 
 # -- Create an ORDER Dictionary!
-# global ordered variables (the order we want to write into grib2)
+# global ordered variables (the order we want to write into grib2) and its
+# packing policy name (of _packingPolicies_)
 _orderedVars_ = {'PressureLevel': [
 # Pressure Level Variable names & STASH codes
-('geopotential_height', 'm01s16i202'),           
-('relative_humidity', 'm01s16i256'),
-('specific_humidity', 'm01s30i205'),   
-('air_temperature', 'm01s16i203'),
-('x_wind', 'm01s15i243'), 
-('y_wind', 'm01s15i244')],
+('geopotential_height', 'm01s16i202', 'complex16'),           
+('relative_humidity', 'm01s16i256', 'complex16'),
+('specific_humidity', 'm01s30i205', 'complex16'),   
+('air_temperature', 'm01s16i203', 'complex16'),
+('x_wind', 'm01s15i243', 'complex16'), 
+('y_wind', 'm01s15i244', 'complex16')],
 # Non Pressure Level Variable names & STASH codes
 'nonPressureLevel': [
-('surface_air_pressure', 'm01s00i409'),
-('air_pressure', 'm01s00i409'),  # this 'air_pressure' is duplicate name of 
+('surface_air_pressure', 'm01s00i409', 'complex16'),
+('air_pressure', 'm01s00i409', 'complex16'),  # this 'air_pressure' is duplicate name of 
 # 'surface_air_pressure', why because after written into anl grib2, the 
 # standard_name gets changed from surface_air_pressure to air_pressure only
 # for analysis, not for fcst! Ref: Saji M
-('air_pressure_at_sea_level', 'm01s16i222'),
-('surface_temperature', 'm01s00i024'),
-('relative_humidity', 'm01s03i245'), 
-('specific_humidity', 'm01s03i237'),
-('air_temperature', 'm01s03i236'),
-('dew_point_temperature', 'm01s03i250'),
-('high_type_cloud_area_fraction', 'm01s09i205'),
-('medium_type_cloud_area_fraction', 'm01s09i204'),
-('low_type_cloud_area_fraction', 'm01s09i203'), 
-('x_wind', 'm01s03i209'), 
-('y_wind', 'm01s03i210'),            
-('surface_altitude', 'm01s00i033')],
+('air_pressure_at_sea_level', 'm01s16i222', 'complex16'),
+('surface_temperature', 'm01s00i024', 'complex16'),
+('relative_humidity', 'm01s03i245', 'complex16'), 
+('specific_humidity', 'm01s03i237', 'complex16'),
+('air_temperature', 'm01s03i236', 'complex16'),
+('dew_point_temperature', 'm01s03i250', 'complex16'),
+('high_type_cloud_area_fraction', 'm01s09i205', 'simple12'),
+('medium_type_cloud_area_fraction', 'm01s09i204', 'simple12'),
+('low_type_cloud_area_fraction', 'm01s09i203', 'simple12'), 
+('x_wind', 'm01s03i209', 'complex16'), 
+('y_wind', 'm01s03i210', 'complex16'),            
+('surface_altitude', 'm01s00i033', 'complex16'),
+# 6-hourly accumulated rain & snow of pf files
+('stratiform_rainfall_amount', 'm01s04i201', 'complex16'),
+('stratiform_snowfall_amount', 'm01s04i202', 'complex16'),
+('convective_rainfall_amount', 'm01s05i201', 'complex16'),
+('convective_snowfall_amount', 'm01s05i202', 'complex16')],
 }
 
+# -- Create a product CATALOG List!
+# input files (filename prefix) and the output fields it provides, in the
+# priority order, i.e. if two input files of the run provide the same output
+# field (outfile, STASH, forecast hours), then it is read from the first one
+# only (see planner.makePlan). qwqg00 file variables are more correct than
+# the short forecast umglca_pd & umglca_pe variables.
+# fcstHours are relative to the forecast hour chunk of the input file.
+# upward_air_velocity is not added, since its not working in wgrib2!
+_productCatalog_ = [
+##### ANALYSIS FILE BEGIN
+{'prefix': 'qwqg00', 'outfile': 'um_ana', 'levels': 0,
+ # the cube contains Instantaneous data at every 3-hours.
+ # but we need to extract every 6th hours instantaneous.
+ 'fcstHours': [0,], 'mean': False, 'previousCycle': False,
+ 'vars': [('geopotential_height', 'm01s16i202'),
+          ('air_temperature', 'm01s16i203'),
+          ('relative_humidity', 'm01s16i256'),
+          ('x_wind', 'm01s15i243'),
+          ('y_wind', 'm01s15i244'),
+          ('air_pressure_at_sea_level', 'm01s16i222'),
+          ('surface_air_pressure', 'm01s00i409'),
+          ('surface_altitude', 'm01s00i033')]},
+{'prefix': 'umglca_pb', 'outfile': 'um_ana', 'levels': 0,
+ 'fcstHours': [0,], 'mean': False, 'previousCycle': False,
+ 'vars': [('dew_point_temperature', 'm01s03i250'),
+          ('surface_temperature', 'm01s00i024'),
+          ('relative_humidity', 'm01s03i245')]},
+{'prefix': 'umglca_pd', 'outfile': 'um_ana', 'levels': 18,
+ 'fcstHours': [0,], 'mean': False, 'previousCycle': False,
+ 'vars': [('geopotential_height', 'm01s16i202'),
+          ('air_temperature', 'm01s16i203'),
+          ('specific_humidity', 'm01s30i205'),
+          ('relative_humidity', 'm01s16i256'),
+          ('x_wind', 'm01s15i243'),
+          ('y_wind', 'm01s15i244')]},
+{'prefix': 'umglca_pe', 'outfile': 'um_ana', 'levels': 0,
+ # the cube contains Instantaneous data at every 1-hours.
+ 'fcstHours': [0,], 'mean': False, 'previousCycle': False,
+ 'vars': [('high_type_cloud_area_fraction', 'm01s09i205'),
+          ('medium_type_cloud_area_fraction', 'm01s09i204'),
+          ('low_type_cloud_area_fraction', 'm01s09i203'),
+          ('air_temperature', 'm01s03i236'),
+          ('air_pressure_at_sea_level', 'm01s16i222'),
+          ('specific_humidity', 'm01s03i237'),
+          ('surface_air_pressure', 'm01s00i409'),
+          ('x_wind', 'm01s03i209'),
+          ('y_wind', 'm01s03i210')]},
+{'prefix': 'umglca_pf', 'outfile': 'um_ana', 'levels': 0,
+ # rain and snow vars (these vars will be created as 6-hourly accumutated)
+ # from the previous cycle short forecast.
+ 'fcstHours': [(1, 5)], 'mean': True, 'previousCycle': True,
+ 'vars': [('stratiform_rainfall_amount', 'm01s04i201'),
+          ('stratiform_snowfall_amount', 'm01s04i202'),
+          ('convective_rainfall_amount', 'm01s05i201'),
+          ('convective_snowfall_amount', 'm01s05i202')]},
+##### ANALYSIS FILE END
+##### FORECAST FILE BEGIN
+{'prefix': 'umglaa_pb', 'outfile': 'um_prg', 'levels': 0,
+ 'fcstHours': [6, 12, 18, 24], 'mean': False, 'previousCycle': False,
+ 'vars': [('dew_point_temperature', 'm01s03i250'),
+          ('surface_temperature', 'm01s00i024'),
+          ('relative_humidity', 'm01s03i245')]},
+{'prefix': 'umglaa_pd', 'outfile': 'um_prg', 'levels': 18,
+ 'fcstHours': [6, 12, 18, 24], 'mean': False, 'previousCycle': False,
+ 'vars': [('geopotential_height', 'm01s16i202'),
+          ('air_temperature', 'm01s16i203'),
+          ('specific_humidity', 'm01s30i205'),
+          ('relative_humidity', 'm01s16i256'),
+          ('x_wind', 'm01s15i243'),
+          ('y_wind', 'm01s15i244')]},
+{'prefix': 'umglaa_pe', 'outfile': 'um_prg', 'levels': 0,
+ 'fcstHours': [6, 12, 18, 24], 'mean': False, 'previousCycle': False,
+ 'vars': [('high_type_cloud_area_fraction', 'm01s09i205'),
+          ('medium_type_cloud_area_fraction', 'm01s09i204'),
+          ('low_type_cloud_area_fraction', 'm01s09i203'),
+          ('air_temperature', 'm01s03i236'),
+          ('air_pressure_at_sea_level', 'm01s16i222'),
+          ('specific_humidity', 'm01s03i237'),
+          ('surface_air_pressure', 'm01s00i409'),
+          ('x_wind', 'm01s03i209'),
+          ('y_wind', 'm01s03i210')]},
+{'prefix': 'umglaa_pf', 'outfile': 'um_prg', 'levels': 0,
+ # the cube contains data of every 3-hourly average or accumutated.
+ # but we need to make only every 6th hourly average or accumutated.
+ 'fcstHours': [(1, 5), (7, 11), (13, 17), (19, 23)], 'mean': True, 'previousCycle': False,
+ 'vars': [('stratiform_rainfall_amount', 'm01s04i201'),
+          ('stratiform_snowfall_amount', 'm01s04i202'),
+          ('convective_rainfall_amount', 'm01s05i201'),
+          ('convective_snowfall_amount', 'm01s05i202')]},
+##### FORECAST FILE END
+]
+
 # -- Create classes
-# create a class #1 for capturing stdin, stdout and stderr
-class myLog():
-    """
-    A simple class with destructor and construtor for logging the standatd I/O
-    """
-    def __init__(self, logfile):
-        self.stdout = sys.stdout
-        self.flush = sys.stdout.flush
-        self.log = open(logfile, 'w')
-
-    def write(self, text):
-        self.stdout.write(text)
-        self.log.write(text)
-        self.log.flush()
-
-    def close(self):
-        self.stdout.close()
-        self.log.close()
-# end of class #1
-
-# create a class #2 to initiate mp daemon processes
-class _NoDaemonProcess(mp.Process):
-    # make 'daemon' attribute always return False
-    # A class created by AAT
-    def _get_daemon(self):
-        return False
-    def _set_daemon(self, value):
-        pass
-    daemon = property(_get_daemon, _set_daemon)
-# end of class #2
-
-# create a class #3 to set-up worker-pools
-class _MyPool(mppool.Pool):
-    # We sub-class multiprocessing.pool. Pool instead of multiprocessing.Pool
-    # because the latter is only a wrapper function, not a proper class.
-    # refer the link in ref#4 to invoke child processes
-    # A class created by AAT
-    Process = _NoDaemonProcess
-# end of class #3
+# create a class #4 to watch the input files of the running UM forecast
+class _FcstFilesWatcher(object):
+    """
+    Poller of the watch mode (see scheduler.Scheduler.run). On every poll, it
+    adds the conversion tasks of the input files which are completely written
+    by the UM run (stable size & mtime since the last poll and a valid
+    fieldsfile header) into the scheduler. Once all the input files of a
+    forecast hour chunk are added, it adds the re-ordering tasks of the
+    outfiles of that chunk, so those are published as soon as converted.
+    """
+    def __init__(self, sched, fnames, outFiles, timeout):
+        self.sched = sched
+        self.outFiles = outFiles
+        self.timeout = timeout
+        self.fcstTimes = getFcstTimes('fcst')
+        # yet to land input files of every forecast hour chunk
+        self.pending = dict([(hr, list(fnames)) for hr in self.fcstTimes])
+        self.chunkTasks = dict([(hr, []) for hr in self.fcstTimes])
+        self.published = set()
+        self.stats = {}
+        self.lastLanded = time.time()
+
+    def _isLanded(self, fname):
+        if not os.path.isfile(fname): return False
+        stat = (os.path.getsize(fname), os.path.getmtime(fname))
+        previous = self.stats.get(fname)
+        self.stats[fname] = stat
+        # size must be stable since the last poll
+        if stat != previous: return False
+        return fieldsfile.isCompleteFieldsFile(fname)
+
+    def _publish(self, hr):
+        # outfiles of hr+6 ... hr+24 of this chunk
+        for outHr, outFn in self.outFiles:
+            if int(hr) < outHr <= int(hr) + 24:
+                addOutFileTask(self.sched, outFn, self.chunkTasks[hr])
+        # end of for outHr, outFn in self.outFiles:
+        self.published.add(hr)
+
+    def __call__(self):
+        global _inDataPath_
+        for hr in self.fcstTimes:
+            for fpname in list(self.pending[hr]):
+                fname = os.path.join(_inDataPath_, fpname + hr)
+                if not self._isLanded(fname): continue
+                _log_.info("Input file landed: %s", fname)
+                for taskName, arg, cost, mem, fhr in getFileConvertTasks(fpname, hr):
+                    addConvertTask(self.sched, taskName, arg, cost, mem)
+                    self.chunkTasks[hr].append(taskName)
+                # end of for taskName, arg, cost, mem, fhr in ...:
+                self.pending[hr].remove(fpname)
+                self.lastLanded = time.time()
+            # end of for fpname in list(self.pending[hr]):
+            if not self.pending[hr] and hr not in self.published: self._publish(hr)
+        # end of for hr in self.fcstTimes:
+        if len(self.published) == len(self.fcstTimes): return False
+        
+        if time.time() - self.lastLanded > self.timeout:
+            _log_.warning("ALERT !!! No input file landed since %d seconds, so stop watching", self.timeout)
+            for hr in self.fcstTimes:
+                if hr in self.published: continue
+                _log_.warning("ALERT !!! Missing input files of %s hour: %s", hr, self.pending[hr])
+                self._publish(hr)
+            # end of for hr in self.fcstTimes:
+            return False
+        # end of if time.time() - self.lastLanded > self.timeout:
+        return True
+# end of class #4
 
 # -- Start definition files..
 # start definition #1
-def getCubeData(umFname):
+def getCubeData(umFname, varNamesSTASH=None, fcstHours=None):
     """
     This definition module reads the input file name and its location as a
     string and it returns the data as an Iris Cube.
     An upgraded version uses a GUI to read the file.
+    The varNamesSTASH (as returned by getVarInOutFilesDetails) is applied as
+    load-time filter, which iris applies on the STASH of every field before
+    converting it into cube (only if the STASH constraint is passed alone), so
+    that the fields of the other variables are never converted and merged.
+    Then the fcstHours are extracted from the loaded cubes (lazy data, so
+    the data of the other forecast hours is never read).
     :param umFname: UM fieldsfile filename passed as a string
+    :param varNamesSTASH: list of (variable name, STASH code) tuples to load.
+                          If None, then all the variables will be loaded.
+    :param fcstHours: forecast hours (scalars or sequences of hours within
+                      the time mean bounds) to load. If None, then all the
+                      forecast hours will be loaded.
     :return: Data for corresponding data file in Iris cube format
     """
-
-    cubes = iris.load(umFname)
+    
+    stashConstraint = None
+    if varNamesSTASH is not None:
+        stashCodes = set([str(varSTASH) for varName, varSTASH in varNamesSTASH])
+        # don't combine it with other constraints, else iris can't apply it
+        # as field level filter
+        stashConstraint = iris.AttributeConstraint(STASH=lambda stash: str(stash) in stashCodes)
+    # end of if varNamesSTASH is not None:
+    
+    cubes = iris.load(umFname, stashConstraint)
+    
+    if fcstHours is not None:
+        fpValues = list(numpy.ravel(fcstHours))
+        # cell == value checks the value within bounds for time mean fields
+        fpConstraint = iris.Constraint(forecast_period=lambda cell: any(cell == value for value in fpValues))
+        cubes = cubes.extract(fpConstraint)
+    # end of if fcstHours is not None:
     
     return cubes
 # end of definition #1
 
+# start definition #14
+def getCubeIndex(cubes):
+    """
+    This definition builds the field index of the loaded cubes only once per
+    input file, so that we need not to scan the whole CubeList by applying
+    constraints (cubes.extract) for every variable and forecast hour.
+    Nothing is sliced or loaded here, the index just points to the (lazily
+    loaded) cube and its time index.
+    :param cubes: Iris CubeList (as returned by getCubeData).
+    :return: index: dictionary with (STASH code string, forecast_period point)
+                    as key and list of (cube, time dimension, time index,
+                    forecast_period cell) tuples as value, in the order of
+                    cubes.
+    """
+    index = {}
+    for cube in cubes:
+        stash = str(cube.attributes.get('STASH', ''))
+        fpCoords = cube.coords('forecast_period')
+        if not fpCoords: continue
+        fpCoord = fpCoords[0]
+        dims = cube.coord_dims(fpCoord)
+        tdim = dims[0] if dims else None
+        for ti, cell in enumerate(fpCoord.cells()):
+            entry = (cube, tdim, ti, cell)
+            index.setdefault((stash, cell.point), []).append(entry)
+        # end of for ti, cell in enumerate(fpCoord.cells()):
+    # end of for cube in cubes:
+    return index
+# end of definition #14
+
+# start definition #15
+def getIndexedCube(index, varName, varSTASH, fhr=None):
+    """
+    This definition returns the variable cube from the field index, which is
+    equivalent to the older cubes.extract(iris.Constraint(name=varName) &
+    iris.AttributeConstraint(STASH=varSTASH) &
+    iris.Constraint(forecast_period=fhr))[0].
+    :param index: field index dictionary (as returned by getCubeIndex).
+    :param varName: variable name.
+    :param varSTASH: variable STASH code as string.
+    :param fhr: forecast hour either scalar or sequence of forecast hours
+                (say (1, 5) to get time slices of 3-hourly mean which
+                contains 1 and 5 forecast hours within its bounds).
+                If it is None, then the whole cube will be returned.
+    :return: Iris cube (sliced lazily w.r.t fhr) or None if not found.
+    """
+    varSTASH = str(varSTASH)
+    if fhr is None:
+        for (stash, fp), entries in index.iteritems():
+            if stash != varSTASH: continue
+            for cube, tdim, ti, cell in entries:
+                if cube.name() == varName: return cube
+        # end of for (stash, fp), entries in index.iteritems():
+        return None
+    # end of if fhr is None:
+
+    # collect the matching time indices of every cube
+    matches = []
+    for value in numpy.atleast_1d(fhr):
+        entries = index.get((varSTASH, value))
+        if entries is None:
+            # forecast hour may fall within the bounds of time mean fields
+            entries = [entry for (stash, fp), ents in index.iteritems()
+                       if stash == varSTASH for entry in ents if entry[-1] == value]
+        # end of if entries is None:
+        matches.extend([entry for entry in entries if entry[0].name() == varName])
+    # end of for value in numpy.atleast_1d(fhr):
+    if not matches: return None
+
+    # like extract()[0], take the first matching cube only
+    cube, tdim = matches[0][0], matches[0][1]
+    if tdim is None: return cube
+    tindices = sorted(set([ti for c, td, ti, cell in matches if c is cube]))
+    if len(tindices) == 1:
+        # single time slice collapses the time dimension
+        tslice = tindices[0]
+    elif tindices == range(tindices[0], tindices[-1] + 1):
+        tslice = slice(tindices[0], tindices[-1] + 1)
+    else:
+        tslice = numpy.array(tindices)
+    # end of if len(tindices) == 1:
+    keys = [slice(None)] * cube.ndim
+    keys[tdim] = tslice
+    return cube[tuple(keys)]
+# end of definition #15
+
 # start definition #2
 def getVarInOutFilesDetails(inDataPath, fname, hr):
     """
     This definition module gets the required variables from the passed
     cube as per the WRF-Variables.txt file.
     (matches the contents of pgp06prepDDMMYY)
+    The details are taken from the _productCatalog_ entry of the file, and
+    the variables are only those which are resolved to this file by the
+    read plan of the run (see planConversion).
     - Improvements & Edits by AAT & MNRS
     :param inDataPath: data path which contains data and hour.
     :param fname: filename of the fieldsfile that has been passed as a string.
@@ -225,125 +631,40 @@ def getVarInOutFilesDetails(inDataPath, fname, hr):
     Updated : 10-12-2015
     """
     
+    global _productCatalog_, _readPlan_
+    
     hr = int(hr)
     
     infile = os.path.join(inDataPath, fname)    
     
-    inDataPathHour = inDataPath.split('/')[-1]      
-    # check frpm where the analysis file is being made.
-    if fname.startswith('umglaa'):
-        outfile = 'um_prg' 
-    elif fname.startswith(('umglca', 'qwqg00')):
-        outfile = 'um_ana'
+    entry = planner.getCatalogEntry(_productCatalog_, fname)
+    outfile = entry['outfile']
+    if _readPlan_ is not None and entry['prefix'] in _readPlan_:
+        # only the variables which are resolved to this file (see planConversion)
+        varNamesSTASH = list(_readPlan_[entry['prefix']])
     else:
-        raise ValueError("Got unknown fname, so couldn't set outfile!")
-    # end of if fname.startswith('umglaa'):
-    
-    ##### ANALYSIS FILE BEGIN     
-    if fname.startswith('qwqg00'):                   # qwqg00
-        varNamesSTASH = [('geopotential_height', 'm01s16i202'),
-            ('air_temperature', 'm01s16i203'),
-            ('relative_humidity', 'm01s16i256'),
-            ('x_wind', 'm01s15i243'), 
-            ('y_wind', 'm01s15i244'),
-            ('air_pressure_at_sea_level', 'm01s16i222'),
-            ('surface_air_pressure', 'm01s00i409'),
-            ('surface_altitude', 'm01s00i033')]
-        ### need to add 'upward_air_velocity' , 
-        #### but its not working in wgrib2!
-        varLvls = 0        
-        # the cube contains Instantaneous data at every 3-hours.        
-        # but we need to extract every 6th hours instantaneous.
-        fcstHours = numpy.array([0,])     
-        do6HourlyMean = False
-            
-    elif fname.startswith('umglca_pb'):              # umglca_pb
-        # varNamesSTASH = [19, 24, 26, 30, 31, 32, 33, 34] # needed
-        # available for use
-        varNamesSTASH = [('dew_point_temperature', 'm01s03i250'),
-                    ('surface_temperature', 'm01s00i024'),
-                    ('relative_humidity', 'm01s03i245')] # available for use
-        varLvls = 0        
-        # the cube contains Instantaneous data at every 3-hours.        
-        # but we need to extract every 6th hours instantaneous.
-        fcstHours = numpy.array([0,])     
-        do6HourlyMean = False
-        
-    elif fname.startswith('umglca_pd'):            # umglca_pd
-        # consider variable
-        if inDataPathHour == '00':
-            varNamesSTASH = [('specific_humidity', 'm01s30i205'),] 
-            # rest of them (i.e 1,2,3,5,6,7) from taken already from qwqg00 file.
-        else:
-            # upward wind is not working
-           varNamesSTASH = [('geopotential_height', 'm01s16i202'),
-                       ('air_temperature', 'm01s16i203'), 
-                       ('specific_humidity', 'm01s30i205'),
-                       ('relative_humidity', 'm01s16i256'),                        
-                       ('x_wind', 'm01s15i243'),
-                       ('y_wind', 'm01s15i244')]
-                     
-        # qwqg00 file variables are more correct than this short forecast vars.
-        varLvls = 18
-        # the cube contains Instantaneous data at every 3-hours.
-        # but we need to extract only every 6th hours instantaneous.
-        fcstHours = numpy.array([0,])     
-        do6HourlyMean = False
-        
-    elif fname.startswith('umglca_pe'):            # umglca_pe
-        if inDataPathHour == '00':
-            varNamesSTASH = [('high_type_cloud_area_fraction', 'm01s09i205'), 
-                        ('medium_type_cloud_area_fraction', 'm01s09i204'),
-                        ('low_type_cloud_area_fraction', 'm01s09i203'),
-                        ('air_temperature', 'm01s03i236'),                    
-                        ('specific_humidity', 'm01s03i237'),                        
-                        ('x_wind', 'm01s03i209'), 
-                        ('y_wind', 'm01s03i210')]
-            # rest of them (i.e 'air_pressure_at_sea_level', 
-            #'surface_air_pressure') from taken already from qwqg00 file.
-        else:
-            varNamesSTASH = [('high_type_cloud_area_fraction', 'm01s09i205'), 
-                        ('medium_type_cloud_area_fraction', 'm01s09i204'),
-                        ('low_type_cloud_area_fraction', 'm01s09i203'),
-                        ('air_temperature', 'm01s03i236'),              
-                        ('air_pressure_at_sea_level', 'm01s16i222'),                              
-                        ('specific_humidity', 'm01s03i237'),
-                        ('surface_air_pressure', 'm01s00i409'),
-                        ('x_wind', 'm01s03i209'), 
-                        ('y_wind', 'm01s03i210')]
-                    
-        ### varIdx 10 is omited, since it has two zero. i think we need to take previous file average or current hour aver.
-        varLvls = 0        
-        # the cube contains Instantaneous data at every 1-hours.
-        # but we need to extract only every 6th hours instantaneous.
-        fcstHours = numpy.array([0,])     
-        do6HourlyMean = False
-
-    elif fname.startswith('umglca_pf'):             # umglca_pf
-        # other vars (these vars will be created as 6-hourly averaged)
-        # varNamesSTASH = [4, 23, 24, 25, 26, 28, 31, 32, 33, 34, 35, 36]
-        # rain and snow vars (these vars will be created as 6-hourly accumutated)
-        varNamesSTASH2 = [12, 13, 17, 18, 20, 21]         # all vars
-        varNamesSTASH = varNamesSTASH2 #+ varNamesSTASH2
-        varLvls = 0        
-        # the cube contains data of every 3-hourly average or accumutated.
-        # but we need to make only every 6th hourly average or accumutated.
-        fcstHours = numpy.array([(1, 5)])   
-        do6HourlyMean = True
-        
+        varNamesSTASH = list(entry['vars'])
+    # end of if _readPlan_ is not None and ...:
+    varLvls = entry['levels']
+    # forecast hours (or windows) of the chunk hr of input file
+    fcstHours = numpy.array(entry['fcstHours']) + hr
+    do6HourlyMean = entry['mean']
+    
+    if entry['previousCycle']:
+        # analysis pf file is taken from the previous cycle short forecast
         ipath = inDataPath.split('/')
         hr = ipath[-1]
         today_date = ipath[-2]
         
         if hr in ['06', '12', '18']:
             hr = str(int(hr) - 6).zfill(2)
-            print "Taken analysis past 6 hour data", hr
+            _log_.info("Taken analysis past 6 hour data %s", hr)
         elif hr == '00':           
             # actually it returns yesterday's date.
             today_date = getYdayStr(today_date)
             # set yesterday's 18z hour.
             hr = '18'
-            print "Taken analysis yesterday's date and 18z hour", today_date
+            _log_.info("Taken analysis yesterday's date and 18z hour %s", today_date)
         else:
             raise ValueError("hour %s method not implemented" % hr)
         # end of if hr in ['06', '12', '18']:            
@@ -355,67 +676,7 @@ def getVarInOutFilesDetails(inDataPath, fname, hr):
         # infile path (it could be current date and past 6 hour for 06,12,18 hours.  
         # but it set yesterday date and past 6 hour for 00 hour)
         infile = os.path.join(ipath, fname)    
-    ##### ANALYSIS FILE END
-    
-    ##### FORECAST FILE BEGIN
-    elif fname.startswith('umglaa_pb'):              # umglaa_pb
-        # varNamesSTASH = [19, 24, 26, 30, 31, 32, 33, 34] # needed        
-        varNamesSTASH = [('dew_point_temperature', 'm01s03i250'),
-                    ('surface_temperature', 'm01s00i024'),
-                    ('relative_humidity', 'm01s03i245')] 
-        varLvls = 0        
-        # the cube contains Instantaneous data at every 3-hours.        
-        # but we need to extract every 6th hours instantaneous.
-        fcstHours = numpy.array([6, 12, 18, 24]) + hr
-        do6HourlyMean = False
-        
-    elif fname.startswith('umglaa_pd'):            # umglaa_pd
-        # consider variable
-        # varNamesSTASH = 'upward_air_velocity' # needed
-        varNamesSTASH = [('geopotential_height', 'm01s16i202'),
-                    ('air_temperature', 'm01s16i203'),  
-                    ('specific_humidity', 'm01s30i205'),                    
-                    ('relative_humidity', 'm01s16i256'),                    
-                    ('x_wind', 'm01s15i243'),
-                    ('y_wind', 'm01s15i244')]
-        varLvls = 18
-        # the cube contains Instantaneous data at every 3-hours.
-        # but we need to extract only every 6th hours instantaneous.
-        fcstHours = numpy.array([6, 12, 18, 24]) + hr
-        do6HourlyMean = False
-        
-    elif fname.startswith('umglaa_pe'):            # umglaa_pe
-        varNamesSTASH = [('high_type_cloud_area_fraction', 'm01s09i205'),
-                    ('medium_type_cloud_area_fraction', 'm01s09i204'),
-                    ('low_type_cloud_area_fraction', 'm01s09i203'),                    
-                    ('air_temperature', 'm01s03i236'),
-                    ('air_pressure_at_sea_level', 'm01s16i222'),
-                    ('specific_humidity', 'm01s03i237'),
-                    ('surface_air_pressure', 'm01s00i409'),
-                    ('x_wind', 'm01s03i209'), 
-                    ('y_wind', 'm01s03i210')]
-        varLvls = 0        
-        # the cube contains Instantaneous data at every 1-hours.
-        # but we need to extract only every 6th hours instantaneous.
-        fcstHours = numpy.array([6, 12, 18, 24]) + hr
-        do6HourlyMean = False
-
-    elif fname.startswith('umglaa_pf'):             # umglaa_pf
-        # other vars (these vars will be created as 6-hourly averaged)
-        # varNamesSTASH = [4, 23, 24, 25, 26, 28, 31, 32, 33, 34, 35, 36]
-        # rain and snow vars (these vars will be created as 6-hourly accumutated)
-        varNamesSTASH2 = [12, 13, 17, 18, 20, 21]         # all vars
-        varNamesSTASH = varNamesSTASH2 #+ varNamesSTASH2
-        varLvls = 0        
-        # the cube contains data of every 3-hourly average or accumutated.
-        # but we need to make only every 6th hourly average or accumutated.
-        fcstHours = numpy.array([(1, 5), (7, 11), (13, 17), (19, 23)]) + hr    
-        do6HourlyMean = True    
-    
-    ##### FORECAST FILE END
-    else:
-        raise ValueError("Filename not implemented yet!")
-    # end if-loop
+    # end of if entry['previousCycle']:
 
     return varNamesSTASH, varLvls, fcstHours, do6HourlyMean, infile, outfile
 # end of definition #2
@@ -453,59 +714,84 @@ def cubeAverager(tmpCube, action='mean', intervals='hourly'):
                         averaged or summed.
     Started and initiated by AAT on 11/16/2015 and minor correction & standardization by MNRS on
     11/29/15.
+    Now it reduces the whole time dimension in one shot by cubeWindowsAverager.
     """
-    meanCube = tmpCube[0]
-    tlen = len(tmpCube.coord('time').points)
-    # average through the time steps for all accumulate fields
-    for ti in range(1, tlen):
-        meanCube = iris.analysis.maths.add(meanCube, tmpCube[ti])
-    # end of for ti in range(1, len(tmpCube)):
+    meanCube, = cubeWindowsAverager(tmpCube, [None], action, intervals)
+    # make memory free
+    del tmpCube
     
-    if action == 'mean':
-        meanCube /= float(tlen)
-        print "Converted cube to %s mean" % intervals
-    else:
-        print "Converted cube to %s accumutation" % intervals
-    # end of if not isAccumulation:
-
-    # get the time coord and set to mean
-    timeAxFirst = tmpCube[0].coords('time')[0]
-    timeAxLast = tmpCube[-1].coords('time')[0]
+    # return mean cube 
+    return meanCube
+# end of def cubeAverager(tmpCube): def #4
 
-    # get the bounds and time points from two extremes    
-    bounds = [timeAxFirst.bounds[0][0], timeAxLast.bounds[-1][-1]]
+# start definition #16
+def _meanTimeCoord(coord, first, last):
+    """
+    It returns the scalar copy of the time coordinate (time/forecast_period)
+    with bounds from the first time index to the last time index and the
+    time point at the middle of the bounds.
+    :param coord: time coordinate along the time dimension.
+    :param first: first time index of the window.
+    :param last: last time index of the window.
+    """
+    if coord.bounds is not None:
+        bounds = [coord.bounds[first][0], coord.bounds[last][-1]]
+    else:
+        bounds = [coord.points[first], coord.points[last]]
+    # end of if coord.bounds is not None:
     timepoint = [bounds[0] + ((bounds[-1] - bounds[0]) / 2.0)]
+    return coord.copy(points=timepoint, bounds=[bounds])
+# end of def _meanTimeCoord(coord, first, last):
 
-    # update the time coordinate with new time point and time bounds
-    timeAxFirst.points = timepoint
-    timeAxFirst.bounds = bounds
-
-    # add the updated time coordinate to the meanCube
-    meanCube.add_aux_coord(timeAxFirst)
-    
-    # get the fcst time coord and set to mean
-    fcstAxFirst = tmpCube[0].coords('forecast_period')[0]
-    fcstAxLast = tmpCube[-1].coords('forecast_period')[0]
-
-    # get the bounds and time points from two extremes
-    bounds = [fcstAxFirst.bounds[0][0], fcstAxLast.bounds[-1][-1]]
-    fcstpoint = [bounds[0] + ((bounds[-1] - bounds[0]) / 2.0)]
-
-    # update the time coordinate with new fcst time point and fcst time bounds
-    fcstAxFirst.points = fcstpoint
-    fcstAxFirst.bounds = bounds
+def cubeWindowsAverager(tmpCube, windows, action='mean', intervals='hourly', skipData=()):
+    """
+    This module reduces the time dimension of the raw data of tmpCube into
+    mean or sum of every window, in one pass over the data. The results
+    are computed into one preallocated float32 buffer (no intermediate
+    cubes) and the time & forecast_period bounds metadata are built directly.
+    The masked data stays masked (only the points masked at all the time
+    slices of the window), and its mean is over the unmasked values only.
+    :param tmpCube:     The cube data with non-singleton time dimension.
+    :param windows:     list of windows. Each window is a sequence of
+                        forecast hours (say (1, 5)), which selects the
+                        time slices containing those hours within its
+                        bounds (as in iris.Constraint(forecast_period=..)).
+                        None window selects all the time slices.
+    :param action:      mean| sum (accumulated fields are summed and instantaneous are averaged).
+    :param intervals:   A simple string representing represting the time & binning aspect.
+    :param skipData:    indices of the windows whose data is not needed (say
+                        done or cached), so only their metadata is built (the
+                        data of those cubes is uninitialised).
+    :return: list of mean/sum cubes w.r.t windows (None for empty window).
+    """
+    tdim, = tmpCube.coord_dims(tmpCube.coord('time'))
+    fpCells = list(tmpCube.coord('forecast_period').cells())
+    tlen = tmpCube.shape[tdim]
     
-    # add the updated fcst time coordinate to the meanCube
-    meanCube.add_aux_coord(fcstAxFirst)
-
-    # add attributes back to meanCube
-    meanCube.attributes = tmpCube.attributes  
-        
-    # add standard_name
-    meanCube.standard_name = tmpCube.standard_name
-    meanCube.long_name = tmpCube.long_name
+    # time indices of every window
+    groups = []
+    for window in windows:
+        if window is None:
+            groups.append(range(tlen))
+        else:
+            values = numpy.atleast_1d(window)
+            groups.append([ti for ti in range(tlen)
+                           if any(fpCells[ti] == value for value in values)])
+        # end of if window is None:
+    # end of for window in windows:
     
-    print meanCube.long_name, tmpCube.long_name
+    # realise the data only once (only if any window needs it) and keep time
+    # axis at first (its a view)
+    shape = tmpCube.shape[:tdim] + tmpCube.shape[tdim + 1:]
+    data, isMasked = None, False
+    if any([len(tindices) > 1 for wi, tindices in enumerate(groups) if wi not in skipData]):
+        data = numpy.rollaxis(tmpCube.data, tdim)
+        isMasked = numpy.ma.isMaskedArray(data)
+    # end of if any([...]):
+    outData = numpy.empty((len(groups),) + shape, dtype=numpy.float32)
+    # mask of the masked data, i.e. the points which are masked at all the
+    # time slices of the window (as iris SUM & MEAN collapse)
+    outMask = numpy.zeros((len(groups),) + shape, dtype=bool) if isMasked else None
     
     # generate cell_methods
     if action == 'mean':
@@ -514,17 +800,83 @@ def cubeAverager(tmpCube, action='mean', intervals='hourly'):
     else:
         cm = iris.coords.CellMethod('sum', 'time', intervals, 
                                      comments=intervals+' accumutation')
-    # add cell_methods to the meanCube                                     
-    meanCube.cell_methods = (cm,)
-
-    print meanCube
-
-    # make memory free
-    del tmpCube
+    # end of if action == 'mean':
     
-    # return mean cube 
-    return meanCube
-# end of def cubeAverager(tmpCube): def #4
+    meanCubes = []
+    for wi, tindices in enumerate(groups):
+        if not tindices:
+            meanCubes.append(None)
+            continue
+        # end of if not tindices:
+        if len(tindices) == 1:
+            # nothing to be averaged
+            keys = [slice(None)] * tmpCube.ndim
+            keys[tdim] = tindices[0]
+            meanCubes.append(tmpCube[tuple(keys)])
+            continue
+        # end of if len(tindices) == 1:
+        
+        if wi in skipData:
+            # metadata only
+            pass
+        elif isMasked:
+            # the masked values (fill/bmdi) are neither summed nor counted
+            counts = numpy.ma.count(data[tindices], axis=0)
+            outData[wi] = numpy.ma.filled(numpy.ma.sum(data[tindices], axis=0), 0)
+            outMask[wi] = counts == 0
+        elif tindices == range(tindices[0], tindices[-1] + 1):
+            # contiguous time slices, reduce the view in one shot
+            numpy.sum(data[tindices[0]:tindices[-1] + 1], axis=0,
+                      dtype=numpy.float32, out=outData[wi])
+        else:
+            outData[wi] = data[tindices[0]]
+            for ti in tindices[1:]:
+                numpy.add(outData[wi], data[ti], out=outData[wi])
+        # end of if wi in skipData:
+        if wi in skipData:
+            pass
+        elif action == 'mean':
+            if isMasked:
+                # mean of the unmasked values only (as iris MEAN)
+                outData[wi] /= numpy.maximum(counts, 1)
+            else:
+                outData[wi] /= float(len(tindices))
+            _log_.debug("Converted cube to %s mean", intervals)
+        else:
+            _log_.debug("Converted cube to %s accumutation", intervals)
+        # end of if action == 'mean':
+        
+        # build the mean cube with all the non-time coordinates
+        meanData = outData[wi]
+        if isMasked: meanData = numpy.ma.array(meanData, mask=outMask[wi], copy=False)
+        meanCube = iris.cube.Cube(meanData)
+        # add attributes, standard_name, long_name, units back to meanCube
+        meanCube.metadata = tmpCube.metadata
+        for coord in tmpCube.coords():
+            dims = tmpCube.coord_dims(coord)
+            if tdim not in dims:
+                if any(coord is dimCoord for dimCoord in tmpCube.dim_coords):
+                    meanCube.add_dim_coord(coord.copy(), [d - (d > tdim) for d in dims])
+                else:
+                    meanCube.add_aux_coord(coord.copy(), [d - (d > tdim) for d in dims])
+            elif coord.name() in ('time', 'forecast_period'):
+                # update the time coordinates with new time point and bounds
+                meanCube.add_aux_coord(_meanTimeCoord(coord, tindices[0], tindices[-1]))
+            elif len(dims) == 1:
+                # other time dependent coordinate takes the first time value
+                meanCube.add_aux_coord(coord[tindices[0]].copy())
+            # end of if tdim not in dims:
+        # end of for coord in tmpCube.coords():
+        
+        # add cell_methods to the meanCube
+        meanCube.cell_methods = (cm,)
+        _log_.debug("%s %s", meanCube.long_name, tmpCube.long_name)
+        _log_.debug("%s", meanCube)
+        meanCubes.append(meanCube)
+    # end of for wi, tindices in enumerate(groups):
+    
+    return meanCubes
+# end of def cubeWindowsAverager(...): def #16
 
 # start definition #5
 def regridAnlFcstFiles(arg):
@@ -535,9 +887,11 @@ def regridAnlFcstFiles(arg):
     parallel problem! It also checks the std names from Iris cube format with the
     CF-convention and it regrids the data to 0.25x0.25 regular grid using linear
     interpolation methods.
-    :param arg: tuple(fname, hr)
+    :param arg: tuple(fname, hr) or tuple(fname, hr, varNamesSTASH)
             fname: common filename
             hr: forecast hour
+            varNamesSTASH: (optional) list of (name, STASH) of the file, to
+                           convert only those variables (fine grained task)
     :return: regridded cube saved as GRIB2 file! TANGIBLE!
     ACK:
     This module has been entirely revamped & improved by AAT based on an older and
@@ -545,8 +899,9 @@ def regridAnlFcstFiles(arg):
     Lock added by AAT on 12/11/2015 (mm/dd/yyyy).
     """
     global _targetGrid_, _current_date_, _startT_, _inDataPath_, _opPath_, _fext_, lock
+    global _regridWeightsDir_, _outputMode_, _shardDir_, _doneUnits_, _writer_, _domains_
     
-    fpname, hr = arg 
+    fpname, hr = arg[:2]
     
     ### if fileName has some extension, then do not add hr to it.
     fileName = fpname + hr if not '.' in fpname else fpname
@@ -556,150 +911,647 @@ def regridAnlFcstFiles(arg):
     # call definition to get variable indices
     varNamesSTASH, varLvls, fcstHours, do6HourlyMean, infile, outfile = getVarInOutFilesDetails(_inDataPath_,
                                                                                              fileName, hr)
+    # unique task name (used as shard name) of this file & variables
+    taskName = fileName
+    if len(arg) > 2:
+        # convert only the selected variables of this file
+        varNamesSTASH = [var for var in varNamesSTASH if var in arg[2]]
+        taskName = fileName + '.' + '_'.join([varSTASH for varName, varSTASH in varNamesSTASH])
+    # end of if len(arg) > 2:
     
     if not os.path.isfile(fname): 
-        print "The file doesn't exists: %s.. \n" %fname
+        _log_.warning("The file doesn't exists: %s", fname)
         return  
     # end of if not os.path.isfile(fname): 
-    print "Started Processing the file: %s.. \n" %fname
+    if not os.path.isfile(infile): 
+        _log_.warning("The file doesn't exists: %s", infile)
+        return  
+    # end of if not os.path.isfile(infile): 
+    # input file (size, mtime) while reading, which is recorded in manifest
+    signature = manifest.getInputSignature(infile)
+    
+    if _doneUnits_:
+        # skip the units (variable, forecast hour) completed in earlier run
+        isDone = lambda varSTASH, fhr: all([manifest.getUnitKey(infile, varSTASH, fhr, domain) in _doneUnits_
+                                            for domain, box, targetGrid in _domains_])
+        varNamesSTASH = [(varName, varSTASH) for varName, varSTASH in varNamesSTASH
+                         if not all([isDone(varSTASH, fhr) for fhr in fcstHours])]
+        if not varNamesSTASH:
+            _log_.info("All the units of %s were converted already in earlier run", taskName)
+            return
+        # end of if not varNamesSTASH:
+        fcstHours = numpy.array([fhr for fhr in fcstHours
+                                 if not all([isDone(varSTASH, fhr) for varName, varSTASH in varNamesSTASH])])
+    # end of if _doneUnits_:
+    _log_.info("Started Processing the file: %s", fname)
+    metrics.startTask(taskName, 'convert', infile=infile)
     
     # call definition to get cube data
-    cubes = getCubeData(infile)
-    nVars = len(cubes)
+    with metrics.stage('load') as stage:
+        # cubes of this file which are loaded already (shared by the tasks of
+        # all its variables) or else load them now
+        cubes = getLoadedCubes(fpname, hr, signature, varNamesSTASH)
+        if cubes is None: cubes = getCubeData(infile, varNamesSTASH, fcstHours)
+        nVars = len(cubes)
+        # build (STASH, forecast_period) field index only once per file
+        cubesIndex = getCubeIndex(cubes)
+        # native reader of the data (lookup index from sidecar, if cached)
+        ffile = openFieldsFile(infile)
+        stage.add(fields=nVars)
+    # end of with metrics.stage('load') as stage:
+    try:
+        # cross-cycle cache of the regridded fields, only for the inputs which
+        # are re-read by the later cycles (previous cycle short forecast)
+        fieldCache = None
+        if planner.getCatalogEntry(_productCatalog_, fileName)['previousCycle']:
+            fieldCache = getFieldCache()
     
-    accumutationType = ['rain', 'precip', 'snow']
+        accumutationType = ['rain', 'precip', 'snow']
            
-    # open for-loop-1 -- for all the variables in the cube
-    for varName, varSTASH in varNamesSTASH:
-        # define variable name constraint
-        varConstraint = iris.Constraint(name=varName)
-        # define varibale stash code constraint
-        STASHConstraint = iris.AttributeConstraint(STASH=varSTASH)
-        # get the standard_name of variable 
-        stdNm = cubes.extract(varConstraint & STASHConstraint)[0].standard_name
-        print "stdNm", stdNm, fileName
-        if stdNm is None:
-            print "Unknown variable standard_name for '%s' of %s. So skipping it" % (varName, fileName)
-            continue
-        # end of if 'unknown' in stdNm: 
-        print "  Working on variable: %s \n" %stdNm
+        # open for-loop-1 -- for all the variables in the cube
+        for varName, varSTASH in varNamesSTASH:
+            # get the variable cube from the field index
+            with metrics.stage('extract'):
+                varCube = getIndexedCube(cubesIndex, varName, varSTASH)
+            if varCube is None:
+                _log_.warning("Couldn't find variable '%s' (%s) in %s. So skipping it", varName, varSTASH, fileName)
+                continue
+            # end of if varCube is None:
+            # get the standard_name of variable 
+            stdNm = varCube.standard_name
+            _log_.debug("stdNm %s %s", stdNm, fileName)
+            if stdNm is None:
+                _log_.warning("Unknown variable standard_name for '%s' of %s. So skipping it", varName, fileName)
+                continue
+            # end of if 'unknown' in stdNm: 
+            _log_.debug("  Working on variable: %s", stdNm)
+            # accumulated fields are regridded conservatively (area weighted),
+            # so that the total precipitation over the area is preserved.
+            regridMethod = 'linear'
+            for acc in accumutationType:
+                if acc in stdNm:
+                    regridMethod = 'conservative'
+                    break
+            # end of for acc in accumutationType:
         
-        for fhr in fcstHours:
-            # loop-2 -- runs through the selected time slices - synop hours                        
-            print "   Working on forecast time: ", fhr            
-            # grab the variable which is f(t,z,y,x)
-            # tmpCube corresponds to each variable for the SYNOP hours
-            print "extract start", infile, fhr, varName
-            
-            # get the varibale iris cube by applying variable name constraint, 
-            # variable stash code constraint and forecast hour -- Revamped by AAT
-            tmpCube = cubes.extract(varConstraint & STASHConstraint & iris.Constraint(forecast_period=fhr))[0]
-            print "extrad end", infile, fhr, varName
-            if do6HourlyMean and (tmpCube.coords('forecast_period')[0].shape[0] > 1):              
-                # grab the variable which is f(t,z,y,x)
-                # tmpCube corresponds to each variable for the SYNOP hours from
-                # start to end of short time period mean (say 3-hourly)                                
+            action = None
+            if do6HourlyMean:
                 action = 'mean'
-                cubeName = tmpCube.standard_name    
                 # to check either do we have to do accumutation or not.
                 for acc in accumutationType:
-                    if cubeName and acc in cubeName:
+                    if stdNm and acc in stdNm:
                         action = 'sum'
                         break 
                 # end of for acc in accumutationType:
+            # end of if do6HourlyMean:
+        
+            # forecast hours (fields) of this variable, which are to be converted
+            fields = []
+            for fi, fhr in enumerate(fcstHours):
+                if _doneUnits_ and all([manifest.getUnitKey(infile, varSTASH, fhr, domain) in _doneUnits_
+                                        for domain, box, targetGrid in _domains_]):
+                    _log_.debug("Already converted in earlier run %s %s %s", varName, fhr, fileName)
+                    continue
+                # end of if _doneUnits_ and ...:
+                fields.append((fi, fhr))
+            # end of for fi, fhr in enumerate(fcstHours):
+            if not fields: continue
+        
+            # cache keys (of every domain) of the regridded fields and the cached
+            # fields. those are opened (memory mapped, no data is read until its
+            # level is encoded) upfront, so that those can't be evicted by other
+            # worker after their read & average is skipped.
+            cacheKeys, cachedData = {}, {}
+            if fieldCache is not None:
+                with metrics.stage('field_cache') as stage:
+                    for fi, fhr in fields:
+                        cacheKeys[fi] = dict([(domain, getFieldCacheKey(infile, signature, varSTASH, fhr, action,
+                                                                        regridMethod, box, targetGrid))
+                                              for domain, box, targetGrid in _domains_])
+                        entries = dict([(domain, fieldCache.get(key)) for domain, key in cacheKeys[fi].items()])
+                        if None in entries.values(): continue
+                        cachedData[fi] = entries
+                        stage.add(fields=1)
+                    # end of for fi, fhr in fields:
+                # end of with metrics.stage('field_cache') as stage:
+                if cachedData: _log_.info("Reusing %d cached fields of '%s' of %s", len(cachedData), varName, fileName)
+            # end of if fieldCache is not None:
+        
+            meanCubes = None
+            if do6HourlyMean:
+                # grab the variable which is f(t,z,y,x) for all the windows.
+                # tmpCube corresponds to each variable for the SYNOP hours from
+                # start to end of short time period mean (say 3-hourly)
+                with metrics.stage('extract'):
+                    tmpCube = getIndexedCube(cubesIndex, varName, varSTASH, numpy.ravel(fcstHours))
+                if tmpCube is None:
+                    _log_.warning("Couldn't find forecast times of '%s' in %s. So skipping it", varName, fileName)
+                    continue
+                # end of if tmpCube is None:
+            
+                if tmpCube.coords('time', dim_coords=True):
+                    # convert 3-hourly mean data into 6-hourly mean or accumutation
+                    # of all the windows in one pass. the windows which are done
+                    # or cached need only the metadata.
+                    toAverage = set([fi for fi, fhr in fields]) - set(cachedData.keys())
+                    with metrics.stage('average') as stage:
+                        meanCubes = cubeWindowsAverager(tmpCube, fcstHours, action, intervals='6-hourly',
+                                                        skipData=set(range(len(fcstHours))) - toAverage)
+                        stage.add(fields=len(toAverage))
+                    # end of with metrics.stage('average') as stage:
+                    # make memory free of the done fields
+                    for fi in set(range(len(fcstHours))) - set([fi for fi, fhr in fields]):
+                        meanCubes[fi] = None
+                    # end of for fi in ...:
+                # end of if tmpCube.coords('time', dim_coords=True):
+                del tmpCube
+            # end of if do6HourlyMean:
+        
+            # the reader thread extracts & reads the level slices of the next
+            # fields (bounded buffer), while the current field is regridded.
+            # the cached fields are not read at all.
+            reader = prefetch.Prefetcher(iterFieldLevels(cubesIndex, varName, varSTASH, fields,
+                                                         meanCubes, fileName, ffile, set(cachedData.keys()),
+                                                         _prefetchDepth_ > 0),
+                                         _prefetchDepth_)
+            try:
+                for fi, fhr in fields:
+                    # loop-2 -- runs through the selected time slices - synop hours                        
+                    _log_.debug("   Working on forecast time: %s", fhr)
+                    # output domains of this unit, which are not converted yet
+                    domains = [(domain, box, targetGrid) for domain, box, targetGrid in _domains_
+                               if not (_doneUnits_ and manifest.getUnitKey(infile, varSTASH, fhr, domain) in _doneUnits_)]
+                    # stream one level at a time through read -> regrid -> encode
+                    # of all the domains. the encoding is done out of the lock, and the
+                    # location section is edited to point to the right RMC (centre 28,
+                    # subCentre 0).
+                    cached = cachedData.pop(fi, None)
+                    # writers of the domains, which are to be cached (level by level)
+                    writers = {}
+                    if fieldCache is not None and cached is None:
+                        for domain, box, targetGrid in domains:
+                            try:
+                                writers[domain] = fieldCache.writer(cacheKeys[fi][domain])
+                            except (IOError, OSError) as e:
+                                _log_.warning("Couldn't cache the regridded field %s %s (%s)", varName, fhr, e)
+                            # end of try:
+                        # end of for domain, box, targetGrid in domains:
+                    # end of if fieldCache is not None and cached is None:
+                    try:
+                        results = regridEncodeLevels(reader.group(fi), varName, varSTASH, regridMethod, domains,
+                                                     cached, writers)
+                        for domain, writer in writers.items():
+                            if results.get(domain, (None, None))[0] is None: continue
+                            with metrics.stage('field_cache') as stage:
+                                writer.commit()
+                                stage.add(fields=1, nbytes=writer.nbytes)
+                            # end of with metrics.stage('field_cache') as stage:
+                        # end of for domain, writer in writers.items():
+                    finally:
+                        # remove the incomplete entries (failed domains)
+                        for writer in writers.values(): writer.abort()
+                    # end of try:
+                    del cached, writers
+                    for domain, box, targetGrid in domains:
+                        # every output (sub)domain is saved into its own outfiles.
+                        messages, regdCube = results.get(domain, (None, None))
+                        if messages is None: continue
+                        _log_.debug("regrid & encode done, %d messages", len(messages))
+            
+                        # get the regridded lat/lons
+                        stdNm, fcstTm, refTm, lat1, lon1 = getCubeAttr(regdCube)
 
-                # convert 3-hourly mean data into 6-hourly mean or accumutation
-                tmpCube = cubeAverager(tmpCube, action, intervals='6-hourly')            
-            # end ofif do6HourlyMean and tmpCube.coords('forecast_period')[0].shape[0] > 1:     
-
-            # interpolate it 0,25 deg resolution by setting up sample points based on coord
-            print "\n    Regridding data to 0.25x0.25 deg spatial resolution \n"
-            print "From shape", tmpCube.shape
-            try:            
-                regdCube = tmpCube.interpolate(_targetGrid_, iris.analysis.Linear())
-            except Exception as e:
-                print "ALERT !!! Error while regridding!! %s" % str(e)
-                print " So skipping this without saving data"
-                continue
-            # end of try:   
-            print "regrid done"
-            print "To shape", regdCube.shape  
+                        # save the cube in append mode as a grib2 file       
+                        if outfile == 'um_prg':
+                            if fcstTm.bounds is not None:
+                                # get the last hour bound ## need this for pf files.                
+                                hr = str(int(fcstTm.bounds[-1][-1]))     
+                                _log_.debug("Bounds comes in %s %s %s", hr, fcstTm.bounds, fileName)
+                            else:
+                                # get the fcst time point 
+                                hr = str(int(fcstTm.points))
+                                _log_.debug("points comes in %s %s", hr, fileName)
+                            # end of if fcstTm.bounds:
+                        else:
+                            # get the hour from infile path as 'least dirname'
+                            hr = _inDataPath_.split('/')[-1]
+                        # end of if outfile == 'um_prg':
             
-            # reset the attributes 
-            regdCube.attributes = tmpCube.attributes
-              
-            # make memory free 
-            del tmpCube
+                        outFn = getOutFileName(outfile, hr, domain)
+                        _log_.debug("Going to be save into %s", outFn)
             
-            # get the regridded lat/lons
-            stdNm, fcstTm, refTm, lat1, lon1 = getCubeAttr(regdCube)
-
-            # save the cube in append mode as a grib2 file       
-            if _inDataPath_.endswith('00'):
-                if fcstTm.bounds is not None:
-                    # get the last hour bound ## need this for pf files.                
-                    hr = str(int(fcstTm.bounds[-1][-1]))     
-                    print "Bounds comes in ", hr, fcstTm.bounds, fileName       
-                else:
-                    # get the fcst time point 
-                    hr = str(int(fcstTm.points))
-                    print "points comes in ", hr, fileName 
-                # end of if fcstTm.bounds:
-            else:
-                # get the hour from infile path as 'least dirname'
-                hr = _inDataPath_.split('/')[-1]
-            # end of if _inDataPath_.endswith('00'):
+                        # order rank of this variable within the outfile
+                        rank = getVarOrderRank(varName, varSTASH, bool(regdCube.coords('pressure')))
+                        # make memory free 
+                        del regdCube
             
-            outFn = outfile +'_'+ hr.zfill(3) +'hr'+ '_' + _current_date_ + _fext_ + '.grib2'
-            outFn = os.path.join(_opPath_, outFn)
-            print "Going to be save into ", outFn
-                        
-            try:                
-                # lock other threads / processors from being access same file 
-                # to write other variables
-                lock.acquire()
-                iris.save(regdCube, outFn, append=True)
-                # release the lock, let other threads/processors access this file.
-                lock.release()
-            except iris.exceptions.TranslationError as e:
-                if str(e) == "The vertical-axis coordinate(s) ('soil_model_level_number') are not recognised or handled.":  
-                    regdCube.remove_coord('soil_model_level_number') 
-                    print "Removed soil_model_level_number from cube, due to error %s" % str(e)
-                    # create lock object
-                    lock = mp.Lock()
-                    # lock other threads / processors from being access same file 
-                    # to write other variables
-                    lock.acquire()
-                    iris.save(regdCube, outFn, append=True)
-                    # release the lock, let other threads/processors access this file.
-                    lock.release()
-                else:
-                    print "ALERT !!! Got error while saving, %s" % str(e)
-                    print " So skipping this without saving data"
-                    continue
-            except Exception as e:
-                print "ALERT !!! Error while saving!! %s" % str(e)
-                print " So skipping this without saving data"
-                continue
+                        try:
+                            if _outputMode_ == 'shard':
+                                # lock free, no other task writes into this shard file
+                                shardFn = getShardFileName(outFn, taskName)
+                                with metrics.stage('save') as stage:
+                                    positions = grib2io.appendShard(shardFn, messages, rank, varName, varSTASH)
+                                    commitUnit(infile, signature, varSTASH, fhr, domain, outFn, shardFn, positions, rank)
+                                    stage.add(fields=len(positions), nbytes=sum([length for offset, length in positions]))
+                                # end of with metrics.stage('save') as stage:
+                            elif _outputMode_ == 'writer':
+                                # no lock, the writer process appends & commits the unit
+                                with metrics.stage('save') as stage:
+                                    _writer_.append(outFn, rank, messages, (infile, signature, varSTASH, fhr, domain))
+                                    stage.add(fields=len(messages), nbytes=sum([len(message) for message, keys in messages]))
+                                # end of with metrics.stage('save') as stage:
+                            else:
+                                # lock other threads / processors from being access same file 
+                                # to write other variables
+                                with metrics.stage('lock_wait'):
+                                    lock.acquire()
+                                try:
+                                    with metrics.stage('save') as stage:
+                                        positions = grib2io.appendMessages(outFn, messages)
+                                        # commit while holding the lock, so that the recorded
+                                        # end offset is the committed end of the outFn.
+                                        commitUnit(infile, signature, varSTASH, fhr, domain, outFn, outFn, positions, rank)
+                                        stage.add(fields=len(positions), nbytes=sum([length for offset, length in positions]))
+                                    # end of with metrics.stage('save') as stage:
+                                finally:
+                                    # release the lock, let other threads/processors access this file.
+                                    lock.release()
+                            # end of if _outputMode_ == 'shard':
+                        except Exception as e:
+                            _log_.error("ALERT !!! Error while saving!! %s. So skipping this without saving data", e)
+                            continue
+                        # end of try:
+                        _log_.debug("saved")
+                        metrics.appendInfo('outfiles', outFn)
+                        del messages
+                    # end of for domain, box, targetGrid in domains:
+                # end of for fi, fhr in fields:
+            finally:
+                # stop the reader (if this task is failed)
+                reader.close()
             # end of try:
-            print "saved"
-            # make memory free 
-            del regdCube
-            
-            ## edit location section in grib2 to point to the right RMC
-            # gribapi.grib_set(outFn,'centre','28')
-            gribapi.grib_set_long(gribid, "centre", 28)  # RMC of India
-            gribapi.grib_set_long(gribid, "subCentre", 0)  # exeter is not in the spec
-            os.system('source /gpfs2/home/umtid/test/grb_local_section.sh')
-        # end of for fhr in fcstHours:
-    # end of for varName, varSTASH in varNamesSTASH:
+        # end of for varName, varSTASH in varNamesSTASH:
+    finally:
+        # close the memory map (even if this task is failed)
+        if ffile is not None: ffile.close()
+    # end of try:
     # make memory free
-    del cubes
+    del cubes, cubesIndex
+    metrics.finishTask()
     
-    print "  Time taken to convert the file: %8.5f seconds \n" %(time.time()-_startT_)
-    print " Finished converting file: %s into grib2 format for fcst file: %s \n" %(fileName,hr)
+    _log_.info("  Time taken to convert the file: %8.5f seconds", time.time() - _startT_)
+    _log_.info(" Finished converting file: %s into grib2 format for fcst file: %s", fileName, hr)
 # end of def regridAnlFcstFiles(fname): def #5
 
+# start definition #46
+def iterFieldLevels(cubesIndex, varName, varSTASH, fields, meanCubes=None, fileName='', ffile=None,
+                    cached=(), background=False):
+    """
+    This definition is the generator of the level slices of the fields of a
+    variable, which is run by the reader thread (see prefetch.Prefetcher),
+    i.e. it extracts the field of every forecast hour and realises (reads)
+    the data of its 2-D (latitude, longitude) slices one after another.
+    :param cubesIndex: field index of the cubes (see getCubeIndex).
+    :param varName: variable name.
+    :param varSTASH: variable STASH code.
+    :param fields: list of (index, forecast hour) to be converted.
+    :param meanCubes: (optional) already averaged cubes of the forecast hours.
+    :param fileName: input filename (for logging).
+    :param ffile: (optional) native reader of the input file (see
+                  openFieldsFile), else the data is read by iris.
+    :param cached: indices of the fields whose regridded data is cached, so
+                   their level slices are yielded without reading the data.
+    :param background: True, if it is run by the reader thread. Then its
+                       stages are recorded as prefetch_extract & prefetch_read,
+                       since those overlap the stages of the task (whose wait
+                       for the reader is read_wait).
+    :return: yields (index, level slice cube with realised data).
+    """
+    stagePrefix = metrics._backgroundPrefix_ if background else ''
+    for fi, fhr in fields:
+        # grab the variable which is f(t,z,y,x)
+        # tmpCube corresponds to each variable for the SYNOP hours
+        _log_.debug("extract start %s %s %s", fileName, fhr, varName)
+        if meanCubes is not None:
+            # already averaged
+            tmpCube = meanCubes[fi]
+            meanCubes[fi] = None
+        else:
+            # get the varibale iris cube from the field index by variable
+            # name, variable stash code and forecast hour -- Revamped by AAT
+            with metrics.stage(stagePrefix + 'extract'):
+                tmpCube = getIndexedCube(cubesIndex, varName, varSTASH, fhr)
+        # end of if meanCubes is not None:
+        _log_.debug("extract end %s %s %s", fileName, fhr, varName)
+        if tmpCube is None:
+            _log_.warning("Couldn't find forecast time %s of '%s' in %s. So skipping it", fhr, varName, fileName)
+            continue
+        # end of if tmpCube is None:
+        _log_.debug("From shape %s", tmpCube.shape)
+        for levCube in tmpCube.slices(['latitude', 'longitude']):
+            if fi in cached:
+                # only the metadata is needed
+                yield fi, levCube
+                continue
+            # end of if fi in cached:
+            with metrics.stage(stagePrefix + 'read') as stage:
+                # realise the lazy data of this slice only here (instead of
+                # within regrid), so that the read from disk is timed separately.
+                if ffile is not None and levCube.has_lazy_data():
+                    data = getNativeLevelData(ffile, levCube)
+                    if data is not None: levCube.data = data
+                # end of if ffile is not None and ...:
+                stage.add(fields=1, nbytes=levCube.data.nbytes)
+            # end of with metrics.stage(stagePrefix + 'read') as stage:
+            yield fi, levCube
+        # end of for levCube in tmpCube.slices(['latitude', 'longitude']):
+        # make memory free 
+        del tmpCube
+    # end of for fi, fhr in fields:
+# end of def iterFieldLevels(...): #46
+
+# start definition #47
+def openFieldsFile(infile):
+    """
+    This definition opens the native memory mapped reader of the input
+    fieldsfile, whose lookup index is cached in the _tmpDir_/lookupIndex
+    directory (so the next open of the same file, say previous cycle umglca
+    file of every analysis hour, doesn't parse the lookup table again).
+    :param infile: input file path.
+    :return: fieldsfile.FieldsFile or None (if disabled or not a fieldsfile,
+             say pp file, so that the data is read by iris).
+    """
+    global _nativeReader_, _tmpDir_
+    
+    if not _nativeReader_: return None
+    cacheDir = os.path.join(_tmpDir_, 'lookupIndex') if _tmpDir_ else None
+    try:
+        return fieldsfile.FieldsFile(infile, cacheDir)
+    except (IOError, OSError, ValueError) as e:
+        _log_.debug("Native reader is not available for %s (%s)", infile, e)
+        return None
+    # end of try:
+# end of def openFieldsFile(infile): #47
+
+# start definition #48
+def getNativeLevelData(ffile, levCube):
+    """
+    This definition reads the data of the 2-D level slice by the native
+    reader, i.e. it finds the lookup record of the slice by its (STASH,
+    forecast period, level) and serves its data. The unpacked fields are read
+    straight from the memory map, but the big endian UM output is converted
+    into the native byte order (one copy of the field, as iris does too).
+    The missing data is masked as iris does (exact bmdi values).
+    :param ffile: fieldsfile.FieldsFile of the input file.
+    :param levCube: 2-D (latitude, longitude) level slice cube with lazy data.
+    :return: numpy (masked) array or None (if there is no unique instantaneous
+             record of the slice or the record is not decoded alike by iris,
+             see fieldsfile.FieldsFile.getData, so that the data is read by
+             iris).
+    """
+    STASH = levCube.attributes.get('STASH')
+    if STASH is None or levCube.cell_methods: return None
+    fp = levCube.coords('forecast_period')
+    if not fp or fp[0].bounds is not None: return None
+    lbft = int(round(fp[0].units.convert(fp[0].points[0], 'hours')))
+    lblev, blev = None, None
+    if levCube.coords('pressure'):
+        pressure = levCube.coord('pressure')
+        blev = pressure.units.convert(pressure.points[0], 'hPa')
+    elif levCube.coords('model_level_number'):
+        lblev = int(levCube.coord('model_level_number').points[0])
+    # end of if levCube.coords('pressure'):
+    records = ffile.find(STASH.section * 1000 + STASH.item, lbft, lblev, blev, lbproc=0)
+    if len(records) != 1: return None
+    try:
+        data = ffile.getData(records[0])
+    except ValueError as e:
+        _log_.debug("Native reader couldn't read %s (%s)", STASH, e)
+        return None
+    # end of try:
+    if data.shape != levCube.shape: return None
+    # copy only if the file is not of native byte order (say big endian UM
+    # output on the little endian nodes)
+    data = numpy.asarray(data, dtype=data.dtype.newbyteorder('='))
+    bmdi = records[0]['bmdi']
+    if (data == bmdi).any(): data = numpy.ma.masked_values(data, bmdi, copy=False)
+    return data
+# end of def getNativeLevelData(ffile, levCube): #48
+
+# start definition #49
+def getFieldCache():
+    """
+    This definition returns the cross-cycle cache of the regridded fields
+    (fieldcache.FieldCache in the _fieldCacheDir_) of this process or None if
+    it is disabled. One instance per process, so that its size estimate
+    spares the rescans of the cache directory.
+    """
+    global _fieldCacheDir_, _fieldCacheSize_, _fieldCache_
+    
+    if not _fieldCacheDir_ or not _fieldCacheSize_: return None
+    if _fieldCache_ is not None and _fieldCache_.cacheDir == _fieldCacheDir_:
+        _fieldCache_.maxBytes = _fieldCacheSize_
+        return _fieldCache_
+    # end of if _fieldCache_ is not None and ...:
+    try:
+        _fieldCache_ = fieldcache.FieldCache(_fieldCacheDir_, _fieldCacheSize_)
+        return _fieldCache_
+    except OSError as e:
+        _log_.warning("Field cache is not available in %s (%s)", _fieldCacheDir_, e)
+        return None
+    # end of try:
+# end of def getFieldCache(): #49
+
+# start definition #50
+def getFieldCacheKey(infile, signature, varSTASH, fhr, action, method, box, targetGrid):
+    """
+    This definition returns the field cache key of the regridded field, i.e.
+    of the input content (path, size & mtime), STASH, forecast hour (or
+    window), time processing, regridding method and target grid.
+    :param signature: (size, mtime) of infile (see manifest.getInputSignature).
+    :param action: time processing of the window ('mean' or 'sum') or None
+                   for the instantaneous field.
+    :param box: subdomain box of the target grid (None is global).
+    """
+    grid = dict(targetGrid)
+    return fieldcache.makeKey(os.path.abspath(infile), tuple(signature), str(varSTASH),
+                              tuple(numpy.ravel(fhr).astype(float).tolist()), action, method,
+                              box, numpy.asarray(grid['latitude'], dtype=numpy.float64),
+                              numpy.asarray(grid['longitude'], dtype=numpy.float64))
+# end of def getFieldCacheKey(...): #50
+
+# start definition #31
+def regridEncodeLevels(levCubes, varName, varSTASH, method='linear', domains=None, cached=None,
+                       writers=None):
+    """
+    This definition streams the field one 2-D (latitude, longitude) slice at
+    a time (say one pressure level of 18 levels pd field) through regrid ->
+    GRIB2 encode, so that the peak memory is bounded by few 2-D slices
+    instead of the whole 3-D field. Every slice is read only once (by the
+    reader thread, see iterFieldLevels) and regridded to all the output
+    domains. Only the encoded messages (packed, much smaller than the
+    regridded fields) of all the levels are kept, so that the caller writes
+    all the messages of the unit in one append (i.e. the manifest commit of
+    the unit is atomic).
+    :param levCubes: iterable of the level slices (with realised data) of one
+                     forecast hour.
+    :param varName: variable name (for its packing policy, see getVarPacking).
+    :param varSTASH: variable STASH code.
+    :param method: regridding method, 'linear' or 'conservative' (for the
+                   accumulated fields).
+    :param domains: list of (domain, box, targetGrid) of the output domains
+                    (default is _domains_).
+    :param cached: (optional) dictionary of domain and its cached regridded
+                   levels (see fieldcache.FieldCache.get), which are encoded
+                   instead of regridding the level slices again.
+    :param writers: (optional) dictionary of domain and its field cache writer
+                    (see fieldcache.FieldWriter), to which the regridded data of
+                    every level is appended.
+    :return: dictionary of domain and its (list of (message bytes, keys)
+             tuples, regridded cube of the last slice for its metadata) or
+             (None, None) on error.
+    """
+    global _domains_
+    
+    if domains is None: domains = _domains_
+    results = dict([(domain, ([], None)) for domain, box, targetGrid in domains])
+    packing = None
+    levCubes = iter(levCubes)
+    li = -1
+    while True:
+        # time of waiting for the reader, which is not hidden by the compute
+        with metrics.stage('read_wait'):
+            levCube = next(levCubes, None)
+        if levCube is None: break
+        li += 1
+        if packing is None:
+            packing = getVarPacking(varName, varSTASH, bool(levCube.coords('pressure')))
+        for domain, box, targetGrid in domains:
+            messages, regdCube = results[domain]
+            # skip the domain, which is failed in earlier level
+            if messages is None: continue
+            # every output (sub)domain is regridded from its own source window
+            domCube = getDomainCube(levCube, box)
+            regdData = None
+            if cached and domain in cached:
+                # the data of the cached field is not read (nor averaged)
+                if li >= len(cached[domain]):
+                    _log_.error("ALERT !!! Cached field of %s has only %d levels. So skipping this "
+                                "without saving data", varName, len(cached[domain]))
+                    results[domain] = (None, None)
+                    continue
+                # end of if li >= len(cached[domain]):
+                regdData = fieldcache.getLevel(cached[domain], li)
+            # end of if cached and domain in cached:
+            levMessages, regdCube = regridEncodeLevel(domCube, packing, method, targetGrid, regdData)
+            del domCube
+            if levMessages is None:
+                results[domain] = (None, None)
+                continue
+            # end of if levMessages is None:
+            if writers and domain in writers:
+                try:
+                    writers[domain].append(regdCube.data)
+                except (IOError, OSError) as e:
+                    _log_.warning("Couldn't cache the regridded field %s (%s)", varName, e)
+                    writers.pop(domain).abort()
+                # end of try:
+            # end of if writers and domain in writers:
+            messages.extend(levMessages)
+            results[domain] = (messages, regdCube)
+        # end of for domain, box, targetGrid in domains:
+        # make memory free 
+        del levCube
+    # end of while True:
+    for domain in results.keys():
+        # no level at all (say missing forecast hour)
+        if results[domain][1] is None: results[domain] = (None, None)
+    # end of for domain in results.keys():
+    return results
+# end of def regridEncodeLevels(levCubes, varName, varSTASH, method='linear', domains=None, ...): #31
+
+# start definition #45
+def regridEncodeLevel(levCube, packing=None, method='linear', targetGrid=None, regdData=None):
+    """
+    This definition regrids and encodes one 2-D (latitude, longitude) slice.
+    :param levCube: Iris cube of one level (with realised data).
+    :param packing: GRIB2 packing policy of the variable (see getVarPacking).
+    :param method: regridding method, 'linear' or 'conservative'.
+    :param targetGrid: target grid of the output domain (default is the
+                       global _targetGrid_).
+    :param regdData: (optional) already regridded data of the level (say
+                     from the field cache), so levCube is not regridded.
+    :return: (list of (message bytes, keys) tuples, regridded cube) or
+             (None, None) on error.
+    """
+    global _targetGrid_, _regridWeightsDir_
+    
+    if targetGrid is None: targetGrid = _targetGrid_
+    try:
+        # apply the cached sparse bilinear (same as iris Linear) or
+        # area weighted (same as iris AreaWeighted) weights
+        if regdData is not None:
+            # cached regridded data with the metadata of levCube
+            regdCube = regridder.makeRegriddedCube(levCube, targetGrid, regdData)
+        else:
+            with metrics.stage('interpolate') as stage:
+                regdCube = regridder.regrid(levCube, targetGrid,
+                                            cacheDir=_regridWeightsDir_, method=method)
+                stage.add(fields=1, nbytes=regdCube.data.nbytes)
+            # end of with metrics.stage('interpolate') as stage:
+        # end of if regdData is not None:
+    except Exception as e:
+        _log_.error("ALERT !!! Error while regridding!! %s. So skipping this without saving data", e)
+        return None, None
+    # end of try:
+    # reset the attributes 
+    regdCube.attributes = levCube.attributes
+    
+    try:
+        with metrics.stage('encode'):
+            levMessages = grib2io.encodeCube(regdCube, packing=packing)
+    except iris.exceptions.TranslationError as e:
+        if str(e) == "The vertical-axis coordinate(s) ('soil_model_level_number') are not recognised or handled.":  
+            regdCube.remove_coord('soil_model_level_number') 
+            _log_.info("Removed soil_model_level_number from cube, due to error %s", e)
+            with metrics.stage('encode'):
+                levMessages = grib2io.encodeCube(regdCube, packing=packing)
+        else:
+            _log_.error("ALERT !!! Got error while saving, %s. So skipping this without saving data", e)
+            return None, None
+    except Exception as e:
+        _log_.error("ALERT !!! Error while saving!! %s. So skipping this without saving data", e)
+        return None, None
+    # end of try:
+    metrics.stage('encode').add(fields=len(levMessages),
+                                nbytes=sum([len(message) for message, keys in levMessages]))
+    return levMessages, regdCube
+# end of def regridEncodeLevel(levCube, packing=None, method='linear', targetGrid=None, ...): #45
+
+# start definition #25
+def commitUnit(infile, signature, varSTASH, fhr, domain, outFn, target, positions, rank=None):
+    """
+    This definition records the completed unit (input file, STASH, forecast
+    hour, output domain) into the task manifest, after its messages are
+    written.
+    :param infile: input file path.
+    :param signature: (size, mtime) of the infile while it was read.
+    :param varSTASH: variable STASH code.
+    :param fhr: forecast hour (or window of forecast hours).
+    :param domain: subdomain name (None is the global domain).
+    :param outFn: unordered outfile path.
+    :param target: file path into which the messages are written.
+    :param positions: list of (offset, length) of the written messages.
+    :param rank: variable order rank of the messages (see getVarOrderRank),
+                 which is used to re-order the target (see getMessageRanker).
+    """
+    global _manifestPath_
+    if _manifestPath_ is None or not positions: return
+    offset, length = positions[-1]
+    manifest.addUnit(_manifestPath_, infile, signature, varSTASH, fhr, outFn,
+                     target, offset + length, domain, positions[0][0], rank)
+# end of def commitUnit(...): #25
+
 # start definition #6
 def getYdayStr(today):
     """
@@ -714,6 +1566,67 @@ def getYdayStr(today):
     return yDay
 # end of def getYdayStr(today).. #6
 
+# start definition #17
+def getVarOrderRank(varName, varSTASH, isPressureLevel):
+    """
+    This definition returns the rank (position) of the variable in the
+    order we want to write into grib2 (as per _orderedVars_). Pressure
+    level variables come first and then non pressure level variables.
+    Unknown variables are ranked at the end.
+    :param varName: variable name
+    :param varSTASH: variable STASH code
+    :param isPressureLevel: True if the variable has pressure coordinate.
+    :return: rank as integer.
+    """
+    global _orderedVars_
+    pressureVars = _orderedVars_['PressureLevel']
+    nonPressureVars = _orderedVars_['nonPressureLevel']
+    if isPressureLevel:
+        offset, orderedVars = 0, pressureVars
+    else:
+        offset, orderedVars = len(pressureVars), nonPressureVars
+    # end of if isPressureLevel:
+    # STASH code is more specific than name (say relative_humidity)
+    for idx, var in enumerate(orderedVars):
+        if var[1] == str(varSTASH): return offset + idx
+    for idx, var in enumerate(orderedVars):
+        if var[0] == varName: return offset + idx
+    
+    return len(pressureVars) + len(nonPressureVars)
+# end of def getVarOrderRank(varName, varSTASH, isPressureLevel): #17
+
+# start definition #32
+def getVarPacking(varName, varSTASH, isPressureLevel):
+    """
+    This definition returns the GRIB2 packing policy of the variable (as per
+    the 3rd item of its _orderedVars_ entry). Unknown variables (and the
+    entries without policy) get the 'default' policy.
+    :param varName: variable name
+    :param varSTASH: variable STASH code
+    :param isPressureLevel: True if the variable has pressure coordinate.
+    :return: packing dictionary (see grib2io.setPacking) or None.
+    """
+    global _orderedVars_, _packingPolicies_
+    orderedVars = _orderedVars_['PressureLevel'] + _orderedVars_['nonPressureLevel']
+    rank = getVarOrderRank(varName, varSTASH, isPressureLevel)
+    policy = 'default'
+    if rank < len(orderedVars) and len(orderedVars[rank]) > 2:
+        policy = orderedVars[rank][2]
+    return _packingPolicies_[policy]
+# end of def getVarPacking(varName, varSTASH, isPressureLevel): #32
+
+# start definition #18
+def getShardFileName(outFn, taskName):
+    """
+    This definition returns the shard file path of the task for the outFn.
+    :param outFn: unordered outfile path (with _fext_).
+    :param taskName: unique name of the task (say umglaa_pb024).
+    """
+    global _shardDir_, _fext_
+    prefix = os.path.basename(outFn).split(_fext_)[0]
+    return os.path.join(_shardDir_, prefix + '.' + taskName + '.shard.grib2')
+# end of def getShardFileName(outFn, taskName): #18
+
 # start definition #7
 def doShuffleVarsInOrder(fpath):
     """
@@ -724,56 +1637,153 @@ def doShuffleVarsInOrder(fpath):
     with g2ctl.pl and gribmap scripts for the ordered grib2 files.
     Arulalan/T
     11-12-2015
+    Now the messages are re-ordered at byte level. i.e. It scans the message
+    boundaries and section-4 keys only and copies the raw message bytes in
+    the order of _orderedVars_, without decoding/encoding data values.
+    :param fpath: unordered outfile path (with _fext_).
+    :return: list of (offset, length, keys) of the messages of the ordered
+             grib2 file (None on failure).
     """
-    global _orderedVars_, _fext_
+    global _orderedVars_, _fext_, _manifestPath_, _finishedFiles_
+    newfilefpath = fpath.split(_fext_)[0] + '.grib2'
+    if fpath in _finishedFiles_ and os.path.isfile(newfilefpath):
+        # already re-ordered in the earlier run
+        _log_.info("Already re-ordered in earlier run %s", newfilefpath)
+        return grib2io.scanMessages(newfilefpath)
+    # end of if fpath in _finishedFiles_ and ...:
+    metrics.startTask(os.path.basename(fpath), 'shuffle', outfile=fpath)
     # checks
     try:
-        f = iris.load(fpath)
+        with metrics.stage('scan'):
+            records = grib2io.scanMessages(fpath)
     except gribapi.GribInternalError as e:
         if str(e) == "Wrong message length":
-            print "ALERT!!!! ERROR!!! Couldn't read grib2 file to re-order", e
+            _log_.error("ALERT!!!! ERROR!!! Couldn't read grib2 file to re-order %s", e)
         else:
-            print "ALERT!!! ERROR!!! couldn't read grib2 file to re-order", e
-        return 
+            _log_.error("ALERT!!! ERROR!!! couldn't read grib2 file to re-order %s", e)
+        metrics.finishTask('failed')
+        return None
     except Exception as e:
-        print "ALERT!!! ERROR!!! couldn't read grib2 file to re-order", e
-        return 
+        _log_.error("ALERT!!! ERROR!!! couldn't read grib2 file to re-order %s", e)
+        metrics.finishTask('failed')
+        return None
     # end of try:
-
-    # get only the pressure coordinate variables
-    unOrderedPressureLevelVars = [i for i in f if len(i.coords('pressure')) == 1]
-
-    # get only the non pressure coordinate variables
-    unOrderedNonPressureLevelVars = list(set(f) - set(unOrderedPressureLevelVars))
-    
-    # generate dictionary (standard_name, STASH) as key and cube variable as value
-    unOrderedPressureLevelVars = {i.standard_name: i for i in unOrderedPressureLevelVars}
-    unOrderedNonPressureLevelVars = {i.standard_name: i for i in unOrderedNonPressureLevelVars}
-    
-    # need to store the ordered variables in this empty list
-    orderedVars = []
-    for name, STASH in _orderedVars_['PressureLevel']:
-        if name in unOrderedPressureLevelVars: orderedVars.append(unOrderedPressureLevelVars[name])
-    # end of for name, STASH in _orderedVars_['PressureLevel']:
     
-    for name, STASH in _orderedVars_['nonPressureLevel']:
-        if name in unOrderedNonPressureLevelVars: orderedVars.append(unOrderedNonPressureLevelVars[name])
-    # end of for name, STASH in _orderedVars_['PressureLevel']:
-    
-    newfilefpath = fpath.split(_fext_)[0] + '.grib2'
+    # sort the messages by order of variables (pressure level variables
+    # first and then non pressure level variables). sort is stable, so the
+    # levels order within a variable is kept as it is.
+    ranker = getMessageRanker(fpath)
+    records.sort(key=lambda record: ranker(record[0], record[-1]))
 
-    # now lets save the ordered variables into same file
+    # now lets copy the ordered messages into new file
     try:
-        iris.save(orderedVars, newfilefpath)
+        with metrics.stage('shuffle') as stage:
+            written = grib2io.copyMessages(fpath, records, newfilefpath)
+            stage.add(fields=len(written), nbytes=sum([record[1] for record in written]))
+        # end of with metrics.stage('shuffle') as stage:
     except Exception as e:
-        print "ALERT !!! Error while saving orderd variables into grib2!! %s" % str(e)
-        print " So skipping this without saving data"
-        return
+        _log_.error("ALERT !!! Error while saving orderd variables into grib2!! %s. So skipping this without saving data", e)
+        metrics.finishTask('failed')
+        return None
     # end of try:
     # remove the older file 
     os.remove(fpath)
     
-    print "Created the variables in ordered fassion and saved into", newfilefpath
+    _log_.info("Created the variables in ordered fassion and saved into %s", newfilefpath)
+    if _manifestPath_ is not None: manifest.addFinished(_manifestPath_, fpath, newfilefpath)
+    
+    # create ctl & idx files
+    with metrics.stage('ctl'):
+        createGrADSCtlIdx(newfilefpath, written)
+    metrics.finishTask()
+    return written
+# end definition #7 -- doShuffleVarsInOrder(fpath):
+
+# start definition #21
+def getGribOrderRank(keys):
+    """
+    This definition returns the rank (position) of the grib2 message in the
+    order we want to write into grib2 (as per _orderedVars_), by its
+    section-4 keys. The GRIB2 parameter codes of the _orderedVars_ are taken
+    from the iris CF to GRIB2 translation table (the same which is used to
+    save). Unknown messages are ranked at the end.
+    It is only the fallback of getMessageRanker for the messages without
+    recorded rank (units of the older manifests), since the parameter codes
+    are not unique (say surface_temperature and 1.5m air_temperature both
+    are TMP), i.e. the first one of those wins.
+    :param keys: message keys dictionary (as returned by grib2io.getMessageKeys)
+    :return: rank as integer.
+    """
+    global _orderedVars_, _gribParamRanks_
+    if _gribParamRanks_ is None:
+        from iris.fileformats.grib import grib_phenom_translation as gptx
+        _gribParamRanks_ = {}
+        rank = 0
+        for isPressureLevel, level in [(True, 'PressureLevel'), (False, 'nonPressureLevel')]:
+            for var in _orderedVars_[level]:
+                info = gptx.cf_phenom_to_grib2_info(var[0])
+                if info is not None:
+                    key = (isPressureLevel, info.discipline, info.category, info.number)
+                    # first one wins, if the same parameter repeats
+                    _gribParamRanks_.setdefault(key, rank)
+                # end of if info is not None:
+                rank += 1
+            # end of for var in _orderedVars_[level]:
+        # end of for isPressureLevel, level in [...]:
+    # end of if _gribParamRanks_ is None:
+    
+    key = (keys['typeOfFirstFixedSurface'] == 100, keys['discipline'],
+           keys['parameterCategory'], keys['parameterNumber'])
+    return _gribParamRanks_.get(key, len(_orderedVars_['PressureLevel']) +
+                                     len(_orderedVars_['nonPressureLevel']))
+# end of def getGribOrderRank(keys): #21
+
+# start definition #51
+def getMessageRanker(target):
+    """
+    This definition returns the ranker of the messages of the target file,
+    i.e. function(offset, keys), which returns the variable order rank of
+    the message at offset, as recorded (by commitUnit) in the manifest for
+    the unit which has written it. The messages without recorded rank are
+    ranked by its section-4 keys (see getGribOrderRank).
+    :param target: file path into which the messages are written.
+    """
+    global _manifestPath_
+    units = manifest.getRanks(_manifestPath_, target) if _manifestPath_ else []
+    starts = [start for start, end, rank in units]
+    
+    def ranker(offset, keys):
+        ui = bisect.bisect_right(starts, offset) - 1
+        if ui >= 0 and offset < units[ui][1]: return units[ui][2]
+        return getGribOrderRank(keys)
+    # end of def ranker(offset, keys):
+    return ranker
+# end of def getMessageRanker(target): #51
+
+# start definition #19
+def createGrADSCtlIdx(newfilefpath, records=None):
+    """
+    It generates GrADS ctl file for easier access with GrADS and idx file of
+    the ordered grib2 file. In 'native' _ctlMode_, the ctl & idx are written
+    directly from the message offsets & keys of the writer (records), without
+    re-reading the data. In 'g2ctl' _ctlMode_, it uses g2ctl.pl and gribmap
+    scripts.
+    :param newfilefpath: ordered grib2 file path.
+    :param records: list of (offset, length, keys) of the messages of
+                    newfilefpath. If None, then it scans the file headers.
+    """
+    global _ctlMode_, _ctlTemplate_
+    if _ctlMode_ == 'native':
+        if _ctlTemplate_ and 'um_prg' in newfilefpath:
+            # templated ctl of all forecast files will be created at the end
+            return
+        if records is None:
+            records = grib2io.scanMessages(newfilefpath)
+        useInitialTime = 'um_ana' in newfilefpath
+        ctlfile = gradsctl.writeCtlIdx(newfilefpath, records, useInitialTime)
+        _log_.info("Successfully created control and index file natively ! %s", ctlfile)
+        return
+    # end of if _ctlMode_ == 'native':
     
     ## g2ctl.pl usage option refer the below link 
     ## https://tuxcoder.wordpress.com/2011/08/31/how-to-install-g2ctl-pl-and-wgrib2-in-linux/
@@ -791,256 +1801,957 @@ def doShuffleVarsInOrder(fpath):
     else:
         raise ValueError("unknown file type while executing g2ctl.pl!!")
     
-    print "Successfully created control and index file using g2ctl !", newfilefpath+'.ctl'
-# end definition #7 -- doShuffleVarsInOrder(fpath):
+    _log_.info("Successfully created control and index file using g2ctl ! %s", newfilefpath + '.ctl')
+# end definition #19 -- createGrADSCtlIdx(newfilefpath, records=None):
 
-# start definition #8
-def doShuffleVarsInOrderInParallel(ftype, simulated_hr):
+# start definition #20
+def doConcatShards(fpath):
     """
-    What does this definition do?
-    This definition re-rders/shuffles the way the variables are written
-    based on the type of the input file - forecast or analysis! and the
-    hour it is based on.
-    Written by AAT
-    :param ftype:
-    :param simulated_hr:
-    :return: None
+    This definition is the 'shard' output mode counterpart of
+    doShuffleVarsInOrder. It concatenates the shard files of all the tasks
+    of the outfile into the ordered grib2 file (in the order of variables,
+    without decoding the messages), removes the shards and then generates
+    GrADS ctl and idx files.
+    :param fpath: unordered outfile path (with _fext_).
+    :return: list of (offset, length, keys) of the messages of the ordered
+             grib2 file (None on failure).
+    """
+    global _shardDir_, _fext_, _manifestPath_, _finishedFiles_
+    newfilefpath = fpath.split(_fext_)[0] + '.grib2'
+    prefix = os.path.basename(fpath).split(_fext_)[0]
+    shards = grib2io.getShards(_shardDir_, prefix)
+    if not shards and fpath in _finishedFiles_ and os.path.isfile(newfilefpath):
+        # already concatenated in the earlier run
+        _log_.info("Already concatenated in earlier run %s", newfilefpath)
+        return grib2io.scanMessages(newfilefpath)
+    # end of if not shards and ...:
+    if not shards:
+        _log_.error("ALERT!!! No shards found to concatenate for %s", fpath)
+        return None
+    # end of if not shards:
+    metrics.startTask(os.path.basename(fpath), 'shuffle', outfile=fpath)
+    
+    try:
+        with metrics.stage('shuffle') as stage:
+            written = grib2io.concatShards(shards, newfilefpath)
+            stage.add(fields=len(written), nbytes=sum([record[1] for record in written]))
+        # end of with metrics.stage('shuffle') as stage:
+    except Exception as e:
+        _log_.error("ALERT !!! Error while concatenating shards into grib2!! %s. So skipping this without saving data", e)
+        metrics.finishTask('failed')
+        return None
+    # end of try:
+    if _manifestPath_ is not None: manifest.addFinished(_manifestPath_, fpath, newfilefpath)
+    # remove the shards
+    grib2io.removeShards(shards)
+    
+    _log_.info("Concatenated %d shards in ordered fassion and saved into %s", len(shards), newfilefpath)
+    
+    # create ctl & idx files
+    with metrics.stage('ctl'):
+        createGrADSCtlIdx(newfilefpath, written)
+    metrics.finishTask()
+    return written
+# end definition #20 -- doConcatShards(fpath):
+
+# start definition #33
+def regridToWriter(arg):
+    """
+    This definition is the 'writer' output mode task of regridAnlFcstFiles.
+    It tells the writer process that this task is over (even if it failed),
+    so that the re-ordering of its outfiles is not waiting for it anymore.
+    :param arg: tuple(taskName, arg of regridAnlFcstFiles)
+    """
+    global _writer_
+    taskName, arg = arg
+    try:
+        return regridAnlFcstFiles(arg)
+    finally:
+        _writer_.taskDone(taskName)
+    # end of try:
+# end of def regridToWriter(arg): #33
+
+# start definition #34
+def doWriterShuffle(arg):
+    """
+    This definition is the 'writer' output mode counterpart of
+    doShuffleVarsInOrder. It waits for the writer process to write all the
+    messages of the tasks of the outfile and then copies the messages into
+    the ordered grib2 file by the index of the writer (without scanning the
+    outfile again), and then generates GrADS ctl and idx files.
+    :param arg: tuple(unordered outfile path, names of its conversion tasks)
+    :return: list of (offset, length, keys) of the messages of the ordered
+             grib2 file (None on failure).
+    """
+    global _fext_, _manifestPath_, _finishedFiles_, _writer_
+    fpath, deps = arg
+    newfilefpath = fpath.split(_fext_)[0] + '.grib2'
+    metrics.startTask(os.path.basename(fpath), 'shuffle', outfile=fpath)
+    try:
+        with metrics.stage('writer_wait'):
+            records = _writer_.flush(fpath, deps)
+    except RuntimeError as e:
+        # dead writer or lost task, so lets fail this task (see scheduler)
+        _log_.error("ALERT !!! %s", e)
+        metrics.finishTask('failed')
+        raise
+    # end of try:
+    if not records and fpath in _finishedFiles_ and os.path.isfile(newfilefpath):
+        # already re-ordered in the earlier run
+        _log_.info("Already re-ordered in earlier run %s", newfilefpath)
+        metrics.finishTask()
+        return grib2io.scanMessages(newfilefpath)
+    # end of if not records and ...:
+    if not records:
+        _log_.error("ALERT!!! No messages were written into %s", fpath)
+        metrics.finishTask('failed')
+        return None
+    # end of if not records:
+    
+    # sort the messages by order of variables. messages of the earlier run
+    # (resume) are ranked by the ranks of its units in the manifest.
+    ranker = getMessageRanker(fpath)
+    records.sort(key=lambda record: record[3] if record[3] is not None
+                                    else ranker(record[0], record[2]))
+    records = [(offset, length, keys) for offset, length, keys, rank in records]
+    try:
+        with metrics.stage('shuffle') as stage:
+            written = grib2io.copyMessages(fpath, records, newfilefpath)
+            stage.add(fields=len(written), nbytes=sum([record[1] for record in written]))
+        # end of with metrics.stage('shuffle') as stage:
+    except Exception as e:
+        _log_.error("ALERT !!! Error while saving orderd variables into grib2!! %s. So skipping this without saving data", e)
+        metrics.finishTask('failed')
+        return None
+    # end of try:
+    # remove the older file 
+    os.remove(fpath)
+    
+    _log_.info("Created the variables in ordered fassion and saved into %s", newfilefpath)
+    if _manifestPath_ is not None: manifest.addFinished(_manifestPath_, fpath, newfilefpath)
+    
+    # create ctl & idx files
+    with metrics.stage('ctl'):
+        createGrADSCtlIdx(newfilefpath, written)
+    metrics.finishTask()
+    return written
+# end definition #34 -- doWriterShuffle(arg):
+
+# start definition #35
+def addConvertTask(sched, taskName, arg, cost, mem):
+    """
+    This definition adds the conversion task (see getFileConvertTasks) into
+    the scheduler as per the output mode.
+    """
+    global _outputMode_
+    if _outputMode_ == 'writer':
+        sched.addTask(taskName, regridToWriter, (taskName, arg), cost, mem=mem)
+    else:
+        sched.addTask(taskName, regridAnlFcstFiles, arg, cost, mem=mem)
+    # end of if _outputMode_ == 'writer':
+# end of def addConvertTask(sched, taskName, arg, cost, mem): #35
+
+# start definition #36
+def addOutFileTask(sched, outFn, deps):
+    """
+    This definition adds the re-ordering (+ ctl) task of the outfile into the
+    scheduler as per the output mode. Re-ordering frees the outfile early,
+    so it is run before other tasks (once its deps conversion tasks are done).
+    """
+    global _outputMode_
+    if _outputMode_ == 'writer':
+        sched.addTask(os.path.basename(outFn), doWriterShuffle, (outFn, list(deps)),
+                      cost=1, deps=deps, priority=1)
+    else:
+        # shards are already ordered by its index, so just concatenate it.
+        doShuffle = doConcatShards if _outputMode_ == 'shard' else doShuffleVarsInOrder
+        sched.addTask(os.path.basename(outFn), doShuffle, outFn, cost=1,
+                      deps=deps, priority=1)
+    # end of if _outputMode_ == 'writer':
+# end of def addOutFileTask(sched, outFn, deps): #36
+
+# start definition #42
+def getResolutionTag(resolution):
+    """
+    This definition returns the outfile name tag of the target grid
+    resolution (say '1p00deg' for 1.0 deg), or None for the default 0.25 deg
+    resolution, so that its outfile names are unchanged.
+    :param resolution: grid spacing in degrees.
+    """
+    global _defaultResolution_
+    if float(resolution) == _defaultResolution_: return None
+    return ('%.2fdeg' % float(resolution)).replace('.', 'p')
+# end of def getResolutionTag(resolution): #42
+
+# start definition #43
+def getTargetGrid(resolution):
+    """
+    This definition returns the global regular lat/lon target grid of the
+    resolution by setting up sample points based on coord (say 1440 x 721
+    points for 0.25 deg). These are shared (memory mapped) arrays, which all
+    the workers attach to.
+    :param resolution: grid spacing in degrees (say 0.25, 0.5 or 1.0).
+    :return: list of (coordinate name, sample points) tuples.
+    """
+    global _sharedDir_
+    
+    resolution = float(resolution)
+    if resolution <= 0 or resolution > 90:
+        raise ValueError("Invalid target grid resolution %s" % str(resolution))
+    # end of if resolution <= 0 or resolution > 90:
+    tag = getResolutionTag(resolution)
+    suffix = '' if tag is None else '_' + tag
+    nlon, nlat = int(round(360.0 / resolution)), int(round(180.0 / resolution)) + 1
+    return [('longitude', sharedstore.putArray(_sharedDir_, 'targetLongitude' + suffix,
+                                              numpy.linspace(0,360,nlon))),
+            ('latitude', sharedstore.putArray(_sharedDir_, 'targetLatitude' + suffix,
+                                             numpy.linspace(-90,90,nlat)))]
+# end of def getTargetGrid(resolution): #43
+
+# start definition #37
+def setTargetDomains(subdomains=None, resolutions=None):
+    """
+    This definition sets up the output domains (_domains_) of the run, i.e.
+    every subdomain at every target grid resolution, and _targetGrid_ (the
+    global grid of the first resolution). The target points of a subdomain
+    are the points of the global grid of that resolution within its lat/lon
+    box, so the regional products have the same points (and values, see
+    getDomainCube) as the global product, but only those points are
+    interpolated and encoded. The box must not cross the 0/360 meridian
+    (the target longitudes are within 0 to 360 as encoded). All the
+    domains are regridded from the same loaded (and averaged) source field,
+    and each domain has its own cached weights and outfiles. Call it before
+    forking the workers.
+    :param subdomains: dictionary of the subdomain name and its (south,
+                       north, west, east) box in degrees (0 <= west < east
+                       <= 360), say {'india': (0, 40, 60, 100)}. The None
+                       box is the global domain (usual outfiles). If None,
+                       then only the global domain.
+    :param resolutions: list of the target grid resolutions in degrees, say
+                        [0.25, 0.5, 1.0]. Default is [0.25].
+    :raise ValueError: if the box is invalid or crosses the 0/360 meridian
+                       (west > east or negative west), say (0, 40, 330, 30).
+    """
+    global _domains_, _targetGrid_, _sharedDir_, _defaultResolution_
+    
+    if not resolutions: resolutions = [_defaultResolution_]
+    boxes = sorted(subdomains.items()) if subdomains else [(None, None)]
+    _domains_ = []
+    for resolution in resolutions:
+        tag = getResolutionTag(resolution)
+        globalGrid = getTargetGrid(resolution)
+        if _domains_ == []: _targetGrid_ = globalGrid
+        for name, box in boxes:
+            if box is None:
+                # global domain of this resolution
+                _domains_.append((tag, None, globalGrid))
+                continue
+            # end of if box is None:
+            south, north, west, east = [float(val) for val in box]
+            if not -90 <= south < north <= 90:
+                raise ValueError("Invalid latitudes of the subdomain box of '%s' %s" % (name, str(box)))
+            if not 0 <= west < east <= 360:
+                raise ValueError("Invalid longitudes of the subdomain box of '%s' %s, which must be "
+                                 "0 <= west < east <= 360 (crossing 0/360 is not supported)" % (name, str(box)))
+            # end of if not -90 <= south < north <= 90:
+            domain = name if tag is None else name + '_' + tag
+            grid = dict(globalGrid)
+            lons = grid['longitude'][(grid['longitude'] >= west) & (grid['longitude'] <= east)]
+            lats = grid['latitude'][(grid['latitude'] >= south) & (grid['latitude'] <= north)]
+            if not lons.size or not lats.size:
+                raise ValueError("No target points within the subdomain '%s'" % domain)
+            # these are shared (memory mapped) arrays, which all the workers attach to.
+            targetGrid = [('longitude', sharedstore.putArray(_sharedDir_, 'targetLongitude_' + domain, lons)),
+                          ('latitude', sharedstore.putArray(_sharedDir_, 'targetLatitude_' + domain, lats))]
+            _domains_.append((domain, (south, north, west, east), targetGrid))
+            _log_.info("Subdomain %s %s has %d x %d target points", domain,
+                       str(box), lats.size, lons.size)
+        # end of for name, box in boxes:
+    # end of for resolution in resolutions:
+# end of def setTargetDomains(subdomains=None, resolutions=None): #37
+
+# start definition #38
+def getDomainCube(tmpCube, box, margin=2):
+    """
+    This definition returns the source window of the cube, which covers the
+    subdomain box (plus margin rows/columns, so that the interpolation
+    stencil of the edge target points is within the window). Only this
+    window is realised, interpolated and encoded. The longitudes of the
+    window of the global (circular) source wrap around the 0/360 meridian
+    (cube.intersection), so the edge target points at 0 or 360 get the same
+    source points (and so values) as in the global product.
+    :param tmpCube: Iris cube with latitude & longitude dimensions.
+    :param box: (south, north, west, east) in degrees or None (global).
+    :param margin: no of extra source rows/columns on every side.
+    :return: Iris cube of the source window (tmpCube itself if box is None).
+    """
+    if box is None: return tmpCube
+    south, north, west, east = box
+    circular = getattr(tmpCube.coord('longitude'), 'circular', False)
+    keys = [slice(None)] * tmpCube.ndim
+    windows = {}
+    for name, lower, upper in [('latitude', south, north), ('longitude', west, east)]:
+        coord = tmpCube.coord(name)
+        points = coord.points
+        spacing = numpy.abs(numpy.diff(points)).max() if len(points) > 1 else 0
+        windows[name] = (lower - margin * spacing, upper + margin * spacing)
+        # window of the circular longitudes is cut by intersection below
+        if name == 'longitude' and circular: continue
+        inside = numpy.where((points >= windows[name][0]) & (points <= windows[name][1]))[0]
+        if not inside.size:
+            raise ValueError("No source points within the subdomain %s" % str(box))
+        dim, = tmpCube.coord_dims(coord)
+        keys[dim] = slice(inside.min(), inside.max() + 1)
+    # end of for name, lower, upper in [...]:
+    domCube = tmpCube[tuple(keys)]
+    if circular:
+        # wraps around 0/360, say (-0.2, 40.2) for the box west 0 & east 40
+        domCube = domCube.intersection(longitude=windows['longitude'])
+    # end of if circular:
+    lon = domCube.coord('longitude')
+    if len(lon.points) < len(tmpCube.coord('longitude').points):
+        # window is not periodic anymore
+        lon.circular = False
+    return domCube
+# end of def getDomainCube(tmpCube, box, margin=2): #38
+
+# start definition #39
+def getOutFileName(outfile, hr, domain=None):
+    """
+    This definition returns the unordered outfile (with _fext_) path.
+    :param outfile: 'um_prg' or 'um_ana'.
+    :param hr: forecast hour of the outfile.
+    :param domain: subdomain name (None is the global domain).
     """
     global _current_date_, _opPath_, _fext_
+    if domain is not None: outfile = outfile + '_' + domain
+    outFn = outfile +'_'+ str(hr).zfill(3) +'hr'+ '_' + _current_date_ + _fext_ + '.grib2'
+    return os.path.join(_opPath_, outFn)
+# end of def getOutFileName(outfile, hr, domain=None): #39
+
+# start definition #44
+def planConversion(fnames):
+    """
+    This definition makes the read plan (_readPlan_) of the run, i.e. every
+    output field is resolved to exactly one of the input files (as per the
+    _productCatalog_ priority), before any I/O starts. So the same variable
+    is never read & regridded from two input files (say qwqg00.pp0 and
+    umglca_pd at 00Z analysis). Call it before the conversion tasks are made
+    (and before forking the workers).
+    :param fnames: list of partial filenames of the run (say umglca_pb).
+    """
+    global _productCatalog_, _readPlan_
+    
+    _readPlan_, dropped = planner.makePlan(_productCatalog_, fnames)
+    for prefix, name, STASH, owner in dropped:
+        _log_.info("Plan: %s (%s) of %s is taken from %s", name, STASH, prefix, owner)
+    # end of for prefix, name, STASH, owner in dropped:
+    for prefix, varNamesSTASH in _readPlan_.items():
+        _log_.debug("Plan: %s reads %s", prefix, str([STASH for name, STASH in varNamesSTASH]))
+    # end of for prefix, varNamesSTASH in _readPlan_.items():
+# end of def planConversion(fnames): #44
+
+# start definition #26
+def prepareResume(outFiles):
+    """
+    This definition recovers the task manifest of the earlier run, i.e. it
+    truncates the partially appended messages, removes the outputs which
+    are not recorded in the manifest and loads the completed units, so that
+    only the missing units are converted again.
+    :param outFiles: list of (hour, unordered outfile path) of this run.
+    """
+    global _manifestPath_, _doneUnits_, _finishedFiles_, _outputMode_, _shardDir_, _fext_
+    
+    _doneUnits_, targets, _finishedFiles_ = manifest.recover(_manifestPath_,
+                                                             grib2io.truncateMessages)
+    # remove the partially written outputs which are not in the manifest
+    for outHr, outFn in outFiles:
+        if _outputMode_ == 'shard':
+            prefix = os.path.basename(outFn).split(_fext_)[0]
+            grib2io.removeShards([shard for shard in grib2io.getShards(_shardDir_, prefix)
+                                  if shard not in targets])
+        # end of if _outputMode_ == 'shard':
+        if os.path.isfile(outFn) and outFn not in targets: os.remove(outFn)
+    # end of for outHr, outFn in outFiles:
+    if _doneUnits_:
+        _log_.info("Resuming: %d units were converted already in earlier run", len(_doneUnits_))
+# end of def prepareResume(outFiles): #26
+
+# start definition #53
+def preloadFiles(convertTasks):
+    """
+    This definition loads (iris.load, i.e. lookup & metadata only, the data
+    is lazy) every input file of the conversion tasks only once, with the
+    variables of all its tasks, into _loadedFiles_. Call it before forking
+    the workers, so that the variable tasks of a file share the same loaded
+    cubes (see getLoadedCubes) instead of loading the file once per task.
+    The files which can't be loaded here are loaded by its tasks.
+    :param convertTasks: list of (taskName, arg, cost, mem, hr) tuples (see
+                         getFileConvertTasks).
+    """
+    global _inDataPath_, _loadedFiles_, _doneUnits_, _domains_
+    
+    _loadedFiles_ = {}
+    files = {}
+    for taskName, arg, cost, mem, hr in convertTasks:
+        files.setdefault(tuple(arg[:2]), []).extend(arg[2])
+    # end of for taskName, arg, cost, mem, hr in convertTasks:
+    for (fpname, hr), varNamesSTASH in sorted(files.items()):
+        fileName = fpname + hr if not '.' in fpname else fpname
+        details = getVarInOutFilesDetails(_inDataPath_, fileName, hr)
+        fcstHours, infile = details[2], details[4]
+        if not os.path.isfile(infile): continue
+        if _doneUnits_:
+            # variables completed in the earlier run are not loaded again
+            isDone = lambda varSTASH, fhr: all([manifest.getUnitKey(infile, varSTASH, fhr, domain) in _doneUnits_
+                                                for domain, box, targetGrid in _domains_])
+            varNamesSTASH = [(varName, varSTASH) for varName, varSTASH in varNamesSTASH
+                             if not all([isDone(varSTASH, fhr) for fhr in fcstHours])]
+            if not varNamesSTASH: continue
+        # end of if _doneUnits_:
+        try:
+            signature = manifest.getInputSignature(infile)
+            _loadedFiles_[(fpname, hr)] = (signature, getCubeData(infile, varNamesSTASH, fcstHours))
+        except Exception as e:
+            _log_.warning("Couldn't load %s for all its tasks (%s), so every task loads it", infile, e)
+        # end of try:
+    # end of for (fpname, hr), varNamesSTASH in sorted(files.items()):
+    _log_.info("Loaded %d input files once for all its tasks", len(_loadedFiles_))
+# end of def preloadFiles(convertTasks): #53
+
+# start definition #54
+def getLoadedCubes(fpname, hr, signature, varNamesSTASH):
+    """
+    This definition returns the cubes of the variables from the input file
+    which is loaded already by preloadFiles. The cubes are copied (lazy data
+    is not read), so that the data realised by this task is not held by the
+    shared cubes.
+    :param fpname: partial filename (say umglaa_pb).
+    :param hr: forecast hour chunk of the file as string (say '024').
+    :param signature: (size, mtime) of the input file of this task.
+    :param varNamesSTASH: list of (variable name, STASH code) of this task.
+    :return: Iris CubeList or None (not loaded or the input has changed).
+    """
+    global _loadedFiles_
+    
+    loaded = _loadedFiles_.get((fpname, hr))
+    if loaded is None or tuple(loaded[0]) != tuple(signature): return None
+    stashCodes = set([str(varSTASH) for varName, varSTASH in varNamesSTASH])
+    return iris.cube.CubeList([cube.copy() for cube in loaded[1]
+                               if str(cube.attributes.get('STASH', '')) in stashCodes])
+# end of def getLoadedCubes(fpname, hr, signature, varNamesSTASH): #54
+
+# start definition #27
+def getFileConvertTasks(fpname, hr):
+    """
+    This definition splits the conversion of one input file into fine grained
+    tasks, i.e. one task per variable (the file itself is loaded only once for
+    all of them, see preloadFiles). The cost of each task is estimated by
+    its no of 2-D fields (levels x forecast hours), so that the scheduler runs
+    the largest tasks (say 18 levels pd files) first. Its memory footprint is
+    estimated by getTaskMemory.
+    :param fpname: partial filename (say umglaa_pb).
+    :param hr: forecast hour chunk of the file as string (say '024').
+    :return: list of (taskName, arg, cost, mem, hr) tuples, where arg is the
+             argument of regridAnlFcstFiles, mem is the estimated memory in
+             bytes and hr is the forecast hour chunk of the input file as
+             integer.
+    """
+    global _inDataPath_
+    
+    ### if fileName has some extension, then do not add hr to it.
+    fileName = fpname + hr if not '.' in fpname else fpname
+    fname = os.path.join(_inDataPath_, fileName)
+    if not os.path.isfile(fname): 
+        _log_.warning("The file doesn't exists: %s", fname)
+        return []
+    # end of if not os.path.isfile(fname): 
+    varNamesSTASH, varLvls, fcstHours, do6HourlyMean, infile, outfile = getVarInOutFilesDetails(_inDataPath_,
+                                                                                             fileName, hr)
+    cost = max(varLvls, 1) * numpy.ravel(fcstHours).size
+    mem = getTaskMemory(infile, varLvls, fcstHours, do6HourlyMean)
+    tasks = []
+    for varName, varSTASH in varNamesSTASH:
+        taskName = fileName + '.' + varSTASH
+        tasks.append((taskName, (fpname, hr, [(varName, varSTASH)]), cost, mem, int(hr)))
+    # end of for varName, varSTASH in varNamesSTASH:
+    return tasks
+# end of def getFileConvertTasks(fpname, hr): #27
+
+# start definition #30
+def getTaskMemory(infile, varLvls, fcstHours, do6HourlyMean):
+    """
+    This definition estimates the peak memory of the conversion task of one
+    variable of the infile. A task streams one level of one forecast hour at
+    a time (see regridEncodeLevels), i.e. the source slice (float32, plus
+    float64 copy if masked), the regridded slice (float64 product and its
+    float32 copy), the encoded messages of all the levels of all the domains
+    and the read ahead slices of the reader thread (_prefetchDepth_ plus the
+    one which is being read) are in memory at the same time. The 6 hourly
+    mean tasks hold all the time slices and the averaged windows too. The
+    field cache writes the float32 copy of every regridded level.
+    :param infile: input fieldsfile path (for the grid size).
+    :param varLvls: no of vertical levels of the variable.
+    :param fcstHours: forecast hours (or windows) of the task.
+    :param do6HourlyMean: True, if the windows are averaged.
+    :return: estimated memory in bytes.
+    """
+    global _domains_, _prefetchDepth_, _fieldCacheDir_, _fieldCacheSize_
     
-    print "Lets re-order variables for all the files!!!"
-    #####
-    ## 6-hourly Files have been created with extension.
-    ## Now lets do re-order variables within those individual files, in parallel mode. 
-   
+    srcSize = fieldsfile.getMaxFieldSize(infile)
+    # unknown (say pp file), so lets take N768 grid size
+    if not srcSize: srcSize = 1536 * 1152
+    # the output domains are regridded one after another, but the messages
+    # of all the domains are kept till the unit is saved
+    tgtSizes = [numpy.prod([len(points) for name, points in targetGrid])
+                for domain, box, targetGrid in _domains_]
+    lvls = max(varLvls, 1)
+    mem = 12 * srcSize + 12 * max(tgtSizes) + lvls * 2 * sum(tgtSizes)
+    mem += (_prefetchDepth_ + 1) * 4 * srcSize
+    if do6HourlyMean:
+        windows = numpy.ravel(fcstHours).size + len(fcstHours)
+        mem += windows * lvls * 4 * srcSize
+    # end of if do6HourlyMean:
+    if _fieldCacheDir_ and _fieldCacheSize_:
+        mem += 4 * max(tgtSizes)
+    # python & iris objects of the cubes
+    return int(mem) + 64 * 1024 ** 2
+# end of def getTaskMemory(infile, varLvls, fcstHours, do6HourlyMean): #30
+
+# start definition #22
+def getConvertTasks(fnames, ftype):
+    """
+    This definition returns the fine grained conversion tasks (see
+    getFileConvertTasks) of all the input files.
+    :param fnames: list of partial filenames (say umglaa_pb).
+    :param ftype: 'fcst' or 'anl'.
+    :return: list of (taskName, arg, cost, mem, hr) tuples.
+    """
+    tasks = []
+    for fpname in fnames:
+        for hr in getFcstTimes(ftype):
+            tasks.extend(getFileConvertTasks(fpname, hr))
+        # end of for hr in getFcstTimes(ftype):
+    # end of for fpname in fnames:
+    return tasks
+# end of def getConvertTasks(fnames, ftype): #22
+
+# start definition #28
+def getFcstTimes(ftype):
+    """
+    This definition returns the forecast hour chunks (of input filenames).
+    :param ftype: 'fcst' or 'anl'.
+    """
+    if ftype in ['fcst', 'forecast']:
+        return ['000', '024','048','072','096','120','144','168','192','216']
+    elif ftype in ['anl', 'analysis']:
+        return ['000']
+    else:
+        raise ValueError("Unknown file type !")
+    # end of if ftype in ['fcst', 'forecast']:
+# end of def getFcstTimes(ftype): #28
+
+# start definition #23
+def getOutFileNames(ftype, simulated_hr, domain=None):
+    """
+    This definition returns the unordered outfiles (with _fext_) of the
+    forecast or analysis conversion.
+    :param ftype: 'fcst' or 'anl'.
+    :param simulated_hr: assimilated hour as string (say '00').
+    :param domain: subdomain name (None is the global domain).
+    :return: list of (outfile hour as integer, unordered outfile path) tuples.
+    """
     if ftype in ['fcst', 'forecast']:
-        ## generate all the forecast filenames w.r.t forecast hours
         # BY THE WAY: all forecast files are prg (which stands for prognostic!)
-        outfile = 'um_prg'
-        fcstFiles = []
-        for hr in range(6,241,6):
-            outFn = outfile +'_'+ str(hr).zfill(3) +'hr'+ '_' + _current_date_ + _fext_ + '.grib2'
-            outFn = os.path.join(_opPath_, outFn)
-            fcstFiles.append(outFn)
-        # end of for hr in range(6,241,6):
-         
-        ## get the no of created anl/fcst 6hourly files  
-        nprocesses = len(fcstFiles)        
-        # parallel begin - 3
-        pool = _MyPool(nprocesses)
-        print "Creating %d (non-daemon) workers and jobs in doShuffleVarsInOrder process." % nprocesses
-        results = pool.map(doShuffleVarsInOrder, fcstFiles)   
-        
-        # closing and joining master pools
-        pool.close()     
-        pool.join()
-        # parallel end - 3    
+        outfile, hours = 'um_prg', range(6,241,6)
     elif ftype in ['anl', 'analysis']:
-        ## generate the analysis filename w.r.t simulated_hr
-        outfile = 'um_ana'
-        outFn = outfile +'_'+ str(simulated_hr).zfill(3) +'hr'+ '_' + _current_date_ + _fext_ + '.grib2'
-        outFn = os.path.join(_opPath_, outFn)
-        doShuffleVarsInOrder(outFn)
-    # end of if ftype in ['fcst', 'forecast']: 
-    print "Total time taken to convert and re-order all files was: %8.5f seconds \n" % (time.time()-_startT_)
-    
-    return 
-# end definition #8 -- doShuffleVarsInOrderInParallel(arg):
+        outfile, hours = 'um_ana', [int(simulated_hr)]
+    else:
+        raise ValueError("Unknown file type !")
+    # end of if ftype in ['fcst', 'forecast']:
     
-# Start definition #9
-def doFcstConvert(fname):
+    return [(hr, getOutFileName(outfile, hr, domain)) for hr in hours]
+# end of def getOutFileNames(ftype, simulated_hr, domain=None): #23
+
+# start definition #40
+def getAllOutFileNames(ftype, simulated_hr):
     """
-    New Module by AAT:
-    What does this module dd?
-    This module creates sub-processes or child-processes for each forecast hour
-    as an embarassingly parallel problem. This is THE main program to feed a filename
-    and its individual/single variable as a child process to a MP thread/daemon process
-    defined by the     filename of interest that has to be divided into time-parallel
-    problem.
-    :param fname: Name of the FF filename in question as a "string"
-    :return: Nothing! TANGIBLE!
-    """
-    fcst_times = ['000', '024','048','072','096','120','144','168','192','216']
-    fcst_filenames = [(fname, hr) for hr in fcst_times]
-    nchild = len(fcst_times)
-    # create the no of child parallel processes
-    inner_pool = mp.Pool(processes=nchild)
-    print "Creating %i (daemon) workers and jobs in child." % nchild
-    
-    # pass the forecast hours as argument to take one fcst file per process / core to regrid it.
-    results = inner_pool.map(regridAnlFcstFiles, fcst_filenames)
-    # closing and joining child pools      
-    inner_pool.close() 
-    inner_pool.join()
-    # parallel end
-# end definition #9 -- doFcstConvert(fname):
-
-# Start definition #10
-def doAnlConvert(fname):
+    This definition returns the unordered outfiles of all the output domains
+    (see getOutFileNames).
     """
-    New Module by AAT:
-    This module has been rewritten entirely by AAT for optimization as an embarassingly-
-    parallel problem! This module acts as the main program to feed the filenames as a
-    child process to a multiprocessing thread as a daemon process.
-    :param fname: Name of the FF filename in question as a "string"
-    :param "fcst hr" as string HHH
-    :return: Nothing! TANGIBLE!
+    global _domains_
+    outFiles = []
+    for domain, box, targetGrid in _domains_:
+        outFiles.extend(getOutFileNames(ftype, simulated_hr, domain))
+    # end of for domain, box, targetGrid in _domains_:
+    return outFiles
+# end of def getAllOutFileNames(ftype, simulated_hr): #40
+
+# start definition #41
+def createDomainsTemplateCtlIdx(results, simulated_hr):
+    """
+    This definition creates the templated ctl & idx (see createTemplateCtlIdx)
+    of the forecast files of every output domain.
+    :param results: dictionary of the scheduler task name and its result.
+    :param simulated_hr: assimilated hour as string (say '00').
     """
+    global _domains_
+    for domain, box, targetGrid in _domains_:
+        filesRecords = dict([(outHr, results.get(os.path.basename(outFn)))
+                             for outHr, outFn in getOutFileNames('fcst', simulated_hr, domain)])
+        createTemplateCtlIdx(filesRecords, simulated_hr, domain)
+    # end of for domain, box, targetGrid in _domains_:
+# end of def createDomainsTemplateCtlIdx(results, simulated_hr): #41
+
+# start definition #24
+def createTemplateCtlIdx(filesRecords, simulated_hr, domain=None):
+    """
+    This definition creates one templated (%f3) GrADS ctl & idx file for all
+    the forecast files.
+    :param filesRecords: dictionary of forecast hour (integer) and the list of
+                         (offset, length, keys) records of that ordered file.
+    :param simulated_hr: assimilated hour as string (say '00').
+    :param domain: subdomain name (None is the global domain).
+    """
+    global _current_date_, _opPath_
     
-    regridAnlFcstFiles((fname, '000'))  
-# end definition #10 -- doAnlConvert(fname):
+    outfile = 'um_prg' if domain is None else 'um_prg_' + domain
+    initTime = datetime.datetime.strptime(_current_date_ + str(simulated_hr).zfill(2), '%Y%m%d%H')
+    ctlfile = os.path.join(_opPath_, outfile + '_' + _current_date_ + '.ctl')
+    dsetTemplate = outfile + '_%f3hr_' + _current_date_ + '.grib2'
+    try:
+        gradsctl.writeTemplateCtlIdx(ctlfile, dsetTemplate, filesRecords, initTime, 6)
+        _log_.info("Successfully created template control and index file ! %s", ctlfile)
+    except Exception as e:
+        _log_.error("ALERT !!! Error while creating template ctl file!! %s", e)
+    # end of try:
+# end of def createTemplateCtlIdx(filesRecords, simulated_hr, domain=None): #24
 
 # Start definition # 11 the convertFilesInParallel function
-def convertFilesInParallel(fnames, ftype):
+def convertFilesInParallel(fnames, ftype, simulated_hr):
     """
-    convertFilesInParallel function calling all the sub-functions
+    convertFilesInParallel function calling all the sub-functions.
+    All the conversion tasks (file x forecast hour x variable) and the
+    re-ordering (+ ctl) task of every outfile are run by a single flat
+    scheduler with bounded no of workers (_nprocs_), instead of nested
+    process pools. The re-ordering task of an outfile is queued as soon as
+    all the conversion tasks which feed that outfile are completed.
     :param fnames: a simple filename as argument in a string format
+    :param ftype: 'fcst' or 'anl'.
+    :param simulated_hr: assimilated hour as string (say '00').
     :return: THE SheBang!
     """
     
-    global _startT_, _tmpDir_, _opPath_
+    global _startT_, _outputMode_, _nprocs_, _memBudget_, _ctlMode_, _ctlTemplate_, _writer_
+    global _loadedFiles_
     
-    ## get the no of files and 
-    nprocesses = len(fnames)
-    # lets create no of parallel process w.r.t no of files.
+    metrics.startTask('run', 'run', ftype=ftype)
+    # resolve every output field to one input file (before any I/O)
+    planConversion(fnames)
+    outFiles = getAllOutFileNames(ftype, simulated_hr)
+    # resume from the task manifest of the earlier run (if any)
+    prepareResume(outFiles)
+    convertTasks = getConvertTasks(fnames, ftype)
+    # load every input file only once for the tasks of all its variables
+    preloadFiles(convertTasks)
     
-    # parallel begin - 1 
-    pool = _MyPool(nprocesses)
-    print "Creating %d (non-daemon) workers and jobs in convertFilesInParallel process." % nprocesses
+    sched = scheduler.Scheduler(_nprocs_, _memBudget_)
+    for taskName, arg, cost, mem, hr in convertTasks:
+        addConvertTask(sched, taskName, arg, cost, mem)
+    # end of for taskName, arg, cost, mem, hr in convertTasks:
     
-    if ftype in ['anl', 'analysis']:
-        print "fnames ++++++++", fnames
-        results = pool.map(doAnlConvert, fnames)
-    elif ftype in ['fcst', 'forecast']:
-        results = pool.map(doFcstConvert, fnames)
-    else:
-        raise ValueError("Unknown file type !")
-    # end of if ftype in ['anl', 'analysis']:    
-
-    # closing and joining master pools
-    pool.close()     
-    pool.join()
-    # parallel end - 1 
+    for outHr, outFn in outFiles:
+        if ftype in ['fcst', 'forecast']:
+            # input file of hour chunk hr has the outfiles of hr+6 ... hr+24
+            deps = [taskName for taskName, arg, cost, mem, hr in convertTasks if hr < outHr <= hr + 24]
+        else:
+            # all the analysis input files are written into same outfile
+            deps = [taskName for taskName, arg, cost, mem, hr in convertTasks]
+        # end of if ftype in ['fcst', 'forecast']:
+        addOutFileTask(sched, outFn, deps)
+    # end of for outHr, outFn in outFiles:
     
-    print "Total time taken to convert %d files was: %8.5f seconds \n" %(len(fnames),(time.time()-_startT_))
+    if _outputMode_ == 'writer':
+        # single writer process of all the outfiles (before forking workers)
+        _writer_ = gribwriter.GribWriter([outFn for outHr, outFn in outFiles], commitUnit)
+    try:
+        results = sched.run()
+    finally:
+        if _writer_ is not None: _writer_.stop()
+        _writer_ = None
+        # make memory free
+        _loadedFiles_ = {}
+    # end of try:
+    
+    if ftype in ['fcst', 'forecast'] and _ctlMode_ == 'native' and _ctlTemplate_:
+        # one templated ctl & idx for all the forecast files (per domain)
+        createDomainsTemplateCtlIdx(results, simulated_hr)
+    # end of if ftype in ['fcst', 'forecast'] and ...:
+    
+    metrics.finishTask()
+    _log_.info("Total time taken to convert and re-order %d files was: %8.5f seconds", len(fnames), time.time() - _startT_)
     
     return
-# end of definition #11 -- convertFilesInParallel(fnames):
+# end of definition #11 -- convertFilesInParallel(fnames, ftype, simulated_hr):
+
+# start definition #29
+def watchFilesInParallel(fnames, simulated_hr, pollInterval=30, timeout=3600):
+    """
+    Watch mode counterpart of convertFilesInParallel for forecast files. It
+    polls _inDataPath_ while the UM forecast is still running and converts
+    each input file as soon as it is completely written, so that the
+    conversion is overlapped with the model integration. The um_prg files of
+    a forecast hour chunk are re-ordered & published as soon as all its
+    input files are converted.
+    :param fnames: list of partial forecast filenames (say umglaa_pb).
+    :param simulated_hr: assimilated hour as string (say '00').
+    :param pollInterval: polling interval in seconds.
+    :param timeout: stop watching, if no new input file lands within these
+                    seconds (then the available outfiles are published).
+    """
+    global _startT_, _inDataPath_, _outputMode_, _nprocs_, _memBudget_, _ctlMode_, _ctlTemplate_
+    global _writer_
+    
+    metrics.startTask('run', 'run', ftype='fcst')
+    # resolve every output field to one input file (before any I/O)
+    planConversion(fnames)
+    outFiles = getAllOutFileNames('fcst', simulated_hr)
+    # resume from the task manifest of the earlier run (if any)
+    prepareResume(outFiles)
+    
+    sched = scheduler.Scheduler(_nprocs_, _memBudget_)
+    watcher = _FcstFilesWatcher(sched, fnames, outFiles, timeout)
+    if _outputMode_ == 'writer':
+        # single writer process of all the outfiles (before forking workers)
+        _writer_ = gribwriter.GribWriter([outFn for outHr, outFn in outFiles], commitUnit)
+    _log_.info("Watching %s for forecast files", _inDataPath_)
+    try:
+        results = sched.run(poller=watcher, pollInterval=pollInterval)
+    finally:
+        if _writer_ is not None: _writer_.stop()
+        _writer_ = None
+    # end of try:
+    
+    if _ctlMode_ == 'native' and _ctlTemplate_:
+        # one templated ctl & idx for all the forecast files (per domain)
+        createDomainsTemplateCtlIdx(results, simulated_hr)
+    # end of if _ctlMode_ == 'native' and _ctlTemplate_:
+    
+    metrics.finishTask()
+    _log_.info("Total time taken to watch, convert and re-order %d files was: %8.5f seconds", len(fnames), time.time() - _startT_)
+# end of def watchFilesInParallel(...): #29
+
+# start definition #52
+def runConversion(ftype, convert, inPath, outPath, tmpPath, date, hr, outputMode='locked',
+                  ctlMode='native', ctlTemplate=False, nprocs=None, resume=True, logLevel='INFO',
+                  memBudget=None, subdomains=None, resolutions=None, prefetchDepth=2,
+                  nativeReader=False, fieldCacheSize=0):
+    """
+    This definition sets up the run of convertFcstFiles & convertAnlFiles
+    (logging, folders, target domains, output mode, task manifest & metrics),
+    calls convert() and then stops the logging and moves the log file.
+    :param ftype: 'fcst' or 'anl'.
+    :param convert: function (without arguments) which converts & re-orders
+                    the files, say convertFilesInParallel of the file names.
+    :param inPath: input data path, which has the date/hr folders.
+    :param outPath: output path, where the date folder is created.
+    :param tmpPath: working path of the log, regrid weights, shared arrays,
+                    shards, task manifest, metrics and field cache.
+    :param date: date in YYYYMMDD format.
+    :param hr: assimilated hour as string (say '00').
+    :param outputMode: 'locked' (all workers append into same file by
+                       acquiring lock) or 'shard' (lock free per-task shard
+                       files concatenated at the end) or 'writer' (workers
+                       encode, single writer process appends).
+    :param ctlMode: 'native' (GrADS ctl & idx from the writer offsets) or
+                    'g2ctl' (g2ctl.pl & gribmap scripts).
+    :param ctlTemplate: if True, then one templated (%f3) ctl & idx is
+                        created for all the forecast files, instead of one
+                        per file (native ctlMode & forecast files only).
+    :param nprocs: no of worker processes (default is the no of LSF
+                   allocated slots or else cpu count).
+    :param resume: if True, then only the units which are not completed in
+                   the earlier run (as per the task manifest) are converted.
+    :param logLevel: log level ('DEBUG' logs the per-field details also).
+    :param memBudget: memory budget (in MB) of the concurrently running tasks
+                      (default is 80% of the physical memory of the node).
+    :param subdomains: dictionary of the subdomain name and its (south,
+                       north, west, east) lat/lon box (not crossing 0/360, see
+                       setTargetDomains), say {'india': (0, 40, 60, 100)}.
+                       Only those boxes are converted (into um_prg_<name>_...
+                       or um_ana_<name>_... outfiles), the None box is the
+                       global domain. Default is global only.
+    :param resolutions: list of the target grid resolutions in degrees, say
+                        [0.25, 0.5, 1.0]. Every field is loaded once and
+                        regridded to all of them (the non 0.25 deg outfiles
+                        are tagged, say um_prg_1p00deg_...). Default [0.25].
+    :param prefetchDepth: no of level slices read ahead by the reader thread
+                          of every task, while the current one is regridded
+                          (0 disables the reader thread).
+    :param nativeReader: if True, then the data of the fieldsfiles is read by
+                         the native memory mapped reader (else by iris). The
+                         fields which it doesn't decode alike by iris are
+                         still read by iris. Default False.
+    :param fieldCacheSize: max size (bytes) of the cross-cycle cache of the
+                           regridded fields of the previous cycle inputs (say
+                           analysis umglca_pf) in tmpPath/fieldCache, which is
+                           reused by the reruns (with the same tmpPath). The
+                           least recently used fields are evicted beyond it.
+                           0 (default) disables the cache.
+    """
+    global _targetGrid_, _current_date_, _startT_, _tmpDir_, _inDataPath_, _opPath_
+    global _regridWeightsDir_, _outputMode_, _shardDir_, _ctlMode_, _ctlTemplate_, _nprocs_
+    global _sharedDir_, _manifestPath_, _memBudget_, _domains_, _prefetchDepth_, _nativeReader_
+    global _fieldCacheDir_, _fieldCacheSize_
+    
+    outfile = 'um_prg' if ftype in ['fcst', 'forecast'] else 'um_ana'
+    logFile = 'log2.log' if ftype in ['fcst', 'forecast'] else 'log1.log'
+    runName = '%s_%shr_%s' % (outfile, hr.zfill(3), date)
+    
+    # get the current date in YYYYMMDD format
+    _tmpDir_ = tmpPath
+    _current_date_ = date
+    # all the workers log through one listener process (non-blocking)
+    logListener = mplogging.LogListener(os.path.join(_tmpDir_, logFile), logLevel)
+    try:
+        _log_.info("_current_date_ is %s", _current_date_)
+        
+        # start the timer now
+        _startT_ = time.time()
+        
+        # set-up base folders
+        _inDataPath_ = os.path.join(inPath, _current_date_, hr)
+        if not os.path.exists(_inDataPath_):
+            raise ValueError("In datapath does not exists %s" % _inDataPath_)
+        # end of if not os.path.exists(_inDataPath_):
+        
+        _opPath_ = os.path.join(outPath, _current_date_)
+        if not os.path.exists(_opPath_):
+            os.makedirs(_opPath_)
+            _log_.info("Created directory %s", _opPath_)
+        # end of if not os.path.exists(_opPath_):
+        
+        # target grids (0.25 deg by default) of the output domains, i.e. global
+        # and/or regional subdomains at every resolution (see setTargetDomains)
+        _sharedDir_ = os.path.join(_tmpDir_, 'shared')
+        setTargetDomains(subdomains, resolutions)
+        # regrid weights are persisted here, so that all runs/workers reuse it.
+        _regridWeightsDir_ = os.path.join(_tmpDir_, 'regridWeights')
+        _fieldCacheDir_ = os.path.join(_tmpDir_, 'fieldCache')
+        
+        if outputMode not in ['locked', 'shard', 'writer']:
+            raise ValueError("Unknown outputMode '%s'" % outputMode)
+        _outputMode_ = outputMode
+        if ctlMode not in ['native', 'g2ctl']:
+            raise ValueError("Unknown ctlMode '%s'" % ctlMode)
+        _ctlMode_ = ctlMode
+        _ctlTemplate_ = ctlTemplate
+        _nprocs_ = nprocs
+        _memBudget_ = memBudget
+        _prefetchDepth_ = prefetchDepth
+        _nativeReader_ = nativeReader
+        _fieldCacheSize_ = fieldCacheSize
+        if _outputMode_ == 'shard':
+            _shardDir_ = os.path.join(_tmpDir_, 'shards')
+            if not os.path.exists(_shardDir_): os.makedirs(_shardDir_)
+        # end of if _outputMode_ == 'shard':
+        # task manifest of this run. If not resume, then start afresh (the older
+        # outputs which are not in the manifest will be removed).
+        _manifestPath_ = os.path.join(_tmpDir_, 'manifest', '%s.%s.manifest' % (runName, _outputMode_))
+        if outfile == 'um_prg':
+            # forecast manifest of the older versions was not named by hour,
+            # so lets move it to the new name (to resume from it)
+            oldManifestPath = os.path.join(_tmpDir_, 'manifest', 'um_prg_%s.%s.manifest' % (date, _outputMode_))
+            if resume and os.path.isfile(oldManifestPath) and not os.path.isfile(_manifestPath_):
+                os.rename(oldManifestPath, _manifestPath_)
+                _log_.warning("Renamed the older forecast manifest %s as %s", oldManifestPath, _manifestPath_)
+            # end of if resume and ...:
+            manifest.removeManifest(oldManifestPath)
+        # end of if outfile == 'um_prg':
+        if not resume: manifest.removeManifest(_manifestPath_)
+        # per-task metrics of this run (see scripts/metricsreport.py)
+        metricsDir = os.path.join(_tmpDir_, 'metrics', '%s.%s' % (runName, time.strftime('%Y%m%dT%H%M%S')))
+        metrics.setup(metricsDir)
+        _log_.info("Writing task metrics into %s", metricsDir)
+        
+        convert()
+    finally:
+        # write all the pending log records
+        logListener.stop()
+    # end of try:
+    
+    cmdStr = ['mv', os.path.join(_tmpDir_, logFile),
+              os.path.join(_tmpDir_, 'um2grib2_%s_stdout_%s_%shr.log' % (ftype, _current_date_, hr))]
+    subprocess.call(cmdStr)
+# end of def runConversion(...): #52
 
 # start definition #12
-def convertFcstFiles(inPath, outPath, tmpPath, date=time.strftime('%Y%m%d'), hr='00'):
+def convertFcstFiles(inPath, outPath, tmpPath, date=time.strftime('%Y%m%d'), hr='00',
+                     outputMode='locked', ctlMode='native', ctlTemplate=False,
+                     nprocs=None, resume=True, watch=False, pollInterval=30,
+                     watchTimeout=3600, logLevel='INFO', memBudget=None, subdomains=None,
+                     resolutions=None, prefetchDepth=2, nativeReader=False,
+                     fieldCacheSize=0):
     """
     What does this definition do?
     This definition is meant to manage the inout filename, outpath and the date
     and hour for which it has to work on. This is the basic module that calls/logs
     the process.
     - Initiated and Written by AAT
-    :param inPath:
-    :param outPath:
-    :param tmpPath:
-    :param date:
-    :param hr:
+    :param watch: if True, then it watches the input path while the UM run
+                  is still writing the forecast files and converts each file
+                  as soon as it lands (instead of waiting for the whole run).
+    :param pollInterval: watch mode polling interval in seconds.
+    :param watchTimeout: watch mode stops, if no new input file lands within
+                         these seconds.
+    The rest of the parameters are documented in runConversion.
     :return:
     """
-
-    global _targetGrid_, _current_date_, _startT_, _tmpDir_, _inDataPath_, _opPath_
     
     # forecast filenames partial name
-    fcst_fnames = ['umglaa_pb','umglaa_pd', 'umglaa_pe'] 
+    fcst_fnames = ['umglaa_pb','umglaa_pd', 'umglaa_pe', 'umglaa_pf'] 
     
-    ## pf file is not working....
-    ###'umglaa_pf',
-    # get the current date in YYYYMMDD format
-    _tmpDir_ = tmpPath
-    _current_date_ = date
-    print "\n _current_date_ is %s" % _current_date_
-    sys.stdout = myLog(os.path.join(_tmpDir_, "log2.log"))
-    
-    # start the timer now
-    _startT_ = time.time()
-
-    # set-up base folders    
-    _inDataPath_ = os.path.join(inPath, _current_date_, hr)
-    if not os.path.exists(_inDataPath_):
-        raise ValueError("In datapath does not exists %s" % _inDataPath_)
-    # end of if not os.path.exists(_inDataPath_):
-    
-    _opPath_ = os.path.join(outPath, _current_date_)
-    if not os.path.exists(_opPath_):  
-        os.makedirs(_opPath_)
-        print "Created directory", _opPath_
-    # end of if not os.path.exists(_opPath_):  
-    
-    # target grid as 0.25 deg resolution by setting up sample points based on coord
-    _targetGrid_ = [('longitude',numpy.linspace(0,360,1440)),
-                    ('latitude',numpy.linspace(-90,90,721))]
-                    
-    # do convert for forecast files 
-    convertFilesInParallel(fcst_fnames, ftype='fcst')   
-    
-    # do re-order variables within files in parallel
-    doShuffleVarsInOrderInParallel('fcst', hr)
-    
-    cmdStr = ['mv', _tmpDir_+'log2.log', _tmpDir_+ 'um2grib2_fcst_stdout_'+ _current_date_ +'_00hr.log']
-    subprocess.call(cmdStr)     
+    def convert():
+        if watch:
+            # convert each forecast file as soon as it lands, and re-order
+            # variables within files as soon as all its input files are done
+            watchFilesInParallel(fcst_fnames, hr, pollInterval, watchTimeout)
+        else:
+            # do convert for forecast files and re-order variables within files
+            # in parallel
+            convertFilesInParallel(fcst_fnames, 'fcst', hr)
+        # end of if watch:
+    # end of def convert():
+    
+    runConversion('fcst', convert, inPath, outPath, tmpPath, date, hr, outputMode, ctlMode,
+                  ctlTemplate, nprocs, resume, logLevel, memBudget, subdomains, resolutions,
+                  prefetchDepth, nativeReader, fieldCacheSize)
 # end of definition #12 -- convertFcstFiles(...):
 
 # start definition #13
-def convertAnlFiles(inPath, outPath, tmpPath, date=time.strftime('%Y%m%d'), hr='00'):
+def convertAnlFiles(inPath, outPath, tmpPath, date=time.strftime('%Y%m%d'), hr='00',
+                    outputMode='locked', ctlMode='native', nprocs=None, resume=True,
+                    logLevel='INFO', memBudget=None, subdomains=None, resolutions=None,
+                    prefetchDepth=2, nativeReader=False, fieldCacheSize=0):
     """
     What does this definition do?
     This module creates the analysis files <- Ref to Dr. Saji! as simple as that!
     Created by AAT!
-    :param inPath:
-    :param outPath:
-    :param tmpPath:
-    :param date:
-    :param hr:
+    The parameters are documented in runConversion.
     :return:
     """
-       
-    global _targetGrid_, _current_date_, _startT_, _tmpDir_, _inDataPath_, _opPath_
     
     # analysis filenames partial name
-    anl_fnames = ['umglca_pb', 'umglca_pd', 'umglca_pe']
+    anl_fnames = ['umglca_pb', 'umglca_pd', 'umglca_pe', 'umglca_pf']
     
     if hr == '00': anl_fnames.insert(0, 'qwqg00.pp0')
     
-    ## pf file is not working....
-    ###'umglca_pf',
-    # get the current date in YYYYMMDD format
-    _tmpDir_ = tmpPath
-    _current_date_ = date
-    print "\n _current_date_ is %s" % _current_date_
-    sys.stdout = myLog(os.path.join(_tmpDir_, "log1.log"))
-    
-    # start the timer now
-    _startT_ = time.time()
-
-    # set-up base folders
-    _inDataPath_ = os.path.join(inPath, _current_date_, hr)
-    if not os.path.exists(_inDataPath_):
-        raise ValueError("In datapath does not exists %s" % _inDataPath_)
-    # end of if not os.path.exists(_inDataPath_):
-    
-    _opPath_ = os.path.join(outPath, _current_date_)
-    if not os.path.exists(_opPath_):  
-        os.makedirs(_opPath_)
-        print "Created directory", _opPath_
-    # end of if not os.path.exists(_opPath_):  
-    
-    # target grid as 0.25 deg resolution by setting up sample points based on coord
-    _targetGrid_ = [('longitude',numpy.linspace(0,360,1440)),
-                    ('latitude',numpy.linspace(-90,90,721))]
-                    
-    # do convert for analysis files
-    convertFilesInParallel(anl_fnames, ftype='anl')   
-    
-    # do re-order variables within files in parallel
-    doShuffleVarsInOrderInParallel('anl', hr)
-    
-    cmdStr = ['mv', _tmpDir_+'log1.log', _tmpDir_+ 'um2grib2_anl_stdout_'+ _current_date_ +'_' +hr+'hr.log']
-    subprocess.call(cmdStr)  
+    # do convert for analysis files and re-order variables within files
+    # in parallel
+    convert = lambda: convertFilesInParallel(anl_fnames, 'anl', hr)
+    runConversion('anl', convert, inPath, outPath, tmpPath, date, hr, outputMode, ctlMode,
+                  False, nprocs, resume, logLevel, memBudget, subdomains, resolutions,
+                  prefetchDepth, nativeReader, fieldCacheSize)
 # end of def convertAnlFiles(...):
 
 ####### Older code-base for later amnesia-attack!
@@ -0,0 +1,26 @@
+"""
+This is simple script to report the per-task metrics of an um2grb2 run,
+i.e. run wall time, per-stage breakdown (time, fields, MB and throughput),
+lock waiting time, per-worker busy time, slowest tasks and critical path.
+
+Usage : python metricsreport.py <tmpPath>/metrics/<run> [--top N] [--json]
+
+Date : 18.Oct.2026
+"""
+
+import os, sys, json, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from g2utils import metrics
+
+parser = argparse.ArgumentParser(description="Report the um2grb2 task metrics")
+parser.add_argument('metricsDir', help="metrics directory of the run")
+parser.add_argument('--top', type=int, default=10, help="no of slowest tasks to list")
+parser.add_argument('--json', action='store_true', help="dump the raw records as json list")
+args = parser.parse_args()
+
+records = metrics.loadRecords(args.metricsDir)
+if args.json:
+    print json.dumps(records, indent=1)
+else:
+    print metrics.report(records, args.top)
+# end of if args.json: